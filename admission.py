@@ -0,0 +1,243 @@
+# admission.py — control de admisión de escrituras: token buckets por centro y por token, tope global en vuelo
+import hashlib, itertools, json, math, os, sqlite3, threading, time
+from collections import Counter, namedtuple
+
+ADMISSION_BACKEND = os.getenv("ADMISSION_BACKEND", "off")  # off | memory | sqlite
+ADMISSION_PATH = os.getenv("ADMISSION_PATH", "/tmp/servidor_sync_admission.sqlite3")
+ADMISSION_CENTRO_RATE = float(os.getenv("ADMISSION_CENTRO_RATE", "5"))  # escrituras/s sostenidas por centro; 0 = sin límite
+ADMISSION_CENTRO_BURST = float(os.getenv("ADMISSION_CENTRO_BURST", "30"))
+ADMISSION_TOKEN_RATE = float(os.getenv("ADMISSION_TOKEN_RATE", "50"))  # escrituras/s por bearer token; 0 = sin límite
+ADMISSION_TOKEN_BURST = float(os.getenv("ADMISSION_TOKEN_BURST", "200"))
+ADMISSION_MAX_IN_FLIGHT = int(os.getenv("ADMISSION_MAX_IN_FLIGHT", "32"))  # entre todos los workers; 0 = sin tope
+ADMISSION_LEASE_TTL = float(os.getenv("ADMISSION_LEASE_TTL", "120"))  # segundos; libera cupos de workers caídos
+ADMISSION_SHED_RETRY_AFTER = float(os.getenv("ADMISSION_SHED_RETRY_AFTER", "1"))
+# Límites por centro, p. ej. {"centro-grande": {"rate": 10, "burst": 60}}
+ADMISSION_CENTRO_LIMITS = os.getenv("ADMISSION_CENTRO_LIMITS", "")
+BUCKET_IDLE_TTL = 3600  # segundos sin uso tras los que se olvida un bucket
+
+Limit = namedtuple("Limit", "rate burst")
+
+class Decision(namedtuple("Decision", "admitted reason retry_after lease")):
+    """Outcome of an admission check; `lease` must be released when the request ends."""
+
+    @property
+    def retry_after_header(self):
+        return str(max(1, math.ceil(self.retry_after)))
+
+ADMITTED = Decision(True, None, 0.0, None)
+
+def parse_limits(raw):
+    if not raw:
+        return {}
+    try:
+        value = json.loads(raw)
+        return {str(centro_id): Limit(float(limit["rate"]), float(limit["burst"])) for centro_id, limit in value.items()}
+    except (ValueError, TypeError, KeyError, AttributeError) as exc:
+        raise RuntimeError(f"ADMISSION_CENTRO_LIMITS inválido: {exc}")
+
+def token_key(authorization):
+    """Bucket key for a bearer token; the token itself is never stored."""
+    token = authorization.split(" ", 1)[1] if authorization and authorization.startswith("Bearer ") else ""
+    return hashlib.sha256(token.encode("utf-8")).hexdigest()[:16] if token else "anon"
+
+def _refill(tokens, updated, limit, now):
+    if tokens is None:
+        return limit.burst
+    return min(limit.burst, tokens + max(0.0, now - updated) * limit.rate)
+
+def _shortest(levels, wants):
+    """(seconds until every bucket holds its cost in tokens, key of the slowest bucket)."""
+    waits = [((cost - levels[key]) / limit.rate, key) for key, limit, cost in wants if levels[key] < cost]
+    return max(waits) if waits else (0.0, None)
+
+class MemoryBackend:
+    """Per-process buckets and leases (a single worker or tests)."""
+
+    def __init__(self):
+        self._buckets = {}
+        self._leases = {}
+        self._ids = itertools.count(1)
+        self._lock = threading.Lock()
+
+    def take(self, wants):
+        """Take each (key, limit, cost) from its bucket, all or none; returns (wait seconds, limiting key)."""
+        now = time.time()
+        with self._lock:
+            levels = {key: _refill(*self._buckets.get(key, (None, None)), limit, now) for key, limit, _ in wants}
+            wait, limiting = _shortest(levels, wants)
+            if limiting is None:
+                for key, _, cost in wants:
+                    self._buckets[key] = (levels[key] - cost, now)
+            return wait, limiting
+
+    def acquire(self, max_in_flight, ttl):
+        now = time.time()
+        with self._lock:
+            for lease, expires in list(self._leases.items()):
+                if expires <= now:
+                    del self._leases[lease]
+            if len(self._leases) >= max_in_flight:
+                return None
+            lease = str(next(self._ids))
+            self._leases[lease] = now + ttl
+            return lease
+
+    def release(self, lease):
+        with self._lock:
+            self._leases.pop(lease, None)
+
+    def clear(self):
+        with self._lock:
+            self._buckets.clear()
+            self._leases.clear()
+
+class SQLiteBackend:
+    """Buckets and leases on local disk, shared by every gunicorn worker on the host."""
+
+    def __init__(self, path=ADMISSION_PATH):
+        self.path = path
+        self._local = threading.local()
+        self._ids = itertools.count(1)
+        self._takes = 0
+        conn = self._conn()
+        conn.execute("CREATE TABLE IF NOT EXISTS buckets (key TEXT PRIMARY KEY, tokens REAL NOT NULL, updated REAL NOT NULL)")
+        conn.execute("CREATE TABLE IF NOT EXISTS leases (id TEXT PRIMARY KEY, expires REAL NOT NULL)")
+
+    def _conn(self):
+        # Una conexión heredada por fork (gunicorn --preload) no debe reutilizarse.
+        conn = getattr(self._local, "conn", None)
+        if conn is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    def _transaction(self, fn):
+        conn = self._conn()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            result = fn(conn)
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        conn.execute("COMMIT")
+        return result
+
+    def take(self, wants):
+        now = time.time()
+
+        def run(conn):
+            levels = {}
+            for key, limit, _ in wants:
+                row = conn.execute("SELECT tokens, updated FROM buckets WHERE key = ?", (key,)).fetchone()
+                levels[key] = _refill(*(row or (None, None)), limit, now)
+            wait, limiting = _shortest(levels, wants)
+            if limiting is None:
+                conn.executemany(
+                    "INSERT OR REPLACE INTO buckets (key, tokens, updated) VALUES (?, ?, ?)",
+                    [(key, levels[key] - cost, now) for key, _, cost in wants],
+                )
+            return wait, limiting
+
+        result = self._transaction(run)
+        self._takes += 1
+        if self._takes % 256 == 0:
+            self._conn().execute("DELETE FROM buckets WHERE updated < ?", (now - BUCKET_IDLE_TTL,))
+        return result
+
+    def acquire(self, max_in_flight, ttl):
+        now = time.time()
+        lease = f"{os.getpid()}-{next(self._ids)}"
+
+        def run(conn):
+            conn.execute("DELETE FROM leases WHERE expires <= ?", (now,))
+            (count,) = conn.execute("SELECT COUNT(*) FROM leases").fetchone()
+            if count >= max_in_flight:
+                return None
+            conn.execute("INSERT INTO leases (id, expires) VALUES (?, ?)", (lease, now + ttl))
+            return lease
+
+        return self._transaction(run)
+
+    def release(self, lease):
+        self._conn().execute("DELETE FROM leases WHERE id = ?", (lease,))
+
+    def clear(self):
+        conn = self._conn()
+        conn.execute("DELETE FROM buckets")
+        conn.execute("DELETE FROM leases")
+
+class AdmissionController:
+    """Decides whether a write request may run now.
+
+    A request first takes one of `max_in_flight` slots (shared by every
+    worker with the sqlite backend), then one token per report from the
+    bucket of each centro it writes to and from the bucket of its bearer
+    token. Any miss answers 429 right away instead of letting the request
+    queue behind the others.
+
+    The slot is held while the request runs. Writes it hands off to the
+    ASYNC_WRITES queue or the autosave coalescer run after it answers and are
+    not counted; those are bounded by their own threads (WRITE_QUEUE_WORKERS,
+    one coalescer thread per worker).
+    """
+
+    def __init__(self, backend=None, centro_limit=None, token_limit=None, centro_limits=None,
+                 max_in_flight=ADMISSION_MAX_IN_FLIGHT, lease_ttl=ADMISSION_LEASE_TTL):
+        self.backend = backend
+        self.centro_limit = centro_limit or Limit(ADMISSION_CENTRO_RATE, ADMISSION_CENTRO_BURST)
+        self.token_limit = token_limit or Limit(ADMISSION_TOKEN_RATE, ADMISSION_TOKEN_BURST)
+        self.centro_limits = parse_limits(ADMISSION_CENTRO_LIMITS) if centro_limits is None else centro_limits
+        self.max_in_flight = max_in_flight
+        self.lease_ttl = lease_ttl
+
+    def limit_for(self, centro_id):
+        return self.centro_limits.get(centro_id, self.centro_limit)
+
+    def admit(self, centro_ids, authorization=None):
+        """`centro_ids` has one entry per report written, so a batch pays per report."""
+        if self.backend is None:
+            return ADMITTED
+        lease = None
+        if self.max_in_flight > 0:
+            lease = self.backend.acquire(self.max_in_flight, self.lease_ttl)
+            if lease is None:
+                return Decision(False, "in_flight", ADMISSION_SHED_RETRY_AFTER, None)
+
+        admitted = False
+        try:
+            # El costo se topa en la ráfaga: si no, un lote mayor nunca cabría.
+            wants = [
+                (f"centro:{centro_id}", self.limit_for(centro_id), min(count, self.limit_for(centro_id).burst))
+                for centro_id, count in sorted(Counter(centro_ids).items())
+            ]
+            wants.append((f"token:{token_key(authorization)}", self.token_limit,
+                          min(max(1, len(centro_ids)), self.token_limit.burst)))
+            wants = [want for want in wants if want[1].rate > 0]
+            wait, limiting = self.backend.take(wants) if wants else (0.0, None)
+            if limiting is not None:
+                return Decision(False, limiting.split(":", 1)[0], wait, None)
+            admitted = True
+            return Decision(True, None, 0.0, lease)
+        finally:
+            if not admitted and lease is not None:
+                self.backend.release(lease)
+
+    def release(self, decision):
+        if self.backend is not None and decision is not None and decision.lease is not None:
+            self.backend.release(decision.lease)
+
+    def clear(self):
+        if self.backend is not None:
+            self.backend.clear()
+
+def build_controller():
+    if ADMISSION_BACKEND == "off":
+        return AdmissionController(None)
+    if ADMISSION_BACKEND == "sqlite":
+        return AdmissionController(SQLiteBackend())
+    if ADMISSION_BACKEND == "memory":
+        return AdmissionController(MemoryBackend())
+    raise RuntimeError(f"ADMISSION_BACKEND desconocido: {ADMISSION_BACKEND}")
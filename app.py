@@ -1,21 +1,62 @@
 # app.py — Render/Flask → Firebase RTDB (/ecosistemas/.../dispositivos/.../feed_estudios)
-import os, json, base64, time, hashlib, hmac, re
-from flask import Flask, request, jsonify
+import os, io, json, base64, time, hashlib, hmac, re, threading
+_import_started = time.perf_counter()
+from flask import Flask, Response, g, request, jsonify, send_file, stream_with_context
 from flask_cors import CORS
-import firebase_admin
-from firebase_admin import credentials, db
+from push_ids import generate_push_id
+import compaction
+from blob_store import digest_from_storage_path, get_blob_store, storage_path_for
+import read_cache
+from write_queue import WriteQueue
+import state_versions
+from firebase_io import FIREBASE_IO_TIMEOUT, fio
+import metrics
+import storage
+import http_codec
+import feed_sync
+import centro_feed
+import admission
+import png_optimize
+import coalescer
+from profiling import profiler
 
 # 1) Instancia de Flask PRIMERO
 app = Flask(__name__)
 CORS(app)
+http_codec.init_app(app)
 
 # 2) Config
 RTDB_URL = "https://reportes-intenligentes-default-rtdb.firebaseio.com/"
 AUTH_TOKEN = os.getenv("PUSH_FEED_TOKEN")  # opcional (si está seteado, exige Bearer)
 MAX_ATTACHMENT_BYTES = int(os.getenv("MAX_ATTACHMENT_BYTES", str(8 * 1024 * 1024)))
+UPLOAD_CHUNK_BYTES = int(os.getenv("UPLOAD_CHUNK_BYTES", str(64 * 1024)))
+PNG_SIGNATURE = b"\x89PNG\r\n\x1a\n"
+RTDB_FORBIDDEN = re.compile(r"[.#$\[\]/\x00-\x1f\x7f]")  # caracteres no válidos en una llave de RTDB
+ATTACHMENT_CACHE_MAX_AGE = int(os.getenv("ATTACHMENT_CACHE_MAX_AGE", "0"))  # 0 = revalidar siempre (304)
+DEVICE_CACHE_TTL = float(os.getenv("DEVICE_CACHE_TTL", "60"))  # segundos; 0 desactiva la caché
+DEVICE_INDEX_LISTEN = os.getenv("DEVICE_INDEX_LISTEN", "") == "1"
+# Un worker con la lista cacheada no ve un registro nuevo hasta que vence el
+# TTL; pasado este plazo se rellena el feed del equipo con lo que se perdió.
+DEVICE_BACKFILL_DELAY = float(os.getenv("DEVICE_BACKFILL_DELAY", str(DEVICE_CACHE_TTL + 5)))
+ASYNC_WRITES = os.getenv("ASYNC_WRITES", "") == "1"  # /push_feed responde 202 y escribe en segundo plano
+BATCH_MAX_ITEMS = int(os.getenv("BATCH_MAX_ITEMS", "500"))
+STATE_WRITE_ATTEMPTS = int(os.getenv("STATE_WRITE_ATTEMPTS", "5"))  # guardados concurrentes del mismo estado
+STATE_RETRY_DELAY = float(os.getenv("STATE_RETRY_DELAY", "0.05"))  # segundos; se duplica en cada intento
+RESTORE_BATCH_MAX = int(os.getenv("RESTORE_BATCH_MAX", "200"))
+READYZ_TIMEOUT = float(os.getenv("READYZ_TIMEOUT", "3"))  # segundos
+READYZ_PROBE_PATH = os.getenv("READYZ_PROBE_PATH", "/_readyz")
+# gunicorn.conf.py lo pone en 0: con preload los hilos se arrancan en post_fork.
+BACKGROUND_ON_IMPORT = os.getenv("BACKGROUND_ON_IMPORT", "1") == "1"
 
-# 3) Init Firebase (acepta ENV JSON, ENV base64 o archivo)
+# httpTimeout acota cada petición HTTP; firebase_io además corta la espera.
+FIREBASE_OPTIONS = {"databaseURL": RTDB_URL, "httpTimeout": FIREBASE_IO_TIMEOUT}
+
+# 3) Init Firebase (acepta ENV JSON, ENV base64 o archivo). Es perezoso: corre
+# en el primer acceso a RTDB o en el post_fork de gunicorn, no al importar.
 def init_firebase():
+    import firebase_admin
+    from firebase_admin import credentials
+
     if firebase_admin._apps:
         return
 
@@ -33,19 +74,19 @@ def init_firebase():
     if sa_b64:
         data = json.loads(base64.b64decode(sa_b64))
         cred = credentials.Certificate(data)
-        firebase_admin.initialize_app(cred, {"databaseURL": RTDB_URL})
+        firebase_admin.initialize_app(cred, FIREBASE_OPTIONS)
         print("[creds] usando FIREBASE_SERVICE_ACCOUNT_B64")
         return
 
     if sa_json:
         cred = credentials.Certificate(json.loads(sa_json))
-        firebase_admin.initialize_app(cred, {"databaseURL": RTDB_URL})
+        firebase_admin.initialize_app(cred, FIREBASE_OPTIONS)
         print("[creds] usando FIREBASE_SERVICE_ACCOUNT")
         return
 
     if sa_path and os.path.exists(sa_path):
         cred = credentials.Certificate(sa_path)
-        firebase_admin.initialize_app(cred, {"databaseURL": RTDB_URL})
+        firebase_admin.initialize_app(cred, FIREBASE_OPTIONS)
         print(f"[creds] usando archivo: {sa_path}")
         return
 
@@ -53,7 +94,73 @@ def init_firebase():
         "No hay credenciales: define FIREBASE_SERVICE_ACCOUNT (o *_B64) o FIREBASE_CREDENTIALS_PATH."
     )
 
-init_firebase()
+# Con STORAGE_BACKEND=sqlite no hay credenciales que cargar.
+store = storage.build_store()
+fio.configure(init_firebase if store.name == "firebase" else None, store=store)
+
+# Instrumentación por ruta (Prometheus, ver /metrics)
+def request_route():
+    return request.url_rule.rule if request.url_rule is not None else "unmatched"
+
+@app.before_request
+def start_request_metrics():
+    g.metrics_started = time.perf_counter()
+    g.metrics_route = request_route()
+    g.profile = profiler.begin(g.metrics_route, request.method)
+    metrics.IN_FLIGHT.labels(g.metrics_route).inc()
+    if request.content_length:
+        metrics.PAYLOAD_BYTES.labels(g.metrics_route).observe(request.content_length)
+
+@app.after_request
+def record_status(response):
+    g.metrics_status = response.status_code
+    return response
+
+@app.teardown_request
+def finish_request_metrics(exc):
+    started = g.pop("metrics_started", None)
+    if started is None:
+        return
+    route = g.pop("metrics_route")
+    status = g.pop("metrics_status", 500)
+    metrics.IN_FLIGHT.labels(route).dec()
+    metrics.REQUEST_LATENCY.labels(route, request.method).observe(time.perf_counter() - started)
+    metrics.REQUESTS.labels(route, request.method, str(status)).inc()
+    profiler.end(g.pop("profile", None), status)
+
+# Control de admisión delante de las escrituras: token buckets por centro y
+# por token, y un tope global de escrituras en vuelo (ver admission.py).
+admission_control = admission.build_controller()
+ADMISSION_ERRORS = {
+    "centro": "Demasiadas escrituras para este centro_id",
+    "token": "Demasiadas escrituras para este token",
+    "in_flight": "Servidor ocupado con otras escrituras",
+}
+
+def admit_write(centro_ids):
+    """Admission check for a write endpoint: None to go ahead, or a 429 response."""
+    try:
+        decision = admission_control.admit(centro_ids, request.headers.get("Authorization"))
+    except Exception as exc:
+        # p. ej. sqlite3.OperationalError (base bloqueada): el control de
+        # admisión protege el servicio, no debe tumbar la escritura.
+        print(f"[admision] falló la verificación, se admite: {exc}")
+        return None
+    if decision.admitted:
+        g.admission = decision
+        return None
+    metrics.ADMISSION_REJECTED.labels(decision.reason).inc()
+    response = jsonify({
+        "ok": False,
+        "error": f"{ADMISSION_ERRORS[decision.reason]}; reintenta en {decision.retry_after_header} s",
+        "retry_after": decision.retry_after_header,
+    })
+    response.headers["Retry-After"] = decision.retry_after_header
+    return response, 429
+
+@app.teardown_request
+def release_admission(exc):
+    admission_control.release(g.pop("admission", None))
 
 # 4) Helpers
 def check_auth(req):
@@ -86,9 +193,83 @@ def parse_report_state(value):
         raise ValueError("estado_reporte debe ser un objeto JSON")
     return value
 
+def report_state_path(centro_id, codigo_unico):
+    key = report_state_key(centro_id, codigo_unico)
+    return f"/ecosistemas/{centro_id}/estados_reportes/{key}"
+
 def report_state_ref(centro_id, codigo_unico):
+    return fio.reference(report_state_path(centro_id, codigo_unico))
+
+# Caché read-through delante de report_state_ref().get() y attachment_ref().get();
+# push_feed y subir_esquema_prostata invalidan la llave que escriben.
+cache = read_cache.build_cache()
+
+def report_keys(reports):
+    """Per-report keys that order queued writes of the same report."""
+    return sorted({report_state_key(r["centro_id"], r["codigo_unico"]) for r in reports if r is not None})
+
+def state_cache_key(centro_id, codigo_unico):
+    return f"estado:{report_state_key(centro_id, codigo_unico)}"
+
+def attachment_cache_key(centro_id, codigo_unico, tipo="esquema_prostata"):
+    return stored_attachment_cache_key(report_state_key(centro_id, codigo_unico), tipo)
+
+def stored_attachment_cache_key(key, tipo):
+    """Cache key of the attachment stored at adjuntos_reportes/{key}/{tipo}."""
+    return f"adjunto:{key}:{tipo}"
+
+def invalidate_stored_attachment(centro_id, key, tipo):
+    cache.invalidate(stored_attachment_cache_key(key, tipo))
+
+def load_report_state(centro_id, codigo_unico):
+    return cache.get_or_load(
+        state_cache_key(centro_id, codigo_unico),
+        lambda: fio.get(report_state_path(centro_id, codigo_unico)),
+    )
+
+def meta_cache_key(centro_id, codigo_unico):
+    return f"meta:{report_state_key(centro_id, codigo_unico)}"
+
+def report_meta_path(centro_id, codigo_unico):
     key = report_state_key(centro_id, codigo_unico)
-    return db.reference(f"/ecosistemas/{centro_id}/estados_reportes/{key}")
+    return f"/ecosistemas/{centro_id}/estados_reportes_meta/{key}"
+
+def report_meta(record, version=None):
+    """Small per-state summary written next to the head for worklist lookups."""
+    return {
+        "codigo_unico": record.get("codigo_unico"),
+        "email_usuario": record.get("email_usuario"),
+        "updatedAt": record.get("updatedAt"),
+        "version": record.get("version") if version is None else version,
+    }
+
+def load_report_meta(centro_id, codigo_unico):
+    def loader():
+        meta = fio.get(report_meta_path(centro_id, codigo_unico))
+        # Un meta con `reservada` lo dejó una reserva de una versión anterior
+        # (el meta hacía de lock): no está confirmado, manda el head.
+        if isinstance(meta, dict) and "reservada" not in meta:
+            return meta
+        # Estados guardados antes de existir el resumen: se deriva del head.
+        head = load_report_state(centro_id, codigo_unico)
+        return report_meta(head) if isinstance(head, dict) else None
+
+    return cache.get_or_load(meta_cache_key(centro_id, codigo_unico), loader)
+
+def current_report_state(centro_id, codigo_unico):
+    """Return the state head for a write, validated against RTDB's version.
+
+    Only the tiny /version child is read; the cached head is reused when it
+    is still current, otherwise the full head is fetched again.
+    """
+    version = fio.get(f"{report_state_path(centro_id, codigo_unico)}/version")
+    if not isinstance(version, int):
+        return None
+    head = load_report_state(centro_id, codigo_unico)
+    if not isinstance(head, dict) or head.get("version") != version:
+        head = fio.get(report_state_path(centro_id, codigo_unico))
+        cache.put(state_cache_key(centro_id, codigo_unico), head)
+    return head
 
 def safe_segment(value):
     cleaned = re.sub(r"[^a-zA-Z0-9_-]+", "_", str(value or "").strip())
@@ -96,7 +277,7 @@ def safe_segment(value):
 
 def attachment_ref(centro_id, codigo_unico, tipo="esquema_prostata"):
     key = report_state_key(centro_id, codigo_unico)
-    return db.reference(f"/ecosistemas/{safe_segment(centro_id)}/adjuntos_reportes/{key}/{tipo}")
+    return fio.reference(f"/ecosistemas/{safe_segment(centro_id)}/adjuntos_reportes/{key}/{tipo}")
 
 def attachment_database_path(centro_id, codigo_unico, tipo="esquema_prostata"):
     key = report_state_key(centro_id, codigo_unico)
@@ -115,6 +296,112 @@ def normalize_attachments(value):
             attachments.append(normalized)
     return attachments
 
+# Registro de dispositivos: lectura shallow (solo llaves) de
+# /ecosistemas/{centro}/dispositivos, cacheada por centro con TTL. Así no se
+# descarga el feed_estudios completo de cada equipo en cada guardado.
+#
+# Los equipos se registran con POST /registrar_dispositivo, que escribe
+# dispositivos/{device_id} y dispositivos_index/{device_id}. Un cliente que se
+# registre escribiendo RTDB directamente debe escribir también
+# /ecosistemas/{centro}/dispositivos_index/{device_id}; si no, los workers con
+# la lista cacheada no lo ven hasta que vence DEVICE_CACHE_TTL.
+_device_cache = {}
+_device_cache_lock = threading.Lock()
+_device_listeners = {}
+
+def invalidate_devices(centro_id=None):
+    with _device_cache_lock:
+        if centro_id is None:
+            _device_cache.clear()
+        else:
+            _device_cache.pop(centro_id, None)
+    centro_feed.invalidate(centro_id)
+
+def _watch_device_index(centro_id):
+    """Invalidate the cached device list when /dispositivos_index changes.
+
+    Listening on /dispositivos itself would stream every feed write, so the
+    listener is attached to the lightweight index node that
+    /registrar_dispositivo writes (one key per device).
+    """
+    if not DEVICE_INDEX_LISTEN:
+        return
+    with _device_cache_lock:
+        if centro_id in _device_listeners:
+            return
+        _device_listeners[centro_id] = None
+    initial = {"pending": True}
+
+    def on_event(event):
+        # El primer evento es el snapshot inicial; ya lo cubre la lectura shallow.
+        if initial.pop("pending", False):
+            return
+        invalidate_devices(centro_id)
+
+    try:
+        _device_listeners[centro_id] = fio.listen(
+            f"/ecosistemas/{centro_id}/dispositivos_index", on_event
+        )
+    except Exception as exc:
+        print(f"[dispositivos] listener no disponible para {centro_id}: {exc}")
+
+def list_devices(centro_id, refresh=False):
+    """Return the device IDs registered for a centro (key-only, cached)."""
+    now = time.monotonic()
+    with _device_cache_lock:
+        cached = _device_cache.get(centro_id)
+        if cached and cached[0] > now and not refresh:
+            return list(cached[1])
+
+    dispositivos = fio.get(f"/ecosistemas/{centro_id}/dispositivos", shallow=True)
+    device_ids = sorted(dispositivos.keys()) if isinstance(dispositivos, dict) else []
+
+    if DEVICE_CACHE_TTL > 0 and device_ids:
+        with _device_cache_lock:
+            _device_cache[centro_id] = (now + DEVICE_CACHE_TTL, tuple(device_ids))
+        _watch_device_index(centro_id)
+    return device_ids
+
+def device_registered(centro_id, device_id):
+    """Whether device_id belongs to the centro, re-reading the list on a cache miss.
+
+    A device found only after the re-read registered while this worker's list
+    was cached, so reports fanned out meanwhile are backfilled into its feed.
+    """
+    if device_id in list_devices(centro_id):
+        return True
+    if device_id not in list_devices(centro_id, refresh=True):
+        return False
+    since = int((time.time() - DEVICE_CACHE_TTL) * 1000)
+    centro_feed.schedule_backfill(centro_id, device_id, since, DEVICE_BACKFILL_DELAY)
+    return True
+
+def find_attachment(centro_id, codigo_unico, email, tipo="esquema_prostata"):
+    """Return the attachment record if it belongs to codigo_unico/email."""
+    saved = cache.get_or_load(
+        attachment_cache_key(centro_id, codigo_unico, tipo),
+        lambda: fio.get(attachment_database_path(centro_id, codigo_unico, tipo)),
+    )
+    if not isinstance(saved, dict):
+        return None
+    if not hmac.compare_digest(str(saved.get("codigo_unico") or ""), codigo_unico) or not hmac.compare_digest(str(saved.get("email_usuario") or ""), email):
+        return None
+    return saved
+
+def open_attachment_content(saved):
+    """Return (path or file object, sha256) for a record, or (None, None)."""
+    content_base64 = str(saved.get("content_base64") or "")
+    if content_base64:
+        contenido = base64.b64decode(content_base64)
+        return io.BytesIO(contenido), saved.get("sha256") or hashlib.sha256(contenido).hexdigest()
+    digest = digest_from_storage_path(saved.get("storage_path"))
+    if not digest:
+        return None, None
+    store = get_blob_store()
+    # Con una ruta local send_file conoce el tamaño (necesario para Range).
+    source = store.local_path(digest) or store.open(digest)
+    return (source, digest) if source is not None else (None, None)
+
 def response_parts(result):
     """Normalize a Flask view result without issuing an internal HTTP request."""
     if isinstance(result, tuple):
@@ -133,8 +420,32 @@ def home():
 
 @app.get("/healthz")
 def healthz():
+    # Liveness: no toca Firebase. La disponibilidad real está en /readyz.
     return jsonify({"status": "ok"}), 200
 
+def probe_firebase(timeout=READYZ_TIMEOUT):
+    """One real RTDB round trip; returns its latency in milliseconds."""
+    started = time.perf_counter()
+    fio.get(READYZ_PROBE_PATH, shallow=True, timeout=timeout)
+    return round((time.perf_counter() - started) * 1000, 1)
+
+@app.get("/readyz")
+def readyz():
+    try:
+        latency = fio.call(probe_firebase, timeout=READYZ_TIMEOUT)
+    except Exception as exc:
+        return jsonify({
+            "status": "unavailable",
+            "error": str(exc) or type(exc).__name__,
+            "app_import_ms": APP_IMPORT_MS,
+        }), 503
+    return jsonify({
+        "status": "ready",
+        "firebase_ms": latency,
+        "firebase_init_ms": fio.init_ms,
+        "app_import_ms": APP_IMPORT_MS,
+    }), 200
+
 @app.get("/debug_env")
 def debug_env():
     return jsonify({
@@ -144,40 +455,77 @@ def debug_env():
         "PUSH_FEED_TOKEN_present": bool(os.getenv("PUSH_FEED_TOKEN"))
     }), 200
 
-@app.post("/push_feed")
-def push_feed():
-    # Auth
+@app.get("/metrics")
+def metrics_endpoint():
     if not check_auth(request):
         return jsonify({"ok": False, "error": "Unauthorized"}), 401
+    body, content_type = metrics.render()
+    return Response(body, content_type=content_type)
 
-    # JSON body
+@app.route("/admin/profiling", methods=["GET", "POST"])
+def admin_profiling():
+    """Show or change the sampling profiler settings (applies to every worker)."""
+    if not check_auth(request):
+        return jsonify({"ok": False, "error": "Unauthorized"}), 401
+    if request.method == "GET":
+        return jsonify({"ok": True, "profiling": profiler.settings()}), 200
+    p = normalize_payload(request.get_json(silent=True) or {})
     try:
-        p = request.get_json(force=True) or {}
-    except Exception:
-        return jsonify({"ok": False, "error": "JSON inválido"}), 400
+        settings = profiler.configure(
+            enabled=p["enabled"] in (True, "true", "1", 1) if "enabled" in p else None,
+            sample_rate=p.get("sample_rate"),
+            slow_ms=p.get("slow_ms"),
+        )
+    except (TypeError, ValueError) as exc:
+        return jsonify({"ok": False, "error": f"Parámetros inválidos: {exc}"}), 400
+    except OSError as exc:
+        return jsonify({"ok": False, "error": str(exc)}), 500
+    return jsonify({"ok": True, "profiling": settings}), 200
 
-    # normalizar llaves a lower (compat Bubble)
-    p = normalize_payload(p)
+@app.get("/cache_stats")
+def cache_stats():
+    if not check_auth(request):
+        return jsonify({"ok": False, "error": "Unauthorized"}), 401
+    return jsonify({"ok": True, "read_cache": cache.stats()}), 200
+
+def build_report(p):
+    """Validate a normalized push_feed payload.
 
+    Returns (report, None) or (None, error message). The report is plain JSON
+    so it can be persisted now or queued and replayed later.
+    """
     # requeridos mínimos
     cu = p.get("codigo_unico")
     email = p.get("email_usuario", "")
     if not cu or not email:
-        return jsonify({"ok": False, "error": "Faltan datos requeridos (codigo_unico, email_usuario)"}), 400
+        return None, "Faltan datos requeridos (codigo_unico, email_usuario)"
 
     # destino (centro + device)
     centro_id = p.get("centro_id")
     device_id = p.get("device_id")  # puede venir mal, pero lo guardamos como source_device_id
 
-    print("DEBUG centro_id/device_id =>", centro_id, device_id)
-
     if not centro_id:
-        return jsonify({"ok": False, "error": "Falta centro_id"}), 400
+        return None, "Falta centro_id"
 
     try:
         estado_reporte = parse_report_state(p.get("estado_reporte", p.get("estado")))
     except ValueError as exc:
-        return jsonify({"ok": False, "error": str(exc)}), 400
+        return None, str(exc)
+
+    # Guardado incremental: el cliente envía solo el delta (JSON Patch) contra
+    # la versión que tiene cargada.
+    estado_patch = p.get("estado_reporte_patch")
+    base_version = p.get("base_version")
+    if estado_patch not in (None, ""):
+        if estado_reporte is not None:
+            return None, "Envía estado_reporte o estado_reporte_patch, no ambos"
+        try:
+            estado_patch = state_versions.validate_patch(estado_patch)
+            base_version = int(base_version)
+        except (TypeError, ValueError) as exc:
+            return None, str(exc) if isinstance(exc, state_versions.PatchError) else "base_version es requerido con estado_reporte_patch"
+    else:
+        estado_patch = None
 
     # payload a difundir
     data = {
@@ -198,90 +546,640 @@ def push_feed():
     if adjuntos:
         data["adjuntos"] = adjuntos
 
-    # 🔥 DIFUSIÓN A TODOS LOS DISPOSITIVOS REGISTRADOS DEL ECOSISTEMA
+    # El estado estructurado se guarda una sola vez, separado del feed que
+    # consume la aplicación local. De este modo los clientes anteriores
+    # siguen funcionando y Bubble puede restaurar el estudio por codigo_unico.
+    estado = None
+    if estado_reporte is not None or estado_patch is not None:
+        estado = {
+            "codigo_unico": cu,
+            "email_usuario": email,
+            "centro_id": centro_id,
+            "modalidad": p.get("modalidad", ""),
+            "estudio": p.get("estudio", ""),
+            "estado_reporte": estado_reporte,
+            "updatedAt": data["updatedAt"],
+            "adjuntos": adjuntos,
+        }
+    report = {"centro_id": centro_id, "codigo_unico": cu, "data": data, "estado": estado}
+    if estado_patch is not None:
+        report["estado_patch"] = estado_patch
+        report["base_version"] = base_version
+    return report, None
+
+def fetch_head(report):
+    """State head a report will be diffed against (None when it has no state)."""
+    if report["estado"] is None:
+        return None
+    return current_report_state(report["centro_id"], report["codigo_unico"])
+
+def plan_report(report, dispositivos, head, feed_config):
+    """Compute the multi-path updates for one report.
+
+    Returns (error, plan): error is a (status, body) tuple when the report
+    cannot be written; plan holds the updates relative to /ecosistemas/{centro}.
+    """
+    centro_id = report["centro_id"]
+    cu = report["codigo_unico"]
+    data = report["data"]
+
+    updates = {}
+    new_head = None
+    base_version = head.get("version") if isinstance(head, dict) and isinstance(head.get("version"), int) else None
+    if report["estado"] is not None:
+        estado_reporte = report["estado"]["estado_reporte"]
+        if "estado_patch" in report:
+            head_version = head.get("version") if isinstance(head, dict) else None
+            if head_version != report["base_version"] or not isinstance(head.get("estado_reporte"), dict):
+                return (409, {
+                    "ok": False,
+                    "error": "La versión base no coincide; envía el estado_reporte completo",
+                    "version": head_version,
+                }), None
+            try:
+                estado_reporte = state_versions.apply_patch(head["estado_reporte"], report["estado_patch"])
+            except (state_versions.PatchError, IndexError, ValueError) as exc:
+                return (400, {"ok": False, "error": f"estado_reporte_patch no aplicable: {exc}"}), None
+        state_updates, new_head = state_versions.plan_state_write(
+            centro_id, report_state_key(centro_id, cu), head, report["estado"], estado_reporte
+        )
+        updates.update(state_updates)
+        updates[f"estados_reportes_meta/{report_state_key(centro_id, cu)}"] = report_meta(new_head)
+        updates[state_versions.lock_key(report_state_key(centro_id, cu))] = {"version": new_head["version"]}
+
+    # Modo "dispositivo": una copia por equipo. Modo "centro": una sola
+    # entrada en feed_centro (más las copias de los equipos legacy).
+    key = generate_push_id(data["updatedAt"])
+    feed_writes = centro_feed.plan_feed_writes(feed_config, dispositivos, key, data)
+    updates.update(feed_writes)
+    pushed = {dev_id: key for dev_id in dispositivos}
+    return None, {"report": report, "updates": updates, "pushed": pushed,
+                  "feed_entries": len(feed_writes), "new_head": new_head, "base_version": base_version}
+
+def claim_plan(plan):
+    """Reserve the state version a plan writes; None when it writes no state."""
+    if plan["new_head"] is None:
+        return None
+    report = plan["report"]
+    return state_versions.claim_version(
+        report["centro_id"], report_state_key(report["centro_id"], report["codigo_unico"]), plan["base_version"],
+    )
+
+def release_plan(plan, claim):
+    """Give back the reservation of a plan whose update failed."""
+    if claim is None:
+        return
+    report = plan["report"]
     try:
-        dispositivos_ref = db.reference(f"/ecosistemas/{centro_id}/dispositivos")
-        dispositivos = dispositivos_ref.get() or {}
-
-        if not isinstance(dispositivos, dict) or len(dispositivos) == 0:
-            return jsonify({
-                "ok": False,
-                "error": f"No hay dispositivos registrados para centro_id={centro_id}"
-            }), 400
-
-        # El estado estructurado se guarda una sola vez, separado del feed que
-        # consume la aplicación local. De este modo los clientes anteriores
-        # siguen funcionando y Bubble puede restaurar el estudio por codigo_unico.
-        estado_guardado = False
-        if estado_reporte is not None:
-            report_state_ref(centro_id, cu).set({
-                "codigo_unico": cu,
-                "email_usuario": email,
-                "centro_id": centro_id,
-                "modalidad": p.get("modalidad", ""),
-                "estudio": p.get("estudio", ""),
-                "estado_reporte": estado_reporte,
-                "updatedAt": data["updatedAt"],
-                "adjuntos": adjuntos,
-            })
-            estado_guardado = True
-
-        pushed = {}
-        for dev_id in dispositivos.keys():
-            path = f"/ecosistemas/{centro_id}/dispositivos/{dev_id}/feed_estudios"
-            key = db.reference(path).push(data).key
-            pushed[dev_id] = key
+        state_versions.release_claim(
+            report["centro_id"], report_state_key(report["centro_id"], report["codigo_unico"]), claim,
+        )
+    except Exception as exc:
+        # Sin liberar, la reserva vence sola tras STATE_CLAIM_TTL.
+        print(f"[estado] no se pudo liberar la reserva de {report['codigo_unico']}: {exc}")
+
+def finish_report(plan):
+    """Post-write bookkeeping for a committed plan; returns the response body."""
+    report, new_head = plan["report"], plan["new_head"]
+    centro_id, cu = report["centro_id"], report["codigo_unico"]
+    metrics.observe_fanout(len(plan["pushed"]), plan["feed_entries"])
+    if plan["pushed"]:
+        feed_sync.notifier.notify(centro_id)
+    if new_head is not None:
+        # Write-through: el próximo guardado calcula su delta sin releer RTDB.
+        cache.put(state_cache_key(centro_id, cu), new_head)
+        cache.put(meta_cache_key(centro_id, cu), report_meta(new_head))
+        state_versions.schedule_compaction(
+            centro_id, report_state_key(centro_id, cu), new_head,
+            on_done=lambda: cache.invalidate(state_cache_key(centro_id, cu)),
+        )
+
+    if save_coalescer is not None:
+        # Todo camino de escritura (individual, lote, cola o flush) deja su
+        # hash: así un autoguardado igual a lo último escrito se omite.
+        save_coalescer.record(
+            report_state_key(centro_id, cu), coalescer.content_digest(report),
+            new_head["version"] if new_head is not None else None,
+        )
+
+    body = {
+        "ok": True,
+        "pushed": plan["pushed"],
+        "estado_guardado": new_head is not None,
+    }
+    if new_head is not None:
+        body["version"] = new_head["version"]
+    return body
+
+def no_devices_error(centro_id):
+    return 400, {
+        "ok": False,
+        "error": f"No hay dispositivos registrados para centro_id={centro_id}"
+    }
+
+def persist_report(report):
+    """Fan a validated report out to every device; returns (status, body).
+
+    Raises state_versions.VersionConflict when other saves of the same
+    state keep winning the next version after STATE_WRITE_ATTEMPTS tries.
+    """
+    centro_id = report["centro_id"]
+
+    for attempt in range(max(1, STATE_WRITE_ATTEMPTS)):
+        # 🔥 DIFUSIÓN A TODOS LOS DISPOSITIVOS REGISTRADOS DEL ECOSISTEMA
+        # La búsqueda de dispositivos, la lectura del estado previo y la del modo
+        # de feed del centro son independientes: se lanzan a la vez.
+        dispositivos, head, feed_config = fio.gather(
+            fio.submit(list_devices, centro_id),
+            fio.submit(fetch_head, report),
+            fio.submit(centro_feed.feed_config, centro_id),
+        )
+        if not dispositivos:
+            return no_devices_error(centro_id)
+
+        error, plan = plan_report(report, dispositivos, head, feed_config)
+        if error:
+            return error
+        # El delta solo vale sobre la versión con la que se calculó: se reserva
+        # la siguiente y, si otro guardado la ganó, se relee el head y se replanea.
+        try:
+            claim = claim_plan(plan)
+        except state_versions.VersionConflict:
+            if attempt + 1 >= max(1, STATE_WRITE_ATTEMPTS):
+                raise
+            time.sleep(STATE_RETRY_DELAY * 2 ** attempt)
+            continue
+
+        # Un único update multi-ruta: el estado y el feed (copia por dispositivo o
+        # entrada única del centro) se escriben de forma atómica en una sola petición.
+        try:
+            fio.update(f"/ecosistemas/{centro_id}", plan["updates"])
+        except Exception:
+            release_plan(plan, claim)
+            raise
+        return 200, finish_report(plan)
+
+def persist_batch(reports):
+    """Persist many validated reports with one device lookup and one combined
+    update per centro. Returns (200, body) with a result per input position;
+    entries that are None in `reports` are skipped (already answered).
+    """
+    outcomes = {}
+    by_centro = {}
+    for index, report in enumerate(reports):
+        if report is not None:
+            by_centro.setdefault(report["centro_id"], []).append(index)
+
+    # Búsquedas de dispositivos de todos los centros en paralelo.
+    lookups = {
+        centro_id: (fio.submit(list_devices, centro_id), fio.submit(centro_feed.feed_config, centro_id))
+        for centro_id in by_centro
+    }
+    devices, configs = {}, {}
+    for centro_id, futures in lookups.items():
+        try:
+            devices[centro_id], configs[centro_id] = fio.gather(*futures)
+        except Exception as exc:
+            devices[centro_id] = None
+            for index in by_centro[centro_id]:
+                outcomes[index] = (500, {"ok": False, "error": str(exc)})
+            continue
+        if not devices[centro_id]:
+            for index in by_centro[centro_id]:
+                outcomes[index] = no_devices_error(centro_id)
+
+    # Rondas con a lo sumo un reporte por (centro, codigo_unico): dos versiones
+    # del mismo estado no pueden ir en el mismo update (rutas superpuestas).
+    rounds = []
+    for centro_id, indexes in by_centro.items():
+        if not devices.get(centro_id):
+            continue
+        for index in indexes:
+            key = (centro_id, reports[index]["codigo_unico"])
+            for batch in rounds:
+                if key not in batch:
+                    batch[key] = index
+                    break
+            else:
+                rounds.append({key: index})
+
+    for batch in rounds:
+        indexes = list(batch.values())
+        heads = [fio.submit(fetch_head, reports[index]) for index in indexes]
+        plans = {}
+        for index, head_future in zip(indexes, heads):
+            report = reports[index]
+            try:
+                error, plan = plan_report(
+                    report, devices[report["centro_id"]], fio.wait(head_future), configs[report["centro_id"]]
+                )
+            except Exception as exc:
+                error, plan = (500, {"ok": False, "error": str(exc)}), None
+            if error:
+                outcomes[index] = error
+                continue
+            plans[index] = plan
+
+        # Reserva de versiones; un reporte que pierde la suya se reintenta solo.
+        claim_futures = {index: fio.submit(claim_plan, plan) for index, plan in plans.items()}
+        claims, contested = {}, []
+        for index, future in claim_futures.items():
+            try:
+                claims[index] = fio.wait(future)
+            except state_versions.VersionConflict:
+                contested.append(index)
+                del plans[index]
+            except Exception as exc:
+                outcomes[index] = (500, {"ok": False, "error": str(exc)})
+                del plans[index]
+        updates = {}
+        for plan in plans.values():
+            updates.setdefault(plan["report"]["centro_id"], {}).update(plan["updates"])
+
+        # Un update por centro; los centros no comparten rutas y van en paralelo.
+        writes = {
+            centro_id: fio.submit(fio.update, f"/ecosistemas/{centro_id}", centro_updates)
+            for centro_id, centro_updates in updates.items()
+        }
+        failed = {}
+        for centro_id, future in writes.items():
+            try:
+                fio.wait(future)
+            except Exception as exc:
+                failed[centro_id] = str(exc)
+        for index, plan in plans.items():
+            centro_id = reports[index]["centro_id"]
+            if centro_id in failed:
+                release_plan(plan, claims[index])
+                outcomes[index] = (500, {"ok": False, "error": failed[centro_id]})
+            else:
+                outcomes[index] = (200, finish_report(plan))
+        for index in contested:
+            try:
+                outcomes[index] = persist_report(reports[index])
+            except state_versions.VersionConflict as exc:
+                outcomes[index] = (409, {"ok": False, "error": f"{exc}; reintenta"})
+            except Exception as exc:
+                outcomes[index] = (500, {"ok": False, "error": str(exc)})
+
+    results = [
+        {"index": index, "status": outcomes[index][0], **outcomes[index][1]} if index in outcomes else None
+        for index in range(len(reports))
+    ]
+    return 200, {"ok": True, "results": results}
+
+@app.post("/push_feed")
+def push_feed():
+    # Auth
+    if not check_auth(request):
+        return jsonify({"ok": False, "error": "Unauthorized"}), 401
 
+    # JSON body
+    try:
+        p = request.get_json(force=True) or {}
+    except Exception:
+        return jsonify({"ok": False, "error": "JSON inválido"}), 400
+
+    # normalizar llaves a lower (compat Bubble)
+    report, error = build_report(normalize_payload(p))
+    if error:
+        return jsonify({"ok": False, "error": error}), 400
+
+    # Los autoguardados retenidos u omitidos no escriben ahora: no pasan por
+    # admisión. Su flush posterior va acotado por el hilo del coalescer.
+    if save_coalescer is not None and coalescer.is_autosave(report):
+        key = report_state_key(report["centro_id"], report["codigo_unico"])
+        outcome, flush_in = save_coalescer.submit(key, report, coalescer.content_digest(report))
+        metrics.AUTOSAVES.labels(outcome).inc()
+        if outcome == "skipped":
+            return jsonify(UNCHANGED_SAVE), 200
+        return jsonify({"ok": True, "coalesced": True, "flush_in_ms": int(flush_in * 1000)}), 202
+
+    rejected = admit_write([report["centro_id"]])
+    if rejected:
+        return rejected
+
+    if save_coalescer is not None:
+        key = report_state_key(report["centro_id"], report["codigo_unico"])
+        digest = coalescer.content_digest(report)
+        # Guardado final o parche: se escribe ya. Lo pendiente queda superado,
+        # porque este guardado trae el estado completo (o su diff) del cliente.
+        pending = save_coalescer.take(key, report, digest)
+        if pending == "skipped":
+            metrics.AUTOSAVES.labels("skipped").inc()
+            return jsonify(UNCHANGED_SAVE), 200
+        if pending == "handed_off":
+            # Otro worker está escribiendo este reporte: el flusher lo escribe
+            # justo después en vez de dejar la petición esperando.
+            metrics.AUTOSAVES.labels("handed_off").inc()
+            return jsonify({"ok": True, "coalesced": True, "flush_in_ms": 0}), 202
+        if pending is not None:
+            metrics.AUTOSAVES.labels("superseded").inc()
+
+    if ASYNC_WRITES:
+        # Modo asíncrono: el payload validado queda en la cola durable y los
+        # workers lo escriben en Firebase; la respuesta no espera a RTDB.
+        try:
+            job_id = write_queue.enqueue("push_feed", report, keys=report_keys([report]))
+        except Exception as exc:
+            return jsonify({"ok": False, "error": str(exc)}), 500
         return jsonify({
             "ok": True,
-            "pushed": pushed,
-            "estado_guardado": estado_guardado,
-        }), 200
+            "queued": True,
+            "job_id": job_id,
+            "status_url": f"/push_feed/jobs/{job_id}",
+        }), 202
 
+    try:
+        status, body = persist_report(report)
+        return jsonify(body), status
+    except state_versions.VersionConflict as exc:
+        return jsonify({"ok": False, "error": f"{exc}; reintenta"}), 409
     except Exception as e:
         return jsonify({"ok": False, "error": str(e)}), 500
 
+@app.post("/push_feed_batch")
+def push_feed_batch():
+    """Ingest many reports: one device lookup and one write per centro."""
+    if not check_auth(request):
+        return jsonify({"ok": False, "error": "Unauthorized"}), 401
+    try:
+        payload = request.get_json(force=True)
+    except Exception:
+        return jsonify({"ok": False, "error": "JSON inválido"}), 400
+
+    items = payload if isinstance(payload, list) else normalize_payload(payload).get("reportes")
+    if not isinstance(items, list) or not items:
+        return jsonify({"ok": False, "error": "Se requiere una lista de reportes"}), 400
+    if len(items) > BATCH_MAX_ITEMS:
+        return jsonify({"ok": False, "error": f"Máximo {BATCH_MAX_ITEMS} reportes por lote"}), 413
+
+    # Validación por elemento: un reporte inválido no invalida el lote.
+    reports, results = [], [None] * len(items)
+    for index, item in enumerate(items):
+        report, error = build_report(normalize_payload(item)) if isinstance(item, dict) else (None, "El reporte debe ser un objeto JSON")
+        reports.append(report)
+        if error:
+            results[index] = {"index": index, "status": 400, "ok": False, "error": error}
+    if any(reports):
+        rejected = admit_write([report["centro_id"] for report in reports if report is not None])
+        if rejected:
+            return rejected
+    # El lote trae lo más nuevo de cada reporte: lo pendiente en el coalescer
+    # queda superado y no debe escribirse después.
+    for index in supersede_autosaves(reports):
+        reports[index] = None
+        results[index] = {"index": index, "status": 202, "ok": True, "coalesced": True}
+
+    if ASYNC_WRITES and any(reports):
+        try:
+            job_id = write_queue.enqueue("push_feed_batch", reports, keys=report_keys(reports))
+        except Exception as exc:
+            return jsonify({"ok": False, "error": str(exc)}), 500
+        for index, report in enumerate(reports):
+            if report is not None:
+                results[index] = {"index": index, "status": 202, "ok": True, "queued": True}
+        return jsonify({
+            "ok": True,
+            "queued": True,
+            "job_id": job_id,
+            "status_url": f"/push_feed/jobs/{job_id}",
+            "results": results,
+        }), 202
+
+    _, body = persist_batch(reports)
+    for index, result in enumerate(body["results"]):
+        if result is not None:
+            results[index] = result
+    return jsonify({
+        "ok": True,
+        "guardados": sum(1 for result in results if result["status"] == 200),
+        "fallidos": sum(1 for result in results if not result["ok"]),
+        "results": results,
+    }), 200
+
+@app.get("/push_feed/jobs/<job_id>")
+def push_feed_job(job_id):
+    if not check_auth(request):
+        return jsonify({"ok": False, "error": "Unauthorized"}), 401
+    job = write_queue.status(job_id)
+    if job is None:
+        return jsonify({"ok": False, "error": "Trabajo no encontrado"}), 404
+    return jsonify({"ok": True, **job}), 200
+
+@app.get("/feed_sync")
+def feed_sync_endpoint():
+    """Feed entries of one device after a cursor: paged JSON, long-poll or SSE."""
+    if not check_auth(request):
+        return jsonify({"ok": False, "error": "Unauthorized"}), 401
+    p = normalize_payload(request.args.to_dict())
+    centro_id = str(p.get("centro_id") or "").strip()
+    device_id = str(p.get("device_id") or "").strip()
+    if not centro_id or not device_id:
+        return jsonify({"ok": False, "error": "Faltan centro_id o device_id"}), 400
+    if RTDB_FORBIDDEN.search(centro_id) or RTDB_FORBIDDEN.search(device_id):
+        return jsonify({"ok": False, "error": "centro_id o device_id inválido"}), 400
+    try:
+        # Last-Event-ID: reconexión automática de EventSource.
+        raw_cursor = p.get("cursor") or request.headers.get("Last-Event-ID")
+        limit = min(max(1, int(p.get("limit") or feed_sync.FEED_SYNC_PAGE_SIZE)), feed_sync.FEED_SYNC_MAX_PAGE)
+        wait = min(max(0.0, float(p.get("wait") or 0)), feed_sync.FEED_SYNC_MAX_WAIT)
+    except ValueError as exc:
+        return jsonify({"ok": False, "error": str(exc)}), 400
+    if not device_registered(centro_id, device_id):
+        return jsonify({"ok": False, "error": "Dispositivo no registrado en el centro"}), 404
+    # En modo centro, sin cursor explícito se continúa desde el que guardó el equipo.
+    if not raw_cursor and centro_feed.reads_centro_feed(centro_id, device_id):
+        raw_cursor = centro_feed.stored_cursor(centro_id, device_id)
+    try:
+        cursor = feed_sync.Cursor(raw_cursor)
+    except ValueError as exc:
+        return jsonify({"ok": False, "error": str(exc)}), 400
+
+    sse = p.get("mode") == "sse" or request.accept_mimetypes.best == "text/event-stream"
+    if (sse or wait > 0) and not feed_sync.stream_slots.acquire():
+        retry_after = str(feed_sync.FEED_SYNC_RETRY_AFTER)
+        response = jsonify({
+            "ok": False,
+            "error": f"Demasiadas conexiones de sincronización abiertas; reintenta en {retry_after} s",
+            "retry_after": retry_after,
+        })
+        response.headers["Retry-After"] = retry_after
+        return response, 503
+    if sse:
+        response = Response(
+            stream_with_context(feed_sync.stream_events(centro_id, device_id, cursor, limit)),
+            mimetype="text/event-stream",
+            headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+        )
+        # close() llega aunque el generador no haya arrancado (cliente que se va).
+        response.call_on_close(feed_sync.stream_slots.release)
+        return response
+
+    try:
+        items, next_cursor, has_more = feed_sync.wait_for_page(centro_id, device_id, cursor, limit, wait)
+    finally:
+        if wait > 0:
+            feed_sync.stream_slots.release()
+    return jsonify({"ok": True, "items": items, "next_cursor": next_cursor, "has_more": has_more}), 200
+
+@app.post("/feed_sync/cursor")
+def feed_sync_cursor():
+    """Store the last feed entry a device has applied (centro feed mode)."""
+    if not check_auth(request):
+        return jsonify({"ok": False, "error": "Unauthorized"}), 401
+    try:
+        p = normalize_payload(request.get_json(force=True) or {})
+    except Exception:
+        return jsonify({"ok": False, "error": "JSON inválido"}), 400
+    centro_id = str(p.get("centro_id") or "").strip()
+    device_id = str(p.get("device_id") or "").strip()
+    cursor = str(p.get("cursor") or "").strip()
+    if not centro_id or not device_id or not cursor:
+        return jsonify({"ok": False, "error": "Faltan centro_id, device_id o cursor"}), 400
+    if RTDB_FORBIDDEN.search(centro_id) or RTDB_FORBIDDEN.search(device_id):
+        return jsonify({"ok": False, "error": "centro_id o device_id inválido"}), 400
+    if not feed_sync.PUSH_ID_RE.match(cursor):
+        return jsonify({"ok": False, "error": "cursor debe ser la llave (push ID) de una entrada del feed"}), 400
+    if not device_registered(centro_id, device_id):
+        return jsonify({"ok": False, "error": "Dispositivo no registrado en el centro"}), 404
+    try:
+        centro_feed.store_cursor(centro_id, device_id, cursor)
+    except Exception as exc:
+        return jsonify({"ok": False, "error": str(exc)}), 500
+    return jsonify({"ok": True, "cursor": cursor}), 200
+
+@app.post("/registrar_dispositivo")
+def registrar_dispositivo():
+    """Register a device so the next reports of its centro are fanned out to it."""
+    if not check_auth(request):
+        return jsonify({"ok": False, "error": "Unauthorized"}), 401
+    try:
+        p = normalize_payload(request.get_json(force=True) or {})
+    except Exception:
+        return jsonify({"ok": False, "error": "JSON inválido"}), 400
+    centro_id = str(p.get("centro_id") or "").strip()
+    device_id = str(p.get("device_id") or "").strip()
+    if not centro_id or not device_id:
+        return jsonify({"ok": False, "error": "Faltan centro_id o device_id"}), 400
+    if RTDB_FORBIDDEN.search(centro_id) or RTDB_FORBIDDEN.search(device_id):
+        return jsonify({"ok": False, "error": "centro_id o device_id inválido"}), 400
+
+    registered_at = int(time.time() * 1000)
+    try:
+        # El índice dispara el listener de los demás workers (DEVICE_INDEX_LISTEN).
+        fio.update(f"/ecosistemas/{centro_id}", {
+            f"dispositivos/{device_id}/registradoEn": registered_at,
+            f"dispositivos_index/{device_id}": registered_at,
+        })
+    except Exception as exc:
+        return jsonify({"ok": False, "error": str(exc)}), 500
+    invalidate_devices(centro_id)
+    centro_feed.schedule_backfill(centro_id, device_id, registered_at, DEVICE_BACKFILL_DELAY)
+    return jsonify({"ok": True, "device_id": device_id, "registradoEn": registered_at}), 200
+
 @app.post("/subir_esquema_prostata")
 def subir_esquema_prostata():
     if not check_auth(request):
         return jsonify({"ok": False, "error": "Unauthorized"}), 401
 
+    # Rechazo temprano por Content-Length, antes de parsear el multipart.
+    if request.content_length and request.content_length > MAX_ATTACHMENT_BYTES + UPLOAD_CHUNK_BYTES:
+        return jsonify({"ok": False, "error": "El esquema prostático excede el tamaño permitido"}), 413
+
     codigo_unico = str(request.form.get("codigo_unico") or "").strip()
     centro_id = str(request.form.get("centro_id") or "").strip()
     email = str(request.form.get("email_usuario") or "").strip()
     archivo = request.files.get("archivo")
     if not codigo_unico or not centro_id or not email or archivo is None:
         return jsonify({"ok": False, "error": "Faltan datos requeridos o el archivo PNG"}), 400
+    rejected = admit_write([centro_id])
+    if rejected:
+        return rejected
 
-    contenido = archivo.read(MAX_ATTACHMENT_BYTES + 1)
-    if not contenido or len(contenido) > MAX_ATTACHMENT_BYTES:
+    # Lectura por bloques: tamaño y firma PNG se validan con el primer bloque,
+    # el sha256 se calcula incrementalmente y los bytes van directo al almacén.
+    chunk = archivo.stream.read(UPLOAD_CHUNK_BYTES)
+    if not chunk:
         return jsonify({"ok": False, "error": "El esquema prostático excede el tamaño permitido"}), 413
-    if archivo.mimetype != "image/png" or not contenido.startswith(b"\x89PNG\r\n\x1a\n"):
+    if archivo.mimetype != "image/png" or not chunk.startswith(PNG_SIGNATURE):
         return jsonify({"ok": False, "error": "El archivo debe ser una imagen PNG válida"}), 400
 
     updated_at = int(time.time() * 1000)
-    digest = hashlib.sha256(contenido).hexdigest()
-    database_path = attachment_database_path(centro_id, codigo_unico)
+    hasher = hashlib.sha256()
     try:
+        with get_blob_store().stage() as staged:
+            while chunk:
+                if staged.size + len(chunk) > MAX_ATTACHMENT_BYTES:
+                    return jsonify({"ok": False, "error": "El esquema prostático excede el tamaño permitido"}), 413
+                hasher.update(chunk)
+                staged.write(chunk)
+                chunk = archivo.stream.read(UPLOAD_CHUNK_BYTES)
+            size_bytes = staged.size
+            digest = hasher.hexdigest()
+            # Subidas idénticas se deduplican; en RTDB solo queda el registro
+            # de metadatos.
+            staged.commit(digest)
+        metrics.ATTACHMENT_BYTES.labels("esquema_prostata").observe(size_bytes)
         adjunto = {
             "tipo": "esquema_prostata",
-            "storage_path": f"rtdb:{database_path}",
+            "storage_path": storage_path_for(digest),
             "mime_type": "image/png",
-            "size_bytes": len(contenido),
+            "size_bytes": size_bytes,
             "sha256": digest,
             "updatedAt": updated_at,
+            "download_endpoint": "/descargar_adjunto_reporte",
         }
-        attachment_ref(centro_id, codigo_unico).set({
+        fio.set(attachment_database_path(centro_id, codigo_unico), {
             **adjunto,
             "codigo_unico": codigo_unico,
             "centro_id": centro_id,
             "email_usuario": email,
-            "content_base64": base64.b64encode(contenido).decode("ascii"),
         })
+        cache.invalidate(attachment_cache_key(centro_id, codigo_unico))
+        # La recompresión sin pérdida corre en segundo plano; la respuesta
+        # lleva el original y el registro se actualiza si el PNG se reduce.
+        png_optimize.schedule_optimization(
+            get_blob_store(), digest,
+            lambda new_digest, original_size, optimized_size, details: apply_optimized_attachment(
+                centro_id, codigo_unico, digest, new_digest, original_size, optimized_size, details,
+            ),
+        )
         return jsonify({"ok": True, "adjunto": adjunto}), 201
     except Exception as exc:
         return jsonify({"ok": False, "error": str(exc)}), 500
 
+class AttachmentReplaced(Exception):
+    pass
+
+def apply_optimized_attachment(centro_id, codigo_unico, digest, new_digest, original_size, optimized_size, details):
+    """Point the attachment record at its optimized blob, keeping the original's hash and size."""
+    path = attachment_database_path(centro_id, codigo_unico)
+
+    def swap(current):
+        # Otra subida reemplazó el adjunto mientras se optimizaba: no se pisa.
+        # Dentro de la transacción, así una subida entre la lectura y la
+        # escritura también aborta el cambio.
+        if not isinstance(current, dict) or current.get("sha256") != digest:
+            raise AttachmentReplaced()
+        return {
+            **current,
+            "storage_path": storage_path_for(new_digest),
+            "sha256": new_digest,
+            "size_bytes": optimized_size,
+            "original_sha256": digest,
+            "original_size_bytes": original_size,
+            "optimizacion": details,
+        }
+
+    try:
+        fio.transaction(path, swap)
+    except AttachmentReplaced:
+        return False
+    cache.invalidate(attachment_cache_key(centro_id, codigo_unico))
+    metrics.ATTACHMENT_BYTES.labels("esquema_prostata_optimizado").observe(optimized_size)
+    return True
+
 @app.post("/obtener_adjunto_reporte")
 def obtener_adjunto_reporte():
     if not check_auth(request):
@@ -299,14 +1197,18 @@ def obtener_adjunto_reporte():
         return jsonify({"ok": False, "error": "Faltan datos para recuperar el adjunto"}), 400
 
     try:
-        saved = attachment_ref(centro_id, codigo_unico, tipo).get()
-        if not isinstance(saved, dict):
-            return jsonify({"ok": False, "error": "Adjunto no encontrado"}), 404
-        if not hmac.compare_digest(str(saved.get("codigo_unico") or ""), codigo_unico) or not hmac.compare_digest(str(saved.get("email_usuario") or ""), email):
+        saved = find_attachment(centro_id, codigo_unico, email, tipo)
+        if saved is None:
             return jsonify({"ok": False, "error": "Adjunto no encontrado"}), 404
         content_base64 = str(saved.get("content_base64") or "")
         if not content_base64:
-            return jsonify({"ok": False, "error": "Adjunto no encontrado"}), 404
+            # Registros nuevos: el contenido vive en el blob store. Los antiguos
+            # con content_base64 se siguen sirviendo hasta migrarlos.
+            digest = digest_from_storage_path(saved.get("storage_path"))
+            contenido = get_blob_store().read(digest) if digest else None
+            if contenido is None:
+                return jsonify({"ok": False, "error": "Adjunto no encontrado"}), 404
+            content_base64 = base64.b64encode(contenido).decode("ascii")
         return jsonify({
             "ok": True,
             "tipo": tipo,
@@ -317,6 +1219,52 @@ def obtener_adjunto_reporte():
     except Exception as exc:
         return jsonify({"ok": False, "error": str(exc)}), 500
 
+@app.get("/descargar_adjunto_reporte")
+@app.post("/descargar_adjunto_reporte")
+def descargar_adjunto_reporte():
+    """Stream the attachment as raw image/png with ETag, Range and 304 support."""
+    if not check_auth(request):
+        return jsonify({"ok": False, "error": "Unauthorized"}), 401
+    if request.method == "GET":
+        p = normalize_payload(request.args.to_dict())
+    else:
+        try:
+            p = normalize_payload(request.get_json(force=True) or {})
+        except Exception:
+            return jsonify({"ok": False, "error": "JSON inválido"}), 400
+
+    codigo_unico = str(p.get("codigo_unico") or "").strip()
+    centro_id = str(p.get("centro_id") or "").strip()
+    email = str(p.get("email_usuario") or "").strip()
+    tipo = str(p.get("tipo") or "esquema_prostata").strip()
+    if not codigo_unico or not centro_id or not email or tipo != "esquema_prostata":
+        return jsonify({"ok": False, "error": "Faltan datos para recuperar el adjunto"}), 400
+
+    try:
+        saved = find_attachment(centro_id, codigo_unico, email, tipo)
+        source, digest = open_attachment_content(saved) if saved is not None else (None, None)
+        if source is None:
+            return jsonify({"ok": False, "error": "Adjunto no encontrado"}), 404
+        # send_file con conditional=True resuelve If-None-Match (304) y Range (206).
+        response = send_file(
+            source,
+            mimetype=saved.get("mime_type", "image/png"),
+            conditional=True,
+            etag=digest,
+            last_modified=(saved.get("updatedAt") or 0) / 1000 or None,
+            download_name=f"{tipo}.png",
+        )
+        response.cache_control.public = False
+        response.cache_control.private = True
+        if ATTACHMENT_CACHE_MAX_AGE > 0:
+            response.cache_control.max_age = ATTACHMENT_CACHE_MAX_AGE
+        else:
+            response.cache_control.no_cache = True
+        response.vary.add("Authorization")
+        return response
+    except Exception as exc:
+        return jsonify({"ok": False, "error": str(exc)}), 500
+
 @app.post("/guardar-reporte")
 def guardar_reporte():
     """Compatibility endpoint formerly served by motor-guardar-reportes."""
@@ -349,7 +1297,7 @@ def recuperar_estado_reporte():
         }), 400
 
     try:
-        saved = report_state_ref(centro_id, cu).get()
+        saved = load_report_state(centro_id, cu)
         if not isinstance(saved, dict):
             return jsonify({"ok": False, "error": "Estado no encontrado"}), 404
 
@@ -360,6 +1308,19 @@ def recuperar_estado_reporte():
             return jsonify({"ok": False, "error": "Estado no encontrado"}), 404
 
         estado = saved.get("estado_reporte")
+        version = saved.get("version")
+        requested = p.get("version")
+        if requested not in (None, "") and requested != version:
+            # Versión anterior: se reconstruye desde el snapshot más cercano.
+            try:
+                requested = int(requested)
+            except (TypeError, ValueError):
+                return jsonify({"ok": False, "error": "version inválida"}), 400
+            if not isinstance(version, int) or not 0 < requested <= version:
+                return jsonify({"ok": False, "error": "Versión no encontrada"}), 404
+            if requested != version:
+                estado = state_versions.rebuild_version(centro_id, report_state_key(centro_id, cu), requested)
+                version = requested
         if not isinstance(estado, dict):
             return jsonify({"ok": False, "error": "Estado no encontrado"}), 404
 
@@ -368,10 +1329,129 @@ def recuperar_estado_reporte():
             "codigo_unico": cu,
             "estado_reporte": estado,
             "updatedAt": saved.get("updatedAt"),
+            "version": version,
         }), 200
     except Exception as exc:
         return jsonify({"ok": False, "error": str(exc)}), 500
 
-# 6) Local dev
+# Cola durable de escrituras (modo ASYNC_WRITES): se reanuda al reiniciar.
+write_queue = WriteQueue(handlers={"push_feed": persist_report, "push_feed_batch": persist_batch})
+
+def flush_autosave(report):
+    """Write the latest coalesced autosave of a report.
+
+    With ASYNC_WRITES it goes through the write queue like any other save,
+    so it keeps its place behind queued saves of the same report.
+    """
+    metrics.AUTOSAVES.labels("flushed").inc()
+    if ASYNC_WRITES:
+        job_id = write_queue.enqueue("push_feed", report, keys=report_keys([report]))
+        return 202, {"ok": True, "queued": True, "job_id": job_id}
+    return persist_report(report)
+
+def supersede_autosaves(reports):
+    """Drop the pending autosaves of reports about to be written by a newer save.
+
+    Returns the indexes handed to the coalescer instead (a flush of the same
+    report was still running); the caller must not write those.
+    """
+    if save_coalescer is None:
+        return []
+    handed_off, seen = [], set()
+    # El último del lote por reporte es el que gana: se recorre al revés.
+    for index in reversed(range(len(reports))):
+        report = reports[index]
+        if report is None:
+            continue
+        key = report_state_key(report["centro_id"], report["codigo_unico"])
+        if key in seen:
+            continue
+        seen.add(key)
+        pending = save_coalescer.take(key, report)
+        if pending == "handed_off":
+            metrics.AUTOSAVES.labels("handed_off").inc()
+            handed_off.append(index)
+        elif pending is not None:
+            metrics.AUTOSAVES.labels("superseded").inc()
+    return handed_off
+
+# Autoguardados de Bubble: solo el último de cada ventana llega a Firebase (ver coalescer.py).
+save_coalescer = coalescer.SaveCoalescer(flush_autosave) if coalescer.COALESCE_AUTOSAVES else None
+UNCHANGED_SAVE = {"ok": True, "skipped": True, "pushed": {}}
+
+def restore_entry(centro_id, codigo_unico, email, metadata_only):
+    """Owner-checked restore result for one study of a worklist."""
+    saved = (load_report_meta if metadata_only else load_report_state)(centro_id, codigo_unico)
+    if not isinstance(saved, dict):
+        return {"existe": False}
+    if not hmac.compare_digest(str(saved.get("email_usuario") or ""), email) or not hmac.compare_digest(str(saved.get("codigo_unico") or ""), codigo_unico):
+        # Igual que en la restauración individual: no revelar estados ajenos.
+        return {"existe": False}
+    entry = {"existe": True, "updatedAt": saved.get("updatedAt"), "version": saved.get("version")}
+    if not metadata_only:
+        if not isinstance(saved.get("estado_reporte"), dict):
+            return {"existe": False}
+        entry["estado_reporte"] = saved["estado_reporte"]
+    return entry
+
+@app.post("/recuperar_estados_reportes")
+def recuperar_estados_reportes():
+    """Restore (or just probe) the saved drafts of a whole worklist at once."""
+    if not check_auth(request):
+        return jsonify({"ok": False, "error": "Unauthorized"}), 401
+    try:
+        p = normalize_payload(request.get_json(force=True) or {})
+    except Exception:
+        return jsonify({"ok": False, "error": "JSON inválido"}), 400
+
+    centro_id = str(p.get("centro_id") or "").strip()
+    email = str(p.get("email_usuario") or "").strip()
+    codigos = p.get("codigos_unicos")
+    if not centro_id or not email or not isinstance(codigos, list):
+        return jsonify({
+            "ok": False,
+            "error": "Faltan datos requeridos (codigos_unicos, centro_id, email_usuario)",
+        }), 400
+    codigos = list(dict.fromkeys(str(cu or "").strip() for cu in codigos if str(cu or "").strip()))
+    if len(codigos) > RESTORE_BATCH_MAX:
+        return jsonify({"ok": False, "error": f"Máximo {RESTORE_BATCH_MAX} códigos por consulta"}), 413
+    metadata_only = p.get("solo_metadatos") in (True, "true", "1", 1)
+
+    futures = {
+        cu: fio.submit(restore_entry, centro_id, cu, email, metadata_only)
+        for cu in codigos
+    }
+    estados = {}
+    for cu, future in futures.items():
+        try:
+            estados[cu] = fio.wait(future)
+        except Exception as exc:
+            estados[cu] = {"existe": False, "error": str(exc)}
+    return jsonify({"ok": True, "estados": estados}), 200
+
+# 6) Arranque: hilos de fondo y calentamiento (gunicorn.conf.py los llama en post_fork)
+def start_background():
+    """Start the per-process background threads (compaction, write queue, autosave flusher)."""
+    compaction.start_scheduler()
+    if ASYNC_WRITES:
+        write_queue.start()
+    if save_coalescer is not None:
+        save_coalescer.start()
+
+def warm_up():
+    """Initialize Firebase and open a pooled connection before the first request."""
+    try:
+        latency = probe_firebase()
+        print(f"[boot] firebase listo: init={fio.init_ms}ms ida_y_vuelta={latency}ms")
+    except Exception as exc:
+        # No tumba el worker: /readyz lo reporta y el primer uso reintenta.
+        print(f"[boot] firebase no disponible aún: {exc}")
+
+APP_IMPORT_MS = round((time.perf_counter() - _import_started) * 1000, 1)
+
+if BACKGROUND_ON_IMPORT:
+    start_background()
+
+# 7) Local dev
 if __name__ == "__main__":
     app.run(host="0.0.0.0", port=int(os.getenv("PORT", 8080)))
@@ -0,0 +1,96 @@
+# fake_rtdb.py — RTDB en memoria con latencia, jitter y fallos configurables
+import os, random, sys, threading, time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "tests"))
+from fake_firebase import FakeQuery, FakeReference, fake_db  # noqa: E402  (instala los módulos falsos)
+
+class RTDBUnavailable(ConnectionError):
+    pass
+
+class NetworkModel:
+    """Per-call delay (latency ± jitter, in ms) and failure probability."""
+
+    def __init__(self, latency_ms=0.0, jitter_ms=0.0, failure_rate=0.0, seed=None):
+        self.latency_ms = latency_ms
+        self.jitter_ms = jitter_ms
+        self.failure_rate = failure_rate
+        self.random = random.Random(seed)
+        self.calls = 0
+        self.failures = 0
+        self._lock = threading.Lock()
+
+    def round_trip(self):
+        with self._lock:
+            self.calls += 1
+            delay = max(0.0, self.latency_ms + self.random.uniform(-self.jitter_ms, self.jitter_ms))
+            failed = self.random.random() < self.failure_rate
+            if failed:
+                self.failures += 1
+        if delay:
+            time.sleep(delay / 1000)
+        if failed:
+            raise RTDBUnavailable("fallo inyectado por el benchmark")
+
+    def stats(self):
+        with self._lock:
+            return {"calls": self.calls, "failures": self.failures}
+
+network = NetworkModel()
+# El árbol compartido no es seguro entre hilos; la latencia se simula fuera del candado.
+_tree_lock = threading.RLock()
+
+class LatencyReference(FakeReference):
+    def get(self, shallow=False):
+        network.round_trip()
+        with _tree_lock:
+            return super().get(shallow)
+
+    def set(self, value):
+        network.round_trip()
+        with _tree_lock:
+            super().set(value)
+
+    def update(self, value):
+        network.round_trip()
+        with _tree_lock:
+            super().update(value)
+
+    def transaction(self, update):
+        # GET con ETag y PUT condicionado: dos idas y vueltas.
+        network.round_trip()
+        network.round_trip()
+        with _tree_lock:
+            return super().transaction(update)
+
+    def push(self, value):
+        network.round_trip()
+        with _tree_lock:
+            return super().push(value)
+
+    def delete(self):
+        network.round_trip()
+        with _tree_lock:
+            super().delete()
+
+    def child(self, path):
+        return LatencyReference(f"{self.path.rstrip('/')}/{path}")
+
+    def order_by_key(self):
+        return LatencyQuery(self)
+
+    def order_by_child(self, path):
+        return LatencyQuery(self, order_by=path)
+
+class LatencyQuery(FakeQuery):
+    def get(self):
+        network.round_trip()
+        with _tree_lock:
+            return super().get()
+
+def install(latency_ms=0.0, jitter_ms=0.0, failure_rate=0.0, seed=None):
+    """Route db.reference() to the latency-injecting tree and reset it."""
+    global network
+    network = NetworkModel(latency_ms, jitter_ms, failure_rate, seed)
+    fake_db.reference = lambda path="/": LatencyReference(path)
+    FakeReference.reset()
+    return network
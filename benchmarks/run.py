@@ -0,0 +1,311 @@
+"""Load benchmarks for the Flask app against a latency-injecting RTDB.
+
+Examples:
+
+    python benchmarks/run.py --latency-ms 40 --jitter-ms 15 --output bench.json
+    python benchmarks/run.py --scenario push_feed_50 --clients 20 --requests 400
+    python benchmarks/run.py --compare bench.json --threshold 0.2
+
+Each scenario is driven by --clients concurrent threads, each with its own
+Flask test client. The JSON output records throughput, the p50/p95/p99
+latency and the RTDB call counts for every scenario. --compare exits with
+status 1 when a scenario's p95 regressed past --threshold.
+"""
+import argparse, atexit, json, os, platform, shutil, subprocess, sys, tempfile, threading, time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+_workdir = tempfile.mkdtemp(prefix="servidor_sync_bench_")
+atexit.register(shutil.rmtree, _workdir, ignore_errors=True)
+os.environ.setdefault("PUSH_FEED_TOKEN", "bench-token")
+os.environ.setdefault("BLOB_STORE_DIR", os.path.join(_workdir, "blobs"))
+os.environ.setdefault("WRITE_QUEUE_PATH", os.path.join(_workdir, "queue.sqlite3"))
+os.environ.setdefault("READ_CACHE_PATH", os.path.join(_workdir, "cache.sqlite3"))
+
+import fake_rtdb  # noqa: E402  (debe ir antes que app: instala firebase_admin falso)
+from fake_firebase import FakeReference  # noqa: E402
+import app as service  # noqa: E402
+import storage  # noqa: E402
+from firebase_io import fio  # noqa: E402
+
+CENTRO = "centro-bench"
+EMAIL = "bench@example.com"
+HEADERS = {"Authorization": f"Bearer {os.environ['PUSH_FEED_TOKEN']}"}
+PNG_SIGNATURE = b"\x89PNG\r\n\x1a\n"
+
+def percentile(sorted_values, fraction):
+    """Nearest-rank percentile of an already sorted list."""
+    if not sorted_values:
+        return None
+    index = max(0, min(len(sorted_values) - 1, int(round(fraction * len(sorted_values) + 0.5)) - 1))
+    return sorted_values[index]
+
+def png_bytes(size, seed=0):
+    body = f"bench-{seed}-".encode() * (size // 8 + 1)
+    return PNG_SIGNATURE + body[:max(0, size - len(PNG_SIGNATURE))]
+
+def reset_world(devices=1, feed_mode="dispositivo"):
+    dispositivos = {f"equipo-{n:03d}": {"nombre": f"equipo-{n:03d}"} for n in range(devices)}
+    centro = {"dispositivos": dispositivos, "feed_config": {"modo": feed_mode}}
+    if isinstance(fio.store, storage.SQLiteStore):
+        fio.store.reference("/").set({"ecosistemas": {CENTRO: centro}})
+    else:
+        FakeReference.reset({f"/ecosistemas/{CENTRO}": centro})
+    service.invalidate_devices()
+    service.cache.clear()
+
+def report(codigo, **extra):
+    return {
+        "codigo_unico": codigo,
+        "centro_id": CENTRO,
+        "email_usuario": EMAIL,
+        "estado_reporte": {"version": "bench-v1", "hallazgos": {"texto": "sin alteraciones", "n": 1}},
+        "modalidad": "RX",
+        **extra,
+    }
+
+def upload(client, codigo, content):
+    from io import BytesIO
+    return client.post("/subir_esquema_prostata", headers=HEADERS, data={
+        "codigo_unico": codigo,
+        "centro_id": CENTRO,
+        "email_usuario": EMAIL,
+        "archivo": (BytesIO(content), "esquema.png", "image/png"),
+    }, content_type="multipart/form-data")
+
+class Scenario:
+    """A named workload: setup() runs untimed, request() is measured."""
+
+    max_requests = None
+    expected = (200,)
+
+    def __init__(self, name):
+        self.name = name
+
+    def setup(self, client, requests):
+        reset_world()
+
+    def request(self, client, index):
+        raise NotImplementedError
+
+class PushFeed(Scenario):
+    def __init__(self, devices, feed_mode="dispositivo"):
+        super().__init__(f"push_feed_{devices}" + ("_centro" if feed_mode == "centro" else ""))
+        self.devices = devices
+        self.feed_mode = feed_mode
+
+    def setup(self, client, requests):
+        reset_world(self.devices, self.feed_mode)
+
+    def request(self, client, index):
+        return client.post("/push_feed", headers=HEADERS, json=report(f"BENCH-{index:06d}"))
+
+class Upload(Scenario):
+    expected = (201,)
+
+    def __init__(self, name, size, max_requests=None):
+        super().__init__(name)
+        self.size = size
+        self.max_requests = max_requests
+
+    def request(self, client, index):
+        # Contenido distinto por petición: si no, la deduplicación evitaría escribir.
+        return upload(client, f"BENCH-{index:06d}", png_bytes(self.size, index))
+
+class Download(Scenario):
+    def __init__(self, name, size, max_requests=None):
+        super().__init__(name)
+        self.size = size
+        self.max_requests = max_requests
+
+    def setup(self, client, requests):
+        reset_world()
+        response = upload(client, "BENCH-DESCARGA", png_bytes(self.size))
+        if response.status_code != 201:
+            raise RuntimeError(f"no se pudo preparar la descarga: {response.get_json()}")
+
+    def request(self, client, index):
+        response = client.get("/descargar_adjunto_reporte", headers=HEADERS, query_string={
+            "codigo_unico": "BENCH-DESCARGA", "centro_id": CENTRO, "email_usuario": EMAIL,
+        })
+        response.get_data()  # consumir el cuerpo: send_file lo entrega en streaming
+        return response
+
+class Restore(Scenario):
+    """Restore saved states; `warm` reuses a small working set already cached."""
+
+    WORKING_SET = 20
+
+    def __init__(self, warm):
+        super().__init__("restore_warm" if warm else "restore_cold")
+        self.warm = warm
+
+    def codigo(self, index):
+        return f"BENCH-{index % self.WORKING_SET if self.warm else index:06d}"
+
+    def setup(self, client, requests):
+        reset_world()
+        codes = {self.codigo(index) for index in range(requests)}
+        # Sembrado sin latencia; luego la caché queda fría.
+        saved_latency = fake_rtdb.network.latency_ms, fake_rtdb.network.jitter_ms, fake_rtdb.network.failure_rate
+        fake_rtdb.network.latency_ms = fake_rtdb.network.jitter_ms = fake_rtdb.network.failure_rate = 0
+        try:
+            for codigo in codes:
+                client.post("/push_feed", headers=HEADERS, json=report(codigo))
+        finally:
+            fake_rtdb.network.latency_ms, fake_rtdb.network.jitter_ms, fake_rtdb.network.failure_rate = saved_latency
+        service.cache.clear()
+        if self.warm:
+            for codigo in codes:
+                self.restore(client, codigo)
+
+    def restore(self, client, codigo):
+        return client.post("/recuperar_estado_reporte", headers=HEADERS, json={
+            "codigo_unico": codigo, "centro_id": CENTRO, "email_usuario": EMAIL,
+        })
+
+    def request(self, client, index):
+        return self.restore(client, self.codigo(index))
+
+SCENARIOS = {scenario.name: scenario for scenario in [
+    PushFeed(1), PushFeed(10), PushFeed(50), PushFeed(200), PushFeed(50, "centro"),
+    Upload("upload_100k", 100 * 1024),
+    Upload("upload_8m", 8 * 1024 * 1024, max_requests=20),
+    Download("download_100k", 100 * 1024),
+    Download("download_8m", 8 * 1024 * 1024, max_requests=40),
+    Restore(warm=False), Restore(warm=True),
+]}
+
+def run_scenario(scenario, clients, requests):
+    requests = min(requests, scenario.max_requests or requests)
+    scenario.setup(service.app.test_client(), requests)
+    calls_before = fake_rtdb.network.stats()
+
+    local = threading.local()
+    latencies = [None] * requests
+    statuses = Counter()
+    lock = threading.Lock()
+
+    def one(index):
+        client = getattr(local, "client", None)
+        if client is None:
+            client = local.client = service.app.test_client()
+        started = time.perf_counter()
+        try:
+            status = scenario.request(client, index).status_code
+        except Exception as exc:
+            status = type(exc).__name__
+        latencies[index] = (time.perf_counter() - started) * 1000
+        with lock:
+            statuses[str(status)] += 1
+
+    wall_started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=clients) as pool:
+        list(pool.map(one, range(requests)))
+    wall = time.perf_counter() - wall_started
+
+    calls_after = fake_rtdb.network.stats()
+    ordered = sorted(latencies)
+    errors = sum(count for status, count in statuses.items() if status not in map(str, scenario.expected))
+    return {
+        "name": scenario.name,
+        "clients": clients,
+        "requests": requests,
+        "wall_s": round(wall, 3),
+        "throughput_rps": round(requests / wall, 2) if wall else None,
+        "latency_ms": {
+            "p50": round(percentile(ordered, 0.50), 2),
+            "p95": round(percentile(ordered, 0.95), 2),
+            "p99": round(percentile(ordered, 0.99), 2),
+            "mean": round(sum(ordered) / len(ordered), 2),
+            "max": round(ordered[-1], 2),
+        },
+        "statuses": dict(statuses),
+        "errors": errors,
+        "rtdb": {
+            "calls": calls_after["calls"] - calls_before["calls"],
+            "failures": calls_after["failures"] - calls_before["failures"],
+        },
+    }
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=ROOT,
+                              capture_output=True, text=True, timeout=5).stdout.strip() or None
+    except (OSError, subprocess.SubprocessError):
+        return None
+
+def compare(results, baseline, threshold):
+    """Return the scenarios whose p95 grew more than `threshold` (a fraction)."""
+    previous = {item["name"]: item for item in baseline.get("scenarios", [])}
+    regressions = []
+    for item in results["scenarios"]:
+        before = previous.get(item["name"])
+        if not before or not before["latency_ms"]["p95"]:
+            continue
+        change = item["latency_ms"]["p95"] / before["latency_ms"]["p95"] - 1
+        print(f"  {item['name']:<16} p95 {before['latency_ms']['p95']:>9.2f} → {item['latency_ms']['p95']:>9.2f} ms ({change:+.0%})")
+        if change > threshold:
+            regressions.append(item["name"])
+    return regressions
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmarks de carga con RTDB simulado")
+    parser.add_argument("--scenario", action="append", choices=sorted(SCENARIOS),
+                        help="escenario a correr (repetible; por defecto todos)")
+    parser.add_argument("--clients", type=int, default=10, help="clientes concurrentes")
+    parser.add_argument("--requests", type=int, default=200, help="peticiones por escenario")
+    parser.add_argument("--latency-ms", type=float, default=30.0, help="latencia por llamada a RTDB")
+    parser.add_argument("--jitter-ms", type=float, default=10.0, help="variación ± de la latencia")
+    parser.add_argument("--failure-rate", type=float, default=0.0, help="fracción de llamadas que fallan")
+    parser.add_argument("--seed", type=int, default=1234)
+    parser.add_argument("--backend", choices=("fake", "sqlite"), default="fake",
+                        help="fake: RTDB en memoria con latencia; sqlite: storage.SQLiteStore local")
+    parser.add_argument("--output", help="archivo JSON de resultados")
+    parser.add_argument("--compare", help="resultados previos contra los que comparar el p95")
+    parser.add_argument("--threshold", type=float, default=0.2, help="regresión tolerada del p95 (0.2 = 20%%)")
+    args = parser.parse_args(argv)
+
+    fake_rtdb.install(args.latency_ms, args.jitter_ms, args.failure_rate, args.seed)
+    if args.backend == "sqlite":
+        fio.configure(None, store=storage.SQLiteStore(os.path.join(_workdir, "rtdb.sqlite3")))
+    results = {
+        "meta": {
+            "timestamp": int(time.time()),
+            "git_commit": git_commit(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "clients": args.clients,
+            "requests": args.requests,
+            "latency_ms": args.latency_ms,
+            "jitter_ms": args.jitter_ms,
+            "failure_rate": args.failure_rate,
+            "seed": args.seed,
+            "backend": args.backend,
+        },
+        "scenarios": [],
+    }
+    for name in args.scenario or list(SCENARIOS):
+        result = run_scenario(SCENARIOS[name], args.clients, args.requests)
+        results["scenarios"].append(result)
+        latency = result["latency_ms"]
+        print(f"{name:<16} {result['throughput_rps']:>8.1f} req/s  p50={latency['p50']:.1f}ms "
+              f"p95={latency['p95']:.1f}ms p99={latency['p99']:.1f}ms errores={result['errors']}")
+
+    if args.output:
+        with open(args.output, "w") as fh:
+            json.dump(results, fh, indent=2)
+    if args.compare:
+        with open(args.compare) as fh:
+            regressions = compare(results, json.load(fh), args.threshold)
+        if regressions:
+            print(f"Regresiones de p95: {', '.join(regressions)}")
+            return 1
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
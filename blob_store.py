@@ -0,0 +1,256 @@
+# blob_store.py — almacén de adjuntos direccionado por contenido (sha256)
+import base64, hashlib, io, os, re, tempfile
+from firebase_io import fio
+
+BLOB_STORE = os.getenv("BLOB_STORE", "local")  # local | s3
+BLOB_STORE_DIR = os.getenv("BLOB_STORE_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), "data", "blobs"))
+BLOB_STORE_BUCKET = os.getenv("BLOB_STORE_BUCKET", "")
+BLOB_STORE_PREFIX = os.getenv("BLOB_STORE_PREFIX", "adjuntos/")
+BLOB_STORAGE_PREFIX = "blob:sha256/"
+
+_DIGEST_RE = re.compile(r"^[0-9a-f]{64}$")
+
+def storage_path_for(digest):
+    return f"{BLOB_STORAGE_PREFIX}{digest}"
+
+def digest_from_storage_path(storage_path):
+    """Return the sha256 of a blob storage_path, or None for other schemes."""
+    storage_path = str(storage_path or "")
+    if not storage_path.startswith(BLOB_STORAGE_PREFIX):
+        return None
+    digest = storage_path[len(BLOB_STORAGE_PREFIX):]
+    return digest if _DIGEST_RE.match(digest) else None
+
+def _check_digest(digest):
+    if not _DIGEST_RE.match(str(digest or "")):
+        raise ValueError("sha256 inválido")
+    return digest
+
+class StagedBlob:
+    """Temporary file that becomes a blob once its digest is known."""
+
+    def __init__(self, store, handle, path=None):
+        self.store = store
+        self.handle = handle
+        self.path = path
+        self.size = 0
+
+    def write(self, chunk):
+        self.handle.write(chunk)
+        self.size += len(chunk)
+
+    def commit(self, digest):
+        """Publish the staged bytes as `digest`; False when deduplicated."""
+        try:
+            return self.store._commit_staged(self, digest)
+        finally:
+            self.discard()
+
+    def discard(self):
+        if not self.handle.closed:
+            self.handle.close()
+        if self.path and os.path.exists(self.path):
+            os.unlink(self.path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.discard()
+
+class BlobStore:
+    """Interface: blobs are immutable and addressed by their sha256."""
+
+    def exists(self, digest):
+        raise NotImplementedError
+
+    def put(self, digest, data):
+        """Store `data` under `digest`; returns False when it was already there."""
+        raise NotImplementedError
+
+    def open(self, digest):
+        """Return a readable binary file object, or None if the blob is missing."""
+        raise NotImplementedError
+
+    def local_path(self, digest):
+        """Return a filesystem path for the blob when the backend has one."""
+        return None
+
+    def stage(self):
+        """Return a StagedBlob to stream an upload into before hashing ends."""
+        return StagedBlob(self, tempfile.TemporaryFile())
+
+    def _commit_staged(self, staged, digest):
+        staged.handle.seek(0)
+        return self.put(digest, staged.handle.read())
+
+    def read(self, digest):
+        handle = self.open(digest)
+        if handle is None:
+            return None
+        with handle:
+            return handle.read()
+
+class LocalBlobStore(BlobStore):
+    def __init__(self, root=BLOB_STORE_DIR):
+        self.root = root
+
+    def path(self, digest):
+        _check_digest(digest)
+        return os.path.join(self.root, digest[:2], digest[2:4], digest)
+
+    def exists(self, digest):
+        return os.path.exists(self.path(digest))
+
+    def put(self, digest, data):
+        target = self.path(digest)
+        if os.path.exists(target):
+            return False
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(target), prefix=".tmp-")
+        try:
+            with os.fdopen(fd, "wb") as handle:
+                handle.write(data)
+            # os.replace es atómico: un lector nunca ve un blob a medio escribir.
+            os.replace(tmp, target)
+        except BaseException:
+            if os.path.exists(tmp):
+                os.unlink(tmp)
+            raise
+        return True
+
+    def open(self, digest):
+        try:
+            return open(self.path(digest), "rb")
+        except FileNotFoundError:
+            return None
+
+    def local_path(self, digest):
+        path = self.path(digest)
+        return path if os.path.exists(path) else None
+
+    def stage(self):
+        staging = os.path.join(self.root, ".staging")
+        os.makedirs(staging, exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=staging, prefix="upload-")
+        return StagedBlob(self, os.fdopen(fd, "wb"), tmp)
+
+    def _commit_staged(self, staged, digest):
+        target = self.path(digest)
+        staged.handle.flush()
+        os.fsync(staged.handle.fileno())
+        staged.handle.close()
+        if os.path.exists(target):
+            return False
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        # Mismo sistema de archivos que el destino: el rename es atómico.
+        os.replace(staged.path, target)
+        return True
+
+class S3BlobStore(BlobStore):
+    """Object-storage backend (S3 or any S3-compatible service via boto3)."""
+
+    def __init__(self, bucket=BLOB_STORE_BUCKET, prefix=BLOB_STORE_PREFIX, client=None):
+        if client is None:
+            import boto3  # dependencia opcional, solo si BLOB_STORE=s3
+            client = boto3.client("s3", endpoint_url=os.getenv("BLOB_STORE_ENDPOINT") or None)
+        if not bucket:
+            raise RuntimeError("BLOB_STORE=s3 requiere BLOB_STORE_BUCKET")
+        self.client = client
+        self.bucket = bucket
+        self.prefix = prefix
+
+    def object_key(self, digest):
+        _check_digest(digest)
+        return f"{self.prefix}{digest[:2]}/{digest}"
+
+    def exists(self, digest):
+        try:
+            self.client.head_object(Bucket=self.bucket, Key=self.object_key(digest))
+            return True
+        except Exception:
+            return False
+
+    def put(self, digest, data):
+        if self.exists(digest):
+            return False
+        self.client.put_object(Bucket=self.bucket, Key=self.object_key(digest), Body=data,
+                               ContentType="application/octet-stream")
+        return True
+
+    def _commit_staged(self, staged, digest):
+        if self.exists(digest):
+            return False
+        staged.handle.seek(0)
+        # upload_fileobj sube por partes desde el archivo temporal, sin cargarlo entero.
+        self.client.upload_fileobj(staged.handle, self.bucket, self.object_key(digest),
+                                   ExtraArgs={"ContentType": "application/octet-stream"})
+        return True
+
+    def open(self, digest):
+        try:
+            obj = self.client.get_object(Bucket=self.bucket, Key=self.object_key(digest))
+        except Exception:
+            return None
+        return io.BytesIO(obj["Body"].read())
+
+_store = None
+
+def get_blob_store():
+    global _store
+    if _store is None:
+        if BLOB_STORE == "s3":
+            _store = S3BlobStore()
+        elif BLOB_STORE == "local":
+            _store = LocalBlobStore()
+        else:
+            raise RuntimeError(f"BLOB_STORE desconocido: {BLOB_STORE}")
+    return _store
+
+def set_blob_store(store):
+    global _store
+    _store = store
+
+def migrate_rtdb_attachments(store=None, centros=None, dry_run=False, on_migrated=None):
+    """Move legacy content_base64 attachments from RTDB into the blob store.
+
+    `on_migrated(centro_id, key, tipo)` runs after each record is rewritten,
+    so callers can drop cached copies that still carry the base64 content.
+    """
+    store = store or get_blob_store()
+    if not centros:
+        listed = fio.get("/ecosistemas", shallow=True)
+        centros = sorted(listed) if isinstance(listed, dict) else []
+
+    summary = {"records": 0, "migrated": 0, "deduplicated": 0, "bytes": 0, "errors": [], "dry_run": dry_run}
+    for centro_id in centros:
+        base = f"/ecosistemas/{centro_id}/adjuntos_reportes"
+        keys = fio.get(base, shallow=True)
+        for key in sorted(keys) if isinstance(keys, dict) else []:
+            # Se lee un reporte a la vez para no cargar todos los base64 en memoria.
+            tipos = fio.get(f"{base}/{key}")
+            for tipo, record in (tipos or {}).items() if isinstance(tipos, dict) else []:
+                if not isinstance(record, dict) or not record.get("content_base64"):
+                    continue
+                summary["records"] += 1
+                try:
+                    content = base64.b64decode(record["content_base64"], validate=True)
+                except (TypeError, ValueError) as exc:
+                    summary["errors"].append({"path": f"{base}/{key}/{tipo}", "error": str(exc)})
+                    continue
+                digest = hashlib.sha256(content).hexdigest()
+                summary["bytes"] += len(record["content_base64"])
+                if dry_run:
+                    continue
+                if not store.put(digest, content):
+                    summary["deduplicated"] += 1
+                fio.update(f"{base}/{key}/{tipo}", {
+                    "storage_path": storage_path_for(digest),
+                    "sha256": digest,
+                    "size_bytes": len(content),
+                    "content_base64": None,
+                })
+                if on_migrated is not None:
+                    on_migrated(centro_id, key, tipo)
+                summary["migrated"] += 1
+    return summary
@@ -0,0 +1,201 @@
+# centro_feed.py — feed por centro escrito una sola vez, con un cursor por dispositivo
+import json, os, threading, time
+from concurrent.futures import ThreadPoolExecutor
+from firebase_io import fio
+from compaction import MAX_PATHS_PER_UPDATE
+
+FEED_MODE_DEFAULT = os.getenv("FEED_MODE_DEFAULT", "dispositivo")  # dispositivo | centro
+FEED_CONFIG_TTL = float(os.getenv("FEED_CONFIG_TTL", "60"))  # segundos; 0 desactiva la caché
+FEED_MODES = ("dispositivo", "centro")
+
+# /ecosistemas/{centro}/feed_config = {"modo": "centro", "legacy": {device_id: true}}
+#
+# En modo "centro" cada reporte se escribe una vez en feed_centro y cada
+# dispositivo guarda solo su cursor. Los dispositivos en "legacy" (clientes que
+# aún leen dispositivos/{dev}/feed_estudios) siguen recibiendo su copia hasta
+# que confirman un cursor.
+_config_cache = {}
+_config_lock = threading.Lock()
+
+def config_path(centro_id):
+    return f"/ecosistemas/{centro_id}/feed_config"
+
+def centro_feed_path(centro_id):
+    return f"/ecosistemas/{centro_id}/feed_centro"
+
+def device_feed_path(centro_id, device_id):
+    return f"/ecosistemas/{centro_id}/dispositivos/{device_id}/feed_estudios"
+
+def cursor_path(centro_id, device_id):
+    return f"/ecosistemas/{centro_id}/dispositivos/{device_id}/feed_cursor"
+
+def normalize_config(value):
+    value = value if isinstance(value, dict) else {}
+    modo = value.get("modo") if value.get("modo") in FEED_MODES else FEED_MODE_DEFAULT
+    legacy = value.get("legacy") if isinstance(value.get("legacy"), dict) else {}
+    return {"modo": modo, "legacy": sorted(dev for dev, on in legacy.items() if on)}
+
+def invalidate(centro_id=None):
+    with _config_lock:
+        if centro_id is None:
+            _config_cache.clear()
+        else:
+            _config_cache.pop(centro_id, None)
+
+def feed_config(centro_id):
+    """Return the normalized feed config of a centro (cached with TTL)."""
+    now = time.monotonic()
+    with _config_lock:
+        cached = _config_cache.get(centro_id)
+        if cached and cached[0] > now:
+            return cached[1]
+    config = normalize_config(fio.get(config_path(centro_id)))
+    if FEED_CONFIG_TTL > 0:
+        with _config_lock:
+            _config_cache[centro_id] = (now + FEED_CONFIG_TTL, config)
+    return config
+
+def plan_feed_writes(config, dispositivos, key, data):
+    """Feed paths (relative to /ecosistemas/{centro}) that receive one report."""
+    if config["modo"] != "centro":
+        return {f"dispositivos/{dev_id}/feed_estudios/{key}": data for dev_id in dispositivos}
+    updates = {f"feed_centro/{key}": data}
+    for dev_id in set(config["legacy"]).intersection(dispositivos):
+        updates[f"dispositivos/{dev_id}/feed_estudios/{key}"] = data
+    return updates
+
+def reads_centro_feed(centro_id, device_id):
+    config = feed_config(centro_id)
+    return config["modo"] == "centro" and device_id not in config["legacy"]
+
+def stored_cursor(centro_id, device_id):
+    value = fio.get(cursor_path(centro_id, device_id))
+    return value.get("key") if isinstance(value, dict) else None
+
+def store_cursor(centro_id, device_id, key):
+    """Persist a device's cursor; confirming one also retires its legacy copy."""
+    fio.update(f"/ecosistemas/{centro_id}", {
+        f"dispositivos/{device_id}/feed_cursor": {"key": key, "updatedAt": int(time.time() * 1000)},
+        f"feed_config/legacy/{device_id}": None,
+    })
+    invalidate(centro_id)
+
+# Relleno de dispositivos recién registrados
+def backfill_device(centro_id, device_id, since_ms):
+    """Copy to a device's feed the entries other devices received since `since_ms`.
+
+    Workers whose cached device list predates a registration keep fanning out
+    without the new device until the cache expires. Every device receives a
+    report under the same push ID, so the missing entries are found by key;
+    they are read by `updatedAt` (RTDB needs `.indexOn: updatedAt` on the feeds).
+    """
+    if reads_centro_feed(centro_id, device_id):
+        return 0  # lee feed_centro, que ya tiene todo
+    value = fio.get(f"/ecosistemas/{centro_id}/dispositivos", shallow=True)
+    others = [dev_id for dev_id in sorted(value) if dev_id != device_id] if isinstance(value, dict) else []
+    own, *feeds = fio.map(
+        lambda dev_id: fio.query(device_feed_path(centro_id, dev_id), order_by="updatedAt", start_at=since_ms),
+        [device_id, *others])
+    missing = {}
+    for feed in feeds:
+        for key, entry in feed.items():
+            if key not in own:
+                missing.setdefault(key, entry)
+    if missing:
+        _write_chunked(centro_id, {f"dispositivos/{device_id}/feed_estudios/{key}": entry for key, entry in missing.items()})
+    return len(missing)
+
+_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="feed-backfill")
+
+def schedule_backfill(centro_id, device_id, since_ms, delay):
+    """Run backfill_device once `delay` seconds have passed (other workers' caches expired)."""
+    due = time.time() + max(0.0, delay)
+
+    def run():
+        time.sleep(max(0.0, due - time.time()))
+        try:
+            return backfill_device(centro_id, device_id, since_ms)
+        except Exception as exc:
+            print(f"[feed] relleno de {centro_id}/{device_id} falló: {exc}")
+            return None
+
+    return _executor.submit(run)
+
+# Migración de feeds por dispositivo al feed del centro
+def _fingerprint(entry):
+    return json.dumps(entry, sort_keys=True, separators=(",", ":"), ensure_ascii=False)
+
+def _write_chunked(centro_id, updates):
+    paths = list(updates)
+    for start in range(0, len(paths), MAX_PATHS_PER_UPDATE):
+        fio.update(f"/ecosistemas/{centro_id}", {path: updates[path] for path in paths[start:start + MAX_PATHS_PER_UPDATE]})
+
+def merge_device_feeds(centro_id, devices):
+    """Copy per-device entries missing from feed_centro; returns (added, last key per device).
+
+    The copies of one report are identical across devices, so they collapse
+    into one entry kept under the smallest of their push IDs.
+    """
+    feeds = fio.map(lambda dev_id: fio.get(device_feed_path(centro_id, dev_id)), devices)
+    existing = fio.get(centro_feed_path(centro_id))
+    existing = existing if isinstance(existing, dict) else {}
+    feeds = {dev_id: feed for dev_id, feed in zip(devices, feeds) if isinstance(feed, dict)}
+
+    by_content, pending = {}, {}
+    for key, entry in existing.items():
+        fingerprint = _fingerprint(entry)
+        by_content[fingerprint] = min(key, by_content.get(fingerprint, key))
+    for feed in feeds.values():
+        for key, entry in feed.items():
+            fingerprint = _fingerprint(entry)
+            if fingerprint in by_content and by_content[fingerprint] in existing:
+                continue
+            current = pending.get(fingerprint)
+            if current is None or key < current[0]:
+                pending[fingerprint] = (key, entry)
+                by_content[fingerprint] = key
+
+    added = dict(pending.values())
+    last_keys = {
+        dev_id: max(by_content[_fingerprint(entry)] for entry in feed.values())
+        for dev_id, feed in feeds.items() if feed
+    }
+    if added:
+        _write_chunked(centro_id, {f"feed_centro/{key}": entry for key, entry in added.items()})
+    return added, last_keys
+
+def migrate_centro(centro_id, legacy=None, drop_device_feeds=False, settle=FEED_CONFIG_TTL, dry_run=False):
+    """Switch one centro to the centro feed.
+
+    `legacy` lists the devices that keep receiving per-device copies (None =
+    every registered device). Workers may write per-device copies until their
+    cached config expires, so after `settle` seconds a second pass merges those
+    stragglers too.
+    """
+    value = fio.get(f"/ecosistemas/{centro_id}/dispositivos", shallow=True)
+    devices = sorted(value) if isinstance(value, dict) else []
+    legacy = devices if legacy is None else [dev for dev in legacy if dev in devices]
+    stats = {"centro_id": centro_id, "devices": len(devices), "legacy": legacy, "entries": 0, "dropped": 0}
+    if dry_run:
+        feeds = fio.map(lambda dev_id: fio.get(device_feed_path(centro_id, dev_id), shallow=True), devices)
+        stats["entries"] = sum(len(feed) for feed in feeds if isinstance(feed, dict))
+        return stats
+
+    added, last_keys = merge_device_feeds(centro_id, devices)
+    switch = {f"dispositivos/{dev_id}/feed_cursor": {"key": key, "updatedAt": int(time.time() * 1000)}
+              for dev_id, key in last_keys.items()}
+    switch["feed_config"] = {"modo": "centro", "legacy": {dev_id: True for dev_id in legacy} or None}
+    fio.update(f"/ecosistemas/{centro_id}", switch)
+    invalidate(centro_id)
+
+    if settle and settle > 0:
+        time.sleep(settle)
+    stragglers, _ = merge_device_feeds(centro_id, devices)
+    stats["entries"] = len(added) + len(stragglers)
+
+    if drop_device_feeds:
+        drops = {f"dispositivos/{dev_id}/feed_estudios": None for dev_id in devices if dev_id not in legacy}
+        if drops:
+            fio.update(f"/ecosistemas/{centro_id}", drops)
+        stats["dropped"] = len(drops)
+    return stats
@@ -0,0 +1,303 @@
+# coalescer.py — agrupa autoguardados del mismo reporte (debounce + tope de espera) en una sola escritura
+import hashlib, json, os, sqlite3, threading, time
+
+COALESCE_AUTOSAVES = os.getenv("COALESCE_AUTOSAVES", "") == "1"
+COALESCE_PATH = os.getenv("COALESCE_PATH", "/tmp/servidor_sync_coalesce.sqlite3")
+COALESCE_DEBOUNCE = float(os.getenv("COALESCE_DEBOUNCE", "3"))  # segundos sin cambios antes de escribir
+COALESCE_MAX_DELAY = float(os.getenv("COALESCE_MAX_DELAY", "15"))  # espera máxima desde el primer cambio pendiente
+COALESCE_FINAL_STATUSES = tuple(
+    status.strip() for status in os.getenv("COALESCE_FINAL_STATUSES", "REPORTADO").split(",") if status.strip()
+)
+COALESCE_HASH_TTL = float(os.getenv("COALESCE_HASH_TTL", "3600"))  # cuánto vale el hash del último guardado
+COALESCE_LEASE = float(os.getenv("COALESCE_LEASE", "60"))  # segundos antes de retomar un flush huérfano
+COALESCE_TAKE_WAIT = float(os.getenv("COALESCE_TAKE_WAIT", "2"))  # espera de un guardado final a un flush en curso
+COALESCE_MAX_ATTEMPTS = int(os.getenv("COALESCE_MAX_ATTEMPTS", "5"))
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS saves (
+    key TEXT PRIMARY KEY,
+    status TEXT NOT NULL,
+    payload TEXT,
+    digest TEXT,
+    dirty INTEGER NOT NULL DEFAULT 0,
+    first_seen REAL,
+    last_seen REAL,
+    lease_until REAL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    persisted_digest TEXT,
+    persisted_at REAL,
+    persisted_version INTEGER
+);
+CREATE INDEX IF NOT EXISTS saves_status ON saves (status);
+"""
+
+# Campos que cambian en cada guardado aunque el contenido sea el mismo.
+VOLATILE_FIELDS = ("updatedAt", "source_device_id")
+
+def content_digest(report):
+    """sha256 of what a save would persist, ignoring timestamps and origin."""
+    content = {
+        "data": {k: v for k, v in report["data"].items() if k not in VOLATILE_FIELDS},
+        "estado": {k: v for k, v in report["estado"].items() if k not in VOLATILE_FIELDS} if report["estado"] else None,
+        "estado_patch": report.get("estado_patch"),
+        "base_version": report.get("base_version"),
+    }
+    encoded = json.dumps(content, sort_keys=True, separators=(",", ":"), ensure_ascii=False, default=str)
+    return hashlib.sha256(encoded.encode("utf-8")).hexdigest()
+
+def is_autosave(report, final_statuses=COALESCE_FINAL_STATUSES):
+    """Whether a save may wait: intermediate full-state saves, not final ones or patches."""
+    return report["data"].get("estatus") not in final_statuses and "estado_patch" not in report
+
+class SaveCoalescer:
+    """Keeps only the latest pending save per report and flushes it later.
+
+    A save is flushed once it has been quiet for `debounce` seconds, or
+    `max_delay` seconds after the first save still pending. State lives in a
+    SQLite file so every gunicorn worker on the host sees the same pending
+    saves and at most one of them flushes a given report at a time.
+    """
+
+    def __init__(self, handler, path=COALESCE_PATH, debounce=COALESCE_DEBOUNCE, max_delay=COALESCE_MAX_DELAY,
+                 hash_ttl=COALESCE_HASH_TTL, lease=COALESCE_LEASE, max_attempts=COALESCE_MAX_ATTEMPTS,
+                 take_wait=COALESCE_TAKE_WAIT):
+        self.handler = handler
+        self.path = path
+        self.debounce = debounce
+        self.max_delay = max_delay
+        self.hash_ttl = hash_ttl
+        self.lease = lease
+        self.max_attempts = max_attempts
+        self.take_wait = take_wait
+        self._local = threading.local()
+        self._wakeup = threading.Condition()
+        self._thread = None
+        self._stopping = False
+        conn = self._conn()
+        conn.executescript(SCHEMA)
+        if "persisted_version" not in {row[1] for row in conn.execute("PRAGMA table_info(saves)")}:
+            try:  # archivo creado por una versión anterior
+                conn.execute("ALTER TABLE saves ADD COLUMN persisted_version INTEGER")
+            except sqlite3.OperationalError:  # otro worker la agregó primero
+                pass
+
+    def _conn(self):
+        # Una conexión heredada por fork (gunicorn --preload) no debe reutilizarse.
+        conn = getattr(self._local, "conn", None)
+        if conn is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    def _transaction(self, fn):
+        conn = self._conn()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            result = fn(conn)
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        conn.execute("COMMIT")
+        return result
+
+    def _row(self, conn, key):
+        row = conn.execute(
+            "SELECT status, dirty, first_seen, lease_until, persisted_digest, persisted_at FROM saves WHERE key = ?",
+            (key,),
+        ).fetchone()
+        return dict(zip(("status", "dirty", "first_seen", "lease_until", "persisted_digest", "persisted_at"), row)) if row else None
+
+    def _unchanged(self, row, digest, now):
+        return (row is not None and row["persisted_digest"] == digest
+                and row["persisted_at"] is not None and now - row["persisted_at"] < self.hash_ttl)
+
+    def submit(self, key, report, digest):
+        """Hold an autosave; returns ("skipped", None) or ("coalesced", seconds until flush)."""
+        now = time.time()
+        payload = json.dumps(report, separators=(",", ":"))
+
+        def run(conn):
+            row = self._row(conn, key)
+            if row is not None and row["status"] in ("pending", "flushing"):
+                # Se reemplaza lo pendiente; si ya se está escribiendo, queda
+                # marcado para una segunda pasada con el contenido nuevo.
+                flushing = row["status"] == "flushing"
+                first_seen = now if flushing and not row["dirty"] else row["first_seen"]
+                conn.execute(
+                    "UPDATE saves SET payload = ?, digest = ?, last_seen = ?, first_seen = ?, dirty = ?"
+                    " WHERE key = ?",
+                    (payload, digest, now, first_seen, 1 if flushing else 0, key),
+                )
+                return "coalesced", min(now + self.debounce, first_seen + self.max_delay) - now
+            if self._unchanged(row, digest, now):
+                return "skipped", None
+            conn.execute(
+                "INSERT INTO saves (key, status, payload, digest, dirty, first_seen, last_seen, attempts)"
+                " VALUES (?, 'pending', ?, ?, 0, ?, ?, 0)"
+                " ON CONFLICT(key) DO UPDATE SET status = 'pending', payload = excluded.payload,"
+                " digest = excluded.digest, dirty = 0, first_seen = excluded.first_seen,"
+                " last_seen = excluded.last_seen, attempts = 0",
+                (key, payload, digest, now, now),
+            )
+            return "coalesced", min(self.debounce, self.max_delay)
+
+        result = self._transaction(run)
+        with self._wakeup:
+            self._wakeup.notify()
+        return result
+
+    def take(self, key, report, digest=None):
+        """Prepare `report`, a save that must be written now (single, batch or queued).
+
+        Removes and returns the pending report of the same key (or None), or
+        "skipped" when `digest` matches what was last persisted and nothing is
+        pending. A flush of the same report already running is awaited for at
+        most `take_wait` seconds; after that `report` is handed to the flusher
+        for a second pass right behind it and "handed_off" is returned, so
+        the caller must not write it.
+        """
+        deadline = time.time() + self.take_wait
+        handoff = json.dumps(report, separators=(",", ":"))
+
+        def run(conn):
+            now = time.time()
+            row = self._row(conn, key)
+            if row is None:
+                return None
+            if row["status"] == "flushing" and row["lease_until"] > now:
+                if now < deadline:
+                    return "wait"
+                # first_seen en el pasado: vence apenas termine el flush actual.
+                conn.execute(
+                    "UPDATE saves SET payload = ?, digest = ?, dirty = 1, last_seen = ?, first_seen = ?"
+                    " WHERE key = ?",
+                    (handoff, digest, now, now - self.max_delay, key),
+                )
+                return "handed_off"
+            if row["status"] in ("pending", "flushing"):
+                (payload,) = conn.execute("SELECT payload FROM saves WHERE key = ?", (key,)).fetchone()
+                conn.execute(
+                    "UPDATE saves SET status = 'idle', payload = NULL, digest = NULL, dirty = 0,"
+                    " lease_until = NULL WHERE key = ?",
+                    (key,),
+                )
+                return json.loads(payload)
+            return "skipped" if digest is not None and self._unchanged(row, digest, now) else None
+
+        while True:
+            result = self._transaction(run)
+            if result != "wait":
+                return result
+            time.sleep(0.05)
+
+    def record(self, key, digest, version=None):
+        """Remember the content hash of a save that was just persisted, by any write path.
+
+        A hash recorded with a state `version` older than the one already
+        stored is ignored: writes of the same report may finish out of order.
+        """
+        self._conn().execute(
+            "INSERT INTO saves (key, status, persisted_digest, persisted_at, persisted_version)"
+            " VALUES (?, 'idle', ?, ?, ?)"
+            " ON CONFLICT(key) DO UPDATE SET persisted_digest = excluded.persisted_digest,"
+            " persisted_at = excluded.persisted_at, persisted_version = excluded.persisted_version"
+            " WHERE saves.persisted_version IS NULL OR excluded.persisted_version IS NULL"
+            "    OR excluded.persisted_version >= saves.persisted_version",
+            (key, digest, time.time(), version),
+        )
+
+    def _claim(self):
+        now = time.time()
+
+        def run(conn):
+            row = conn.execute(
+                "SELECT key, payload FROM saves"
+                " WHERE (status = 'pending' AND (last_seen <= ? OR first_seen <= ?))"
+                "    OR (status = 'flushing' AND lease_until < ?)"
+                " ORDER BY first_seen LIMIT 1",
+                (now - self.debounce, now - self.max_delay, now),
+            ).fetchone()
+            if row is not None:
+                conn.execute(
+                    "UPDATE saves SET status = 'flushing', dirty = 0, lease_until = ?, attempts = attempts + 1"
+                    " WHERE key = ?",
+                    (now + self.lease, row[0]),
+                )
+            return row
+
+        return self._transaction(run)
+
+    def _finish(self, key, retry):
+        now = time.time()
+
+        def run(conn):
+            row = conn.execute("SELECT status, dirty, attempts FROM saves WHERE key = ?", (key,)).fetchone()
+            if row is None or row[0] != "flushing":
+                return  # un guardado final lo tomó mientras tanto
+            status, dirty, attempts = row
+            if dirty:
+                conn.execute("UPDATE saves SET status = 'pending', lease_until = NULL, attempts = 0 WHERE key = ?", (key,))
+            elif retry and attempts < self.max_attempts:
+                conn.execute("UPDATE saves SET status = 'pending', lease_until = NULL, first_seen = ?, last_seen = ? WHERE key = ?",
+                             (now, now, key))
+            else:
+                conn.execute(
+                    "UPDATE saves SET status = 'idle', payload = NULL, digest = NULL, lease_until = NULL,"
+                    " attempts = 0 WHERE key = ?",
+                    (key,),
+                )
+
+        self._transaction(run)
+
+    def flush_one(self):
+        """Flush one due save; returns False when none is due."""
+        row = self._claim()
+        if row is None:
+            return False
+        key, payload = row
+        try:
+            status, body = self.handler(json.loads(payload))
+        except Exception as exc:
+            print(f"[coalescer] error al escribir {key}: {exc}")
+            self._finish(key, retry=True)
+            return True
+        # 4xx = payload inválido: reintentar no ayuda.
+        if not 200 <= status < 300:
+            print(f"[coalescer] {key} descartado: {status} {body.get('error') if isinstance(body, dict) else body}")
+        # El hash persistido lo registra el handler al escribir (record).
+        self._finish(key, retry=False)
+        return True
+
+    def drain(self):
+        flushed = 0
+        while self.flush_one():
+            flushed += 1
+        return flushed
+
+    def _loop(self):
+        while not self._stopping:
+            try:
+                if self.flush_one():
+                    continue
+            except Exception as exc:
+                print(f"[coalescer] error: {exc}")
+            with self._wakeup:
+                self._wakeup.wait(timeout=max(0.05, min(self.debounce, self.max_delay) / 4))
+
+    def start(self):
+        if self._thread is not None:
+            return
+        self._stopping = False
+        self._thread = threading.Thread(target=self._loop, name="save-coalescer", daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout=5):
+        self._stopping = True
+        with self._wakeup:
+            self._wakeup.notify_all()
+        if self._thread is not None:
+            self._thread.join(timeout)
+        self._thread = None
@@ -0,0 +1,156 @@
+# compaction.py — retención y compactación de feed_estudios (por dispositivo) y feed_centro
+import fcntl, json, os, threading, time
+from firebase_io import fio
+from push_ids import push_id_timestamp
+
+FEED_MAX_AGE_DAYS = float(os.getenv("FEED_MAX_AGE_DAYS", "90"))
+FEED_MAX_ENTRIES = int(os.getenv("FEED_MAX_ENTRIES", "500"))
+FEED_COMPACTION_BATCH = int(os.getenv("FEED_COMPACTION_BATCH", "20"))  # centros por lote
+FEED_COMPACTION_PAUSE = float(os.getenv("FEED_COMPACTION_PAUSE", "1"))  # segundos entre lotes: alivia RTDB
+FEED_COMPACTION_INTERVAL = float(os.getenv("FEED_COMPACTION_INTERVAL", "0"))  # segundos; 0 = apagado
+FEED_COMPACTION_LOCK = os.getenv("FEED_COMPACTION_LOCK", "/tmp/feed_compaction.lock")
+MAX_PATHS_PER_UPDATE = 500
+
+def entry_timestamp(key, entry):
+    updated_at = entry.get("updatedAt") if isinstance(entry, dict) else None
+    if isinstance(updated_at, (int, float)):
+        return int(updated_at)
+    return push_id_timestamp(key)
+
+def entry_size(key, entry):
+    return len(key) + len(json.dumps(entry, separators=(",", ":"), ensure_ascii=False).encode("utf-8"))
+
+def select_prunable(entries, now_ms, max_age_ms=None, max_count=None):
+    """Return the feed keys to delete.
+
+    Only the newest entry per codigo_unico survives; the survivors are then
+    trimmed by age and by count. The rule depends only on the entries, so every
+    device of a centro converges on the same feed.
+    """
+    if not isinstance(entries, dict):
+        return []
+    ordered = sorted(entries.items(), key=lambda kv: (entry_timestamp(*kv), kv[0]), reverse=True)
+
+    prune, seen, kept = [], set(), []
+    for key, entry in ordered:
+        codigo = entry.get("codigo_unico") if isinstance(entry, dict) else None
+        if codigo not in (None, ""):
+            if codigo in seen:
+                prune.append(key)
+                continue
+            seen.add(codigo)
+        kept.append((key, entry))
+
+    for position, (key, entry) in enumerate(kept):
+        too_old = max_age_ms is not None and now_ms - entry_timestamp(key, entry) > max_age_ms
+        too_many = max_count is not None and position >= max_count
+        if too_old or too_many:
+            prune.append(key)
+    return prune
+
+def _shallow_keys(path):
+    value = fio.get(path, shallow=True)
+    return sorted(value.keys()) if isinstance(value, dict) else []
+
+def compact_centro(centro_id, now_ms=None, max_age_days=FEED_MAX_AGE_DAYS,
+                   max_entries=FEED_MAX_ENTRIES, dry_run=False):
+    """Compact every device feed of one centro and return its stats."""
+    now_ms = int(time.time() * 1000) if now_ms is None else now_ms
+    max_age_ms = int(max_age_days * 86400 * 1000) if max_age_days and max_age_days > 0 else None
+    max_count = max_entries if max_entries and max_entries > 0 else None
+
+    stats = {"centro_id": centro_id, "devices": 0, "entries": 0, "pruned": 0, "bytes": 0}
+    deletes = {}
+    devices = _shallow_keys(f"/ecosistemas/{centro_id}/dispositivos")
+    feeds = fio.map(lambda dev_id: fio.get(f"/ecosistemas/{centro_id}/dispositivos/{dev_id}/feed_estudios"), devices)
+    for dev_id, feed in zip(devices, feeds):
+        if not isinstance(feed, dict):
+            continue
+        stats["devices"] += 1
+        stats["entries"] += len(feed)
+        for key in select_prunable(feed, now_ms, max_age_ms, max_count):
+            stats["pruned"] += 1
+            stats["bytes"] += entry_size(key, feed[key])
+            deletes[f"dispositivos/{dev_id}/feed_estudios/{key}"] = None
+
+    # Feed único del centro (modo "centro"); los cursores no dependen de
+    # que la entrada siga existiendo, así que se poda con la misma regla.
+    feed = fio.get(f"/ecosistemas/{centro_id}/feed_centro")
+    if isinstance(feed, dict):
+        stats["entries"] += len(feed)
+        for key in select_prunable(feed, now_ms, max_age_ms, max_count):
+            stats["pruned"] += 1
+            stats["bytes"] += entry_size(key, feed[key])
+            deletes[f"feed_centro/{key}"] = None
+
+    if deletes and not dry_run:
+        paths = list(deletes)
+        for start in range(0, len(paths), MAX_PATHS_PER_UPDATE):
+            chunk = {path: None for path in paths[start:start + MAX_PATHS_PER_UPDATE]}
+            fio.update(f"/ecosistemas/{centro_id}", chunk)
+    return stats
+
+def compact_all(centros=None, batch_size=FEED_COMPACTION_BATCH, pause=FEED_COMPACTION_PAUSE,
+                start_after=None, dry_run=False, **kwargs):
+    """Compact the given centros (or all of them) in batches of batch_size.
+
+    Centros go in key order with `pause` seconds between batches. After each
+    batch its last centro is logged and kept in summary["last_centro"]; an
+    interrupted run resumes with start_after set to it.
+    """
+    centros = sorted(centros) if centros else _shallow_keys("/ecosistemas")
+    if start_after:
+        centros = [centro_id for centro_id in centros if centro_id > start_after]
+    batch_size = max(1, int(batch_size))
+    summary = {"centros": 0, "devices": 0, "entries": 0, "pruned": 0, "bytes": 0,
+               "dry_run": dry_run, "last_centro": start_after, "detail": []}
+    batches = range(0, len(centros), batch_size)
+    for number, start in enumerate(batches, 1):
+        if number > 1 and pause > 0:
+            time.sleep(pause)
+        batch = centros[start:start + batch_size]
+        for centro_id in batch:
+            try:
+                stats = compact_centro(centro_id, dry_run=dry_run, **kwargs)
+            except Exception as exc:
+                stats = {"centro_id": centro_id, "error": str(exc)}
+            summary["detail"].append(stats)
+            if "error" in stats:
+                continue
+            summary["centros"] += 1
+            for field in ("devices", "entries", "pruned", "bytes"):
+                summary[field] += stats[field]
+        summary["last_centro"] = batch[-1]
+        print(f"[compaction] lote {number}/{len(batches)} hasta {batch[-1]}: pruned={summary['pruned']}")
+    return summary
+
+def run_locked(**kwargs):
+    """Run compact_all unless another worker already holds the lock."""
+    with open(FEED_COMPACTION_LOCK, "a") as lock:
+        try:
+            fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            return None
+        try:
+            return compact_all(**kwargs)
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
+
+def start_scheduler(interval=FEED_COMPACTION_INTERVAL):
+    """Start a daemon thread that compacts every `interval` seconds."""
+    if not interval or interval <= 0:
+        return None
+
+    def loop():
+        while True:
+            time.sleep(interval)
+            try:
+                summary = run_locked()
+                if summary is not None:
+                    print(f"[compaction] centros={summary['centros']} pruned={summary['pruned']} bytes={summary['bytes']}")
+            except Exception as exc:
+                print(f"[compaction] error: {exc}")
+
+    thread = threading.Thread(target=loop, name="feed-compaction", daemon=True)
+    thread.start()
+    return thread
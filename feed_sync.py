@@ -0,0 +1,140 @@
+# feed_sync.py — sincronización incremental del feed por cursor (páginas, long-poll y SSE)
+import json, os, re, threading, time
+import centro_feed
+from firebase_io import fio
+from push_ids import push_id_prefix
+
+FEED_SYNC_PAGE_SIZE = int(os.getenv("FEED_SYNC_PAGE_SIZE", "100"))
+FEED_SYNC_MAX_PAGE = int(os.getenv("FEED_SYNC_MAX_PAGE", "500"))
+FEED_SYNC_MAX_WAIT = float(os.getenv("FEED_SYNC_MAX_WAIT", "25"))  # segundos de long-poll como máximo
+FEED_SYNC_POLL_INTERVAL = float(os.getenv("FEED_SYNC_POLL_INTERVAL", "2"))  # relectura si otro proceso escribe
+FEED_SYNC_SSE_MAX = float(os.getenv("FEED_SYNC_SSE_MAX", "300"))  # un stream SSE se cierra y el cliente reconecta
+FEED_SYNC_HEARTBEAT = float(os.getenv("FEED_SYNC_HEARTBEAT", "15"))
+# Cada long-poll o SSE ocupa un hilo de gthread mientras espera: el tope deja
+# hilos libres para las escrituras. Por defecto, la mitad de GUNICORN_THREADS.
+FEED_SYNC_MAX_STREAMS = int(os.getenv(
+    "FEED_SYNC_MAX_STREAMS", str(max(1, int(os.getenv("GUNICORN_THREADS", "8")) // 2))
+))
+FEED_SYNC_RETRY_AFTER = int(os.getenv("FEED_SYNC_RETRY_AFTER", "5"))
+
+PUSH_ID_RE = re.compile(r"^[-0-9A-Za-z_]{20}$")
+
+class CursorError(ValueError):
+    pass
+
+class Cursor:
+    """Position in a feed.
+
+    A push ID (the `key` of the last entry seen) returns the entries after
+    it. An updatedAt in milliseconds maps to the time prefix of the push IDs
+    and returns entries from that millisecond on: entries sharing it are
+    resent rather than lost, so clients dedupe by key.
+    """
+
+    def __init__(self, raw=None):
+        self.raw = None if raw in (None, "") else str(raw).strip()
+        self.start = self.exclude = None
+        if self.raw is None:
+            return
+        if PUSH_ID_RE.match(self.raw):
+            self.start = self.exclude = self.raw
+        elif self.raw.isdigit():
+            self.start = push_id_prefix(int(self.raw))
+        else:
+            raise CursorError("cursor debe ser un push ID o un updatedAt en milisegundos")
+
+def feed_path(centro_id, device_id):
+    """The feed a device reads: feed_centro once its centro switched, else its own copy."""
+    if centro_feed.reads_centro_feed(centro_id, device_id):
+        return centro_feed.centro_feed_path(centro_id)
+    return centro_feed.device_feed_path(centro_id, device_id)
+
+def fetch_page(centro_id, device_id, cursor, limit=FEED_SYNC_PAGE_SIZE):
+    """Return (items, next_cursor, has_more) for the entries after `cursor`."""
+    extra = 1 if cursor.exclude else 0
+    entries = fio.query(feed_path(centro_id, device_id), start_at=cursor.start, limit_to_first=limit + 1 + extra)
+    ordered = [(key, entries[key]) for key in sorted(entries) if key != cursor.exclude]
+    has_more = len(ordered) > limit
+    ordered = ordered[:limit]
+    items = [{"key": key, "data": value} for key, value in ordered]
+    next_cursor = ordered[-1][0] if ordered else cursor.raw
+    return items, next_cursor, has_more
+
+class FeedNotifier:
+    """Wakes waiting readers when this process writes to a centro's feeds.
+
+    Writes made by other workers are picked up by the periodic re-read.
+    """
+
+    def __init__(self):
+        self._condition = threading.Condition()
+        self._versions = {}
+
+    def version(self, centro_id):
+        with self._condition:
+            return self._versions.get(centro_id, 0)
+
+    def notify(self, centro_id):
+        with self._condition:
+            self._versions[centro_id] = self._versions.get(centro_id, 0) + 1
+            self._condition.notify_all()
+
+    def wait(self, centro_id, seen_version, timeout):
+        with self._condition:
+            return self._condition.wait_for(lambda: self._versions.get(centro_id, 0) != seen_version, timeout)
+
+notifier = FeedNotifier()
+
+class StreamSlots:
+    """Per-process cap on requests parked in a long-poll or an SSE stream."""
+
+    def __init__(self, limit):
+        self._slots = threading.BoundedSemaphore(max(1, limit))
+
+    def acquire(self):
+        return self._slots.acquire(blocking=False)
+
+    def release(self):
+        self._slots.release()
+
+stream_slots = StreamSlots(FEED_SYNC_MAX_STREAMS)
+
+def wait_for_page(centro_id, device_id, cursor, limit, wait):
+    """Long-poll: return the first non-empty page, or an empty one after `wait` seconds."""
+    deadline = time.monotonic() + max(0.0, wait)
+    while True:
+        seen = notifier.version(centro_id)
+        items, next_cursor, has_more = fetch_page(centro_id, device_id, cursor, limit)
+        remaining = deadline - time.monotonic()
+        if items or remaining <= 0:
+            return items, next_cursor, has_more
+        notifier.wait(centro_id, seen, min(FEED_SYNC_POLL_INTERVAL, remaining))
+
+def _event(name, data, event_id=None):
+    payload = json.dumps(data, separators=(",", ":"), ensure_ascii=False)
+    return (f"id: {event_id}\n" if event_id else "") + f"event: {name}\ndata: {payload}\n\n"
+
+def stream_events(centro_id, device_id, cursor, limit, duration=None):
+    """Server-Sent Events: one `estudio` event per entry, ids usable as Last-Event-ID."""
+    duration = FEED_SYNC_SSE_MAX if duration is None else duration
+    deadline = time.monotonic() + duration
+    yield "retry: 3000\n\n"
+    last_sent = time.monotonic()
+    while time.monotonic() < deadline:
+        seen = notifier.version(centro_id)
+        items, next_cursor, has_more = fetch_page(centro_id, device_id, cursor, limit)
+        for item in items:
+            yield _event("estudio", item["data"], item["key"])
+        if items:
+            cursor = Cursor(next_cursor)
+            last_sent = time.monotonic()
+            if has_more:
+                continue
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            break
+        notifier.wait(centro_id, seen, min(FEED_SYNC_POLL_INTERVAL, FEED_SYNC_HEARTBEAT, remaining))
+        if time.monotonic() - last_sent >= FEED_SYNC_HEARTBEAT:
+            yield ": ping\n\n"
+            last_sent = time.monotonic()
+    yield _event("fin", {"next_cursor": cursor.raw})
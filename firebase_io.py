@@ -0,0 +1,191 @@
+# firebase_io.py — capa única de E/S hacia RTDB: pool de hilos acotado,
+# conexiones keep-alive dimensionadas al pool y timeout por operación.
+import contextvars, os, threading, time
+from concurrent.futures import Future, ThreadPoolExecutor, TimeoutError as FutureTimeout
+from metrics import firebase_op
+import profiling
+from storage import FirebaseStore
+
+FIREBASE_IO_CONCURRENCY = int(os.getenv("FIREBASE_IO_CONCURRENCY", "16"))
+FIREBASE_IO_TIMEOUT = float(os.getenv("FIREBASE_IO_TIMEOUT", "15"))  # segundos por operación
+FIREBASE_HTTP_POOL = int(os.getenv("FIREBASE_HTTP_POOL", str(FIREBASE_IO_CONCURRENCY)))
+
+class FirebaseTimeout(TimeoutError):
+    pass
+
+class FirebaseIO:
+    """Runs RTDB operations on a bounded pool so independent ones overlap.
+
+    Calls made from inside a pool thread run inline, so helpers that do I/O
+    can themselves be submitted without risking pool starvation. The backend
+    (`store`, Firebase by default) is initialized on first use through the
+    configured initializer.
+    """
+
+    def __init__(self, concurrency=FIREBASE_IO_CONCURRENCY, timeout=FIREBASE_IO_TIMEOUT,
+                 http_pool=FIREBASE_HTTP_POOL):
+        self.concurrency = max(1, concurrency)
+        self.timeout = timeout
+        self.http_pool = max(1, http_pool)
+        self._executor = None
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._pool_configured = False
+        self._init_lock = threading.Lock()
+        self.initializer = None
+        self.store = FirebaseStore()
+        self.ready = False
+        self.init_ms = None
+
+    def _pool(self):
+        if self._executor is None:
+            with self._lock:
+                if self._executor is None:
+                    self._executor = ThreadPoolExecutor(
+                        max_workers=self.concurrency,
+                        thread_name_prefix="firebase-io",
+                        initializer=self._mark_worker,
+                    )
+        return self._executor
+
+    def _mark_worker(self):
+        self._local.worker = True
+
+    def configure(self, initializer=None, store=None):
+        self.initializer = initializer
+        if store is not None:
+            self.store = store
+
+    def ensure_ready(self):
+        """Run the initializer once (lazily, or from the gunicorn post_fork hook)."""
+        if self.ready:
+            return
+        with self._init_lock:
+            if self.ready:
+                return
+            started = time.perf_counter()
+            if self.initializer is not None:
+                self.initializer()
+            self.configure_http_pool()
+            self.init_ms = round((time.perf_counter() - started) * 1000, 1)
+            self.ready = True
+
+    def configure_http_pool(self):
+        """Size the keep-alive pool of firebase-admin's session to the thread pool.
+
+        requests keeps at most 10 connections per host by default, which would
+        serialize a wider thread pool behind connection setup.
+        """
+        if self._pool_configured or not hasattr(self.store, "http_session"):
+            return
+        self._pool_configured = True
+        try:
+            import requests
+            from firebase_admin import _http_client
+            session = self.store.http_session()
+            adapter = requests.adapters.HTTPAdapter(
+                pool_connections=4,
+                pool_maxsize=self.http_pool,
+                max_retries=_http_client.DEFAULT_RETRY_CONFIG,
+            )
+            session.mount("https://", adapter)
+            session.mount("http://", adapter)
+        except Exception as exc:
+            print(f"[firebase_io] no se pudo ajustar el pool HTTP: {exc}")
+
+    def reference(self, path):
+        self.ensure_ready()
+        return self.store.reference(path)
+
+    def submit(self, fn, *args, **kwargs):
+        """Schedule fn on the pool (inline when already on a pool thread).
+
+        The caller's context travels with fn, so per-request state such as
+        the active profile is visible on the pool thread.
+        """
+        if getattr(self._local, "worker", False):
+            future = Future()
+            try:
+                future.set_result(fn(*args, **kwargs))
+            except BaseException as exc:
+                future.set_exception(exc)
+            return future
+        return self._pool().submit(contextvars.copy_context().run, fn, *args, **kwargs)
+
+    def wait(self, future, timeout=None):
+        """Result of a future, cancelling it if the per-operation timeout expires."""
+        try:
+            return future.result(timeout=self.timeout if timeout is None else timeout)
+        except FutureTimeout:
+            future.cancel()
+            raise FirebaseTimeout("Tiempo de espera agotado con Firebase") from None
+
+    def gather(self, *futures, timeout=None):
+        """Wait for several futures; on the first error the rest are cancelled."""
+        try:
+            return [self.wait(future, timeout) for future in futures]
+        except BaseException:
+            for future in futures:
+                future.cancel()
+            raise
+
+    def map(self, fn, items, timeout=None):
+        return self.gather(*[self.submit(fn, item) for item in items], timeout=timeout)
+
+    def call(self, fn, *args, timeout=None, **kwargs):
+        return self.wait(self.submit(fn, *args, **kwargs), timeout)
+
+    # Operaciones RTDB (medidas en el hilo que las ejecuta, sin la espera en cola)
+    def _op(self, op, path, fn, timeout):
+        def run():
+            started = time.perf_counter()
+            error = None
+            try:
+                with firebase_op(op):
+                    return fn()
+            except Exception as exc:
+                error = type(exc).__name__
+                raise
+            finally:
+                profiling.record_firebase(op, path, time.perf_counter() - started, error)
+        return self.call(run, timeout=timeout)
+
+    def get(self, path, shallow=False, timeout=None):
+        return self._op("get", path, lambda: self.reference(path).get(shallow=shallow), timeout)
+
+    def set(self, path, value, timeout=None):
+        return self._op("set", path, lambda: self.reference(path).set(value), timeout)
+
+    def update(self, path, value, timeout=None):
+        return self._op("update", path, lambda: self.reference(path).update(value), timeout)
+
+    def transaction(self, path, update, timeout=None):
+        """Compare-and-set on one node: update(current) returns the new value or raises to abort."""
+        return self._op("transaction", path, lambda: self.reference(path).transaction(update), timeout)
+
+    def query(self, path, start_at=None, end_at=None, limit_to_first=None, limit_to_last=None, timeout=None,
+              order_by=None, equal_to=None):
+        """Children of `path` ordered by key (or by child `order_by`), optionally bounded and limited."""
+        def run():
+            reference = self.reference(path)
+            query = reference.order_by_key() if order_by is None else reference.order_by_child(order_by)
+            if equal_to is not None:
+                query = query.equal_to(equal_to)
+            if start_at is not None:
+                query = query.start_at(start_at)
+            if end_at is not None:
+                query = query.end_at(end_at)
+            if limit_to_first is not None:
+                query = query.limit_to_first(limit_to_first)
+            if limit_to_last is not None:
+                query = query.limit_to_last(limit_to_last)
+            value = query.get()
+            return dict(value) if isinstance(value, dict) else {}
+        return self._op("query", path, run, timeout)
+
+    def listen(self, path, callback):
+        # Los listeners abren su propia sesión de streaming; no usan el pool.
+        with firebase_op("listen"):
+            return self.reference(path).listen(callback)
+
+fio = FirebaseIO()
@@ -0,0 +1,46 @@
+# gunicorn.conf.py — arranque rápido: app precargada en el master, Firebase y
+# hilos de fondo por worker en post_fork (los hilos y sockets no sobreviven al fork).
+import os, shutil, time
+
+# app.py no arranca hilos al importarse; los arranca post_fork en cada worker.
+os.environ.setdefault("BACKGROUND_ON_IMPORT", "0")
+# Métricas Prometheus agregadas entre workers (ver metrics.py). Se limpia antes
+# de precargar la app: archivos de una ejecución anterior falsearían los contadores.
+os.environ.setdefault("PROMETHEUS_MULTIPROC_DIR", "/tmp/servidor_sync_metrics")
+shutil.rmtree(os.environ["PROMETHEUS_MULTIPROC_DIR"], ignore_errors=True)
+os.makedirs(os.environ["PROMETHEUS_MULTIPROC_DIR"], exist_ok=True)
+
+bind = f"0.0.0.0:{os.getenv('PORT', '8080')}"
+# Trabajo dominado por E/S (RTDB): pocos procesos con varios hilos cada uno.
+worker_class = "gthread"
+workers = int(os.getenv("WEB_CONCURRENCY", "2"))
+threads = int(os.getenv("GUNICORN_THREADS", "8"))
+# Una escritura solo invalida la caché de lecturas del worker que la atendió:
+# con varios workers la caché por proceso serviría borradores viejos, así que
+# por defecto se comparte en SQLite local (ver read_cache.py).
+if workers > 1:
+    os.environ.setdefault("READ_CACHE_BACKEND", "sqlite")
+preload_app = os.getenv("GUNICORN_PRELOAD", "1") == "1"
+timeout = int(os.getenv("GUNICORN_TIMEOUT", "60"))
+graceful_timeout = 20
+keepalive = 5
+accesslog = "-" if os.getenv("GUNICORN_ACCESS_LOG") == "1" else None
+
+_started = time.perf_counter()
+
+def when_ready(server):
+    server.log.info("[boot] master listo en %.0f ms", (time.perf_counter() - _started) * 1000)
+
+def post_fork(server, worker):
+    import threading
+    import app as service
+
+    service.start_background()
+    # El calentamiento (credenciales + primera ida y vuelta a RTDB) corre en
+    # segundo plano para que el worker acepte tráfico de inmediato.
+    threading.Thread(target=service.warm_up, name="firebase-warmup", daemon=True).start()
+    server.log.info("[boot] worker %s listo en %.0f ms", worker.pid, (time.perf_counter() - _started) * 1000)
+
+def child_exit(server, worker):
+    import metrics
+    metrics.mark_process_dead(worker.pid)
@@ -0,0 +1,269 @@
+# http_codec.py — JSON rápido (orjson con respaldo stdlib) y compresión HTTP en ambos sentidos
+import decimal, gzip, io, json, os, zlib
+from flask import Response, request
+from flask.json.provider import DefaultJSONProvider
+from werkzeug.exceptions import BadRequest, RequestEntityTooLarge
+
+JSON_CODEC = os.getenv("JSON_CODEC", "orjson")  # orjson | stdlib
+COMPRESS_ENABLED = os.getenv("COMPRESS_ENABLED", "1") == "1"
+COMPRESS_MIN_BYTES = int(os.getenv("COMPRESS_MIN_BYTES", "1024"))
+COMPRESS_STREAM_BYTES = int(os.getenv("COMPRESS_STREAM_BYTES", str(1024 * 1024)))  # por encima: por bloques
+COMPRESS_CHUNK_BYTES = 64 * 1024
+GZIP_LEVEL = int(os.getenv("GZIP_LEVEL", "6"))
+BROTLI_QUALITY = int(os.getenv("BROTLI_QUALITY", "5"))
+REQUEST_MAX_DECOMPRESSED_BYTES = int(os.getenv("REQUEST_MAX_DECOMPRESSED_BYTES", str(32 * 1024 * 1024)))
+COMPRESSIBLE_TYPES = ("application/json", "text/plain", "text/html", "text/csv")
+
+try:
+    import orjson
+except ImportError:  # dependencia opcional: sin ella se usa el json de Flask
+    orjson = None
+
+try:
+    import brotli
+except ImportError:  # dependencia opcional: sin ella solo se negocia gzip
+    brotli = None
+
+def _orjson_default(value):
+    if isinstance(value, decimal.Decimal):
+        return str(value)
+    if isinstance(value, (set, frozenset)):
+        return list(value)
+    raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
+
+class OrjsonProvider(DefaultJSONProvider):
+    """Flask JSON provider backed by orjson; odd values fall back to stdlib."""
+
+    def _options(self):
+        option = orjson.OPT_NON_STR_KEYS
+        if self.sort_keys:
+            option |= orjson.OPT_SORT_KEYS
+        return option
+
+    def dumps(self, obj, **kwargs):
+        if kwargs:
+            return super().dumps(obj, **kwargs)
+        try:
+            return orjson.dumps(obj, default=_orjson_default, option=self._options()).decode("utf-8")
+        except TypeError:  # p. ej. enteros de más de 64 bits
+            return super().dumps(obj)
+
+    def loads(self, s, **kwargs):
+        if kwargs:
+            return super().loads(s, **kwargs)
+        try:
+            return orjson.loads(s)
+        except orjson.JSONDecodeError:  # p. ej. enteros de más de 64 bits o NaN
+            return super().loads(s)
+
+    def response(self, *args, **kwargs):
+        obj = self._prepare_response_obj(args, kwargs)
+        try:
+            body = orjson.dumps(obj, default=_orjson_default, option=self._options())
+        except TypeError:
+            body = super().dumps(obj).encode("utf-8")
+        return self._app.response_class(body + b"\n", mimetype=self.mimetype)
+
+# Peticiones comprimidas (Content-Encoding: gzip | deflate | br)
+def _decompressor(encoding):
+    if encoding in ("gzip", "x-gzip"):
+        return zlib.decompressobj(16 + zlib.MAX_WBITS)
+    if encoding == "deflate":
+        return zlib.decompressobj()
+    if encoding == "br" and brotli is not None:
+        return brotli.Decompressor()
+    return None
+
+class DecompressRequestMiddleware:
+    """WSGI middleware that inflates compressed request bodies as they are read, with a size cap."""
+
+    def __init__(self, wsgi_app, max_bytes=REQUEST_MAX_DECOMPRESSED_BYTES):
+        self.wsgi_app = wsgi_app
+        self.max_bytes = max_bytes
+
+    def __call__(self, environ, start_response):
+        encoding = environ.get("HTTP_CONTENT_ENCODING", "").strip().lower()
+        if not encoding or encoding == "identity":
+            return self.wsgi_app(environ, start_response)
+        decompressor = _decompressor(encoding)
+        if decompressor is None:
+            body = _error_body(f"Content-Encoding no soportado: {encoding}")
+            start_response("415 Unsupported Media Type", [
+                ("Content-Type", "application/json"), ("Content-Length", str(len(body))),
+            ])
+            return [body]
+
+        # El cuerpo se infla a medida que la vista lo lee (las subidas van por
+        # bloques a disco), así que nunca se arma completo en memoria. El
+        # largo descomprimido no se conoce de antemano: la entrada se declara
+        # terminada en vez de fijar CONTENT_LENGTH.
+        environ = dict(environ)
+        environ.pop("HTTP_CONTENT_ENCODING", None)
+        remaining = int(environ.pop("CONTENT_LENGTH", None) or 0) or None
+        environ["wsgi.input"] = InflatingStream(environ["wsgi.input"], remaining, decompressor, self.max_bytes)
+        environ["wsgi.input_terminated"] = True
+        return self.wsgi_app(environ, start_response)
+
+class InflatingStream(io.RawIOBase):
+    """Readable stream that decompresses `source` lazily and refuses to grow past `max_bytes`."""
+
+    def __init__(self, source, remaining, decompressor, max_bytes):
+        self._source = source
+        self._remaining = remaining
+        self._decompressor = decompressor
+        self._budget = max_bytes
+        self._pending = b""
+        self._tail = b""
+        self._eof = False
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        try:
+            while not self._pending and not self._eof:
+                self._pending = self._inflate()
+        except _TooLarge:
+            raise RequestEntityTooLarge(response=_error_response(
+                413, "El cuerpo descomprimido excede el tamaño permitido"
+            )) from None
+        except (zlib.error, OSError, getattr(brotli, "error", OSError)) as exc:
+            raise BadRequest(response=_error_response(400, f"Cuerpo comprimido inválido: {exc}")) from None
+        size = min(len(buffer), len(self._pending))
+        buffer[:size] = self._pending[:size]
+        self._pending = self._pending[size:]
+        return size
+
+    def _inflate(self):
+        decompressor = self._decompressor
+        if self._tail:  # zlib: resto de un bloque que se infló por partes
+            data = decompressor.decompress(self._tail, COMPRESS_CHUNK_BYTES)
+            self._tail = decompressor.unconsumed_tail
+        else:
+            size = COMPRESS_CHUNK_BYTES if self._remaining is None else min(COMPRESS_CHUNK_BYTES, self._remaining)
+            chunk = self._source.read(size) if size else b""
+            if self._remaining is not None:
+                self._remaining -= len(chunk)
+            if not chunk:
+                self._eof = True
+                data = decompressor.flush() if hasattr(decompressor, "flush") else b""
+            elif hasattr(decompressor, "unconsumed_tail"):  # zlib
+                data = decompressor.decompress(chunk, COMPRESS_CHUNK_BYTES)
+                self._tail = decompressor.unconsumed_tail
+            else:  # brotli
+                data = decompressor.process(chunk)
+        # Se infla con tope para no expandir una "bomba" sin límite.
+        if len(data) > self._budget:
+            raise _TooLarge()
+        self._budget -= len(data)
+        return data
+
+def _error_body(message):
+    return json.dumps({"ok": False, "error": message}).encode("utf-8")
+
+def _error_response(status, message):
+    return Response(_error_body(message), status=status, mimetype="application/json")
+
+class _TooLarge(Exception):
+    pass
+
+# Respuestas comprimidas según Accept-Encoding
+def negotiate_encoding(accept_encoding):
+    """Pick br or gzip from an Accept-Encoding header (honouring q=0)."""
+    accepted = {}
+    for part in (accept_encoding or "").split(","):
+        name, _, params = part.strip().partition(";")
+        name = name.strip().lower()
+        if not name:
+            continue
+        q = 1.0
+        for param in params.split(";"):
+            key, _, value = param.strip().partition("=")
+            if key == "q":
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0.0
+        accepted[name] = q
+    wildcard = accepted.get("*", 0.0)
+    candidates = (["br"] if brotli is not None else []) + ["gzip"]
+    ranked = [(accepted.get(name, wildcard), -index, name) for index, name in enumerate(candidates)]
+    best = max(ranked)
+    return best[2] if best[0] > 0 else None
+
+def _compressor(encoding):
+    if encoding == "br":
+        return brotli.Compressor(quality=BROTLI_QUALITY)
+    return zlib.compressobj(GZIP_LEVEL, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+
+def _compress_all(encoding, data):
+    if encoding == "br":
+        return brotli.compress(data, quality=BROTLI_QUALITY)
+    return gzip.compress(data, GZIP_LEVEL)
+
+def _compress_stream(encoding, chunks):
+    compressor = _compressor(encoding)
+    compress = compressor.process if encoding == "br" else compressor.compress
+    for chunk in chunks:
+        if isinstance(chunk, str):
+            chunk = chunk.encode("utf-8")
+        data = compress(chunk)
+        if data:
+            yield data
+    yield compressor.finish() if encoding == "br" else compressor.flush()
+
+def _slices(data):
+    for start in range(0, len(data), COMPRESS_CHUNK_BYTES):
+        yield data[start:start + COMPRESS_CHUNK_BYTES]
+
+def compress_response(response):
+    """after_request hook: compress textual responses the client accepts."""
+    if (
+        not COMPRESS_ENABLED
+        or request.method == "HEAD"
+        or response.status_code < 200 or response.status_code in (204, 206, 304)
+        or "Content-Encoding" in response.headers
+        or response.mimetype not in COMPRESSIBLE_TYPES
+        or response.direct_passthrough
+    ):
+        return response
+    response.vary.add("Accept-Encoding")
+    encoding = negotiate_encoding(request.headers.get("Accept-Encoding"))
+    if encoding is None:
+        return response
+    length = response.calculate_content_length()
+    if length is not None and length < COMPRESS_MIN_BYTES:
+        return response
+
+    if length is not None and length <= COMPRESS_STREAM_BYTES:
+        response.set_data(_compress_all(encoding, response.get_data()))
+    else:
+        # Cuerpos grandes o en streaming: se comprimen por bloques y se envían
+        # con transfer-encoding chunked en vez de armar todo en memoria.
+        source = _slices(response.get_data()) if length is not None else response.response
+        response.response = _compress_stream(encoding, source)
+        response.headers.pop("Content-Length", None)
+    response.headers["Content-Encoding"] = encoding
+    etag, weak = response.get_etag()
+    if etag and not weak:
+        response.set_etag(etag, weak=True)
+    return response
+
+def read_inflated_body():
+    """before_request hook: inflate non-multipart bodies up front so a bad body answers 400/413.
+
+    Views parse JSON inside broad try/except blocks; reading here keeps those
+    errors from being reported as "JSON inválido". Multipart uploads are left
+    to stream (and fail) while the form is parsed.
+    """
+    if isinstance(request.environ.get("wsgi.input"), InflatingStream) and request.mimetype != "multipart/form-data":
+        request.get_data(cache=True)
+
+def init_app(app):
+    if JSON_CODEC == "orjson" and orjson is not None:
+        app.json = OrjsonProvider(app)
+    elif JSON_CODEC not in ("orjson", "stdlib"):
+        raise RuntimeError(f"JSON_CODEC desconocido: {JSON_CODEC}")
+    app.wsgi_app = DecompressRequestMiddleware(app.wsgi_app)
+    app.before_request(read_inflated_body)
+    app.after_request(compress_response)
@@ -0,0 +1,101 @@
+# manage.py — tareas de mantenimiento: python manage.py <comando> --help
+import argparse, json, sys
+
+def cmd_compact_feeds(args):
+    import app  # noqa: F401 — inicializa Firebase
+    import compaction
+
+    summary = compaction.compact_all(
+        centros=args.centro or None,
+        batch_size=args.batch_size,
+        pause=args.pause,
+        start_after=args.start_after,
+        dry_run=args.dry_run,
+        max_age_days=args.max_age_days,
+        max_entries=args.max_entries,
+    )
+    if not args.verbose:
+        summary.pop("detail", None)
+    print(json.dumps(summary, indent=2, ensure_ascii=False))
+    return 0
+
+def cmd_migrate_attachments(args):
+    import app  # inicializa Firebase
+    import blob_store
+
+    # La caché de lectura guarda los adjuntos con su base64: se descartan al migrarlos.
+    summary = blob_store.migrate_rtdb_attachments(centros=args.centro or None, dry_run=args.dry_run,
+                                                  on_migrated=app.invalidate_stored_attachment)
+    print(json.dumps(summary, indent=2, ensure_ascii=False))
+    return 1 if summary["errors"] else 0
+
+def cmd_migrate_centro_feed(args):
+    import app  # noqa: F401 — inicializa Firebase
+    import centro_feed
+    import compaction
+
+    centros = args.centro or compaction._shallow_keys("/ecosistemas")
+    legacy = [] if args.no_legacy else args.legacy_device
+    summary = {"centros": 0, "entries": 0, "dropped": 0, "errors": 0, "dry_run": args.dry_run, "detail": []}
+    for centro_id in centros:
+        try:
+            stats = centro_feed.migrate_centro(
+                centro_id,
+                legacy=legacy,
+                drop_device_feeds=args.drop_device_feeds,
+                settle=args.settle,
+                dry_run=args.dry_run,
+            )
+        except Exception as exc:
+            stats = {"centro_id": centro_id, "error": str(exc)}
+            summary["errors"] += 1
+        else:
+            summary["centros"] += 1
+            summary["entries"] += stats["entries"]
+            summary["dropped"] += stats["dropped"]
+        summary["detail"].append(stats)
+    print(json.dumps(summary, indent=2, ensure_ascii=False))
+    return 1 if summary["errors"] else 0
+
+def build_parser():
+    from compaction import FEED_COMPACTION_BATCH, FEED_COMPACTION_PAUSE, FEED_MAX_AGE_DAYS, FEED_MAX_ENTRIES
+    from centro_feed import FEED_CONFIG_TTL
+
+    parser = argparse.ArgumentParser(prog="manage.py")
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    compact = sub.add_parser("compact-feeds", help="Poda feed_estudios por antigüedad y cantidad")
+    compact.add_argument("--centro", action="append", help="centro_id a compactar (repetible; por defecto todos)")
+    compact.add_argument("--batch-size", type=int, default=FEED_COMPACTION_BATCH)
+    compact.add_argument("--pause", type=float, default=FEED_COMPACTION_PAUSE, help="Segundos entre lotes")
+    compact.add_argument("--start-after", help="Retoma después de este centro_id (last_centro de una corrida cortada)")
+    compact.add_argument("--max-age-days", type=float, default=FEED_MAX_AGE_DAYS)
+    compact.add_argument("--max-entries", type=int, default=FEED_MAX_ENTRIES)
+    compact.add_argument("--dry-run", action="store_true", help="Solo reporta lo que se borraría")
+    compact.add_argument("--verbose", action="store_true", help="Incluye el detalle por centro")
+    compact.set_defaults(func=cmd_compact_feeds)
+
+    migrate = sub.add_parser("migrate-attachments", help="Mueve adjuntos content_base64 de RTDB al blob store")
+    migrate.add_argument("--centro", action="append", help="centro_id a migrar (repetible; por defecto todos)")
+    migrate.add_argument("--dry-run", action="store_true", help="Solo cuenta los registros pendientes")
+    migrate.set_defaults(func=cmd_migrate_attachments)
+
+    feed = sub.add_parser("migrate-centro-feed", help="Pasa centros al feed único (feed_centro) con cursor por dispositivo")
+    feed.add_argument("--centro", action="append", help="centro_id a migrar (repetible; por defecto todos)")
+    feed.add_argument("--legacy-device", action="append",
+                      help="Equipo que sigue recibiendo copia en feed_estudios (repetible; por defecto todos)")
+    feed.add_argument("--no-legacy", action="store_true", help="Ningún equipo conserva la copia por dispositivo")
+    feed.add_argument("--drop-device-feeds", action="store_true",
+                      help="Borra feed_estudios de los equipos que ya no son legacy")
+    feed.add_argument("--settle", type=float, default=FEED_CONFIG_TTL,
+                      help="Segundos antes de la segunda pasada (escrituras con configuración en caché)")
+    feed.add_argument("--dry-run", action="store_true", help="Solo cuenta las entradas por migrar")
+    feed.set_defaults(func=cmd_migrate_centro_feed)
+    return parser
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    return args.func(args)
+
+if __name__ == "__main__":
+    sys.exit(main())
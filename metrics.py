@@ -0,0 +1,96 @@
+# metrics.py — métricas Prometheus (latencias por ruta, E/S de Firebase, fan-out, tamaños)
+import os, time
+from contextlib import contextmanager
+
+# En modo multiproceso (gunicorn) cada worker escribe en PROMETHEUS_MULTIPROC_DIR
+# y /metrics agrega todos los archivos; la variable debe existir antes de importar.
+from prometheus_client import (
+    CONTENT_TYPE_LATEST, REGISTRY, CollectorRegistry, Counter, Gauge, Histogram, generate_latest,
+)
+
+MULTIPROC_DIR = os.getenv("PROMETHEUS_MULTIPROC_DIR")
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+SIZE_BUCKETS = (256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304, 16777216)
+FANOUT_BUCKETS = (1, 2, 3, 5, 8, 13, 21, 34, 55, 89, 144)
+
+REQUEST_LATENCY = Histogram(
+    "http_request_duration_seconds", "Request latency by route.",
+    ["route", "method"], buckets=LATENCY_BUCKETS,
+)
+REQUESTS = Counter(
+    "http_requests_total", "Requests by route and status code.",
+    ["route", "method", "status"],
+)
+IN_FLIGHT = Gauge(
+    "http_requests_in_flight", "Requests being served right now.",
+    ["route"], multiprocess_mode="livesum",
+)
+PAYLOAD_BYTES = Histogram(
+    "http_request_payload_bytes", "Request body size by route.",
+    ["route"], buckets=SIZE_BUCKETS,
+)
+FIREBASE_LATENCY = Histogram(
+    "firebase_op_duration_seconds", "RTDB operation latency.",
+    ["op"], buckets=LATENCY_BUCKETS,
+)
+FIREBASE_ERRORS = Counter(
+    "firebase_op_errors_total", "RTDB operations that raised.",
+    ["op"],
+)
+FANOUT_DEVICES = Histogram(
+    "feed_fanout_devices", "Devices a report is fanned out to.",
+    buckets=FANOUT_BUCKETS,
+)
+# Sin etiqueta de centro: centro_id llega en el payload y su cardinalidad no
+# tiene tope (cada valor nuevo crearía series en los archivos de cada worker).
+FANOUT_ENTRIES = Counter(
+    "feed_fanout_entries_total", "Feed entries written.",
+)
+ADMISSION_REJECTED = Counter(
+    "admission_rejected_total", "Write requests shed with 429, by limit hit.",
+    ["reason"],
+)
+AUTOSAVES = Counter(
+    "autosaves_total", "Report saves seen by the autosave coalescer, by outcome.",
+    ["outcome"],
+)
+ATTACHMENT_BYTES = Histogram(
+    "attachment_bytes", "Uploaded attachment size.",
+    ["tipo"], buckets=SIZE_BUCKETS,
+)
+
+@contextmanager
+def firebase_op(op):
+    """Time one RTDB operation and count it as an error if it raises."""
+    started = time.perf_counter()
+    try:
+        yield
+    except BaseException:
+        FIREBASE_ERRORS.labels(op).inc()
+        raise
+    finally:
+        FIREBASE_LATENCY.labels(op).observe(time.perf_counter() - started)
+
+def observe_fanout(devices, entries=None):
+    """Record one report reaching `devices` through `entries` feed writes (one per device by default)."""
+    FANOUT_DEVICES.observe(devices)
+    entries = devices if entries is None else entries
+    if entries:
+        FANOUT_ENTRIES.inc(entries)
+
+def render():
+    """Return (body, content_type) for the /metrics endpoint."""
+    if MULTIPROC_DIR:
+        from prometheus_client import multiprocess
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    else:
+        registry = REGISTRY
+    return generate_latest(registry), CONTENT_TYPE_LATEST
+
+def mark_process_dead(pid):
+    """Drop a dead worker's live gauges (gunicorn child_exit hook)."""
+    if MULTIPROC_DIR:
+        from prometheus_client import multiprocess
+        multiprocess.mark_process_dead(pid)
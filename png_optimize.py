@@ -0,0 +1,391 @@
+# png_optimize.py — recompresión PNG sin pérdida (filtros, zlib 9, paleta/gris) en un proceso aparte
+import hashlib, multiprocessing, os, struct, sys, zlib
+from array import array
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+
+PNG_OPTIMIZE = os.getenv("PNG_OPTIMIZE", "0") == "1"
+PNG_OPTIMIZE_REDUCE = os.getenv("PNG_OPTIMIZE_REDUCE", "1") == "1"  # paleta / gris / sin alfa, solo si no hay pérdida
+PNG_OPTIMIZE_MAX_PIXELS = int(os.getenv("PNG_OPTIMIZE_MAX_PIXELS", str(16 * 1024 * 1024)))
+# El códec es Python puro (~3.5 s por megapíxel con el GIL tomado): corre en un
+# proceso hijo con tiempo y memoria acotados para no frenar los hilos de gunicorn.
+PNG_OPTIMIZE_TIMEOUT = float(os.getenv("PNG_OPTIMIZE_TIMEOUT", "120"))  # segundos
+PNG_OPTIMIZE_MEMORY_MB = int(os.getenv("PNG_OPTIMIZE_MEMORY_MB", "1024"))  # espacio de direcciones del hijo; 0 = sin tope
+PNG_OPTIMIZE_LEVEL = 9
+PNG_SIGNATURE = b"\x89PNG\r\n\x1a\n"
+CHANNELS = {0: 1, 2: 3, 3: 1, 4: 2, 6: 4}
+# Chunks auxiliares que cambian cómo se ven los píxeles; el resto (texto,
+# fechas, pHYs, bKGD...) se descarta.
+COLOR_CHUNKS = (b"gAMA", b"cHRM", b"sRGB", b"iCCP")
+IDAT_CHUNK_BYTES = 1024 * 1024
+
+class PNGError(ValueError):
+    pass
+
+class Image:
+    """A decoded, non-interlaced PNG: unfiltered scanlines plus palette data."""
+
+    def __init__(self, width, height, bit_depth, color_type, rows, palette=None, trns=None, color_chunks=()):
+        self.width = width
+        self.height = height
+        self.bit_depth = bit_depth
+        self.color_type = color_type
+        self.rows = rows
+        self.palette = palette
+        self.trns = trns
+        self.color_chunks = list(color_chunks)
+
+    @property
+    def bpp(self):
+        return max(1, CHANNELS[self.color_type] * self.bit_depth // 8)
+
+# Aritmética byte a byte (mód 256) sobre enteros grandes: cada fila se filtra
+# con unas pocas operaciones en C en vez de un bucle por byte.
+@lru_cache(maxsize=64)
+def _masks(n):
+    return int.from_bytes(b"\x7f" * n, "little"), int.from_bytes(b"\x80" * n, "little"), (1 << (8 * n)) - 1
+
+def _add(x, y, low, high):
+    return ((x & low) + (y & low)) ^ ((x ^ y) & high)
+
+def _sub(x, y, low, high):
+    return ((x | high) - (y & low)) ^ ((x ^ ~y) & high)
+
+def _unfilter_sub(x, bpp, n):
+    low, high, full = _masks(n)
+    shift = bpp
+    while shift < n:
+        x = _add(x, (x << (8 * shift)) & full, low, high)
+        shift *= 2
+    return x
+
+def _unfilter_average(row, prev, bpp):
+    out = bytearray(row)
+    for i in range(len(out)):
+        left = out[i - bpp] if i >= bpp else 0
+        out[i] = (out[i] + ((left + prev[i]) >> 1)) & 0xFF
+    return bytes(out)
+
+def _unfilter_paeth(row, prev, bpp):
+    out = bytearray(row)
+    for i in range(len(out)):
+        a = out[i - bpp] if i >= bpp else 0
+        b = prev[i]
+        c = prev[i - bpp] if i >= bpp else 0
+        p = a + b - c
+        pa, pb, pc = abs(p - a), abs(p - b), abs(p - c)
+        out[i] = (out[i] + (a if pa <= pb and pa <= pc else b if pb <= pc else c)) & 0xFF
+    return bytes(out)
+
+def read_chunks(data):
+    if not data.startswith(PNG_SIGNATURE):
+        raise PNGError("firma PNG inválida")
+    chunks, pos = [], len(PNG_SIGNATURE)
+    while True:
+        if pos + 12 > len(data):
+            raise PNGError("PNG truncado")
+        length, kind = struct.unpack(">I4s", data[pos:pos + 8])
+        body = data[pos + 8:pos + 8 + length]
+        (crc,) = struct.unpack(">I", data[pos + 8 + length:pos + 12 + length] or b"\0\0\0\0")
+        if len(body) != length or zlib.crc32(kind + body) != crc:
+            raise PNGError(f"chunk {kind!r} dañado")
+        chunks.append((kind, body))
+        pos += 12 + length
+        if kind == b"IEND":
+            return chunks
+
+def decode(data, max_pixels=PNG_OPTIMIZE_MAX_PIXELS):
+    chunks = read_chunks(data)
+    if chunks[0][0] != b"IHDR" or len(chunks[0][1]) != 13:
+        raise PNGError("falta IHDR")
+    width, height, bit_depth, color_type, compression, filter_method, interlace = struct.unpack(">IIBBBBB", chunks[0][1])
+    if color_type not in CHANNELS or compression or filter_method or not width or not height:
+        raise PNGError("IHDR inválido")
+    if interlace:
+        raise PNGError("PNG entrelazado (Adam7) no soportado")
+    if width * height > max_pixels:
+        raise PNGError("imagen demasiado grande para optimizar")
+
+    kinds = {kind: body for kind, body in chunks}
+    stride = (width * CHANNELS[color_type] * bit_depth + 7) // 8
+    expected = height * (stride + 1)
+    decompressor = zlib.decompressobj()
+    raw = decompressor.decompress(b"".join(body for kind, body in chunks if kind == b"IDAT"), expected + 1)
+    if len(raw) != expected:
+        raise PNGError("IDAT con longitud inesperada")
+
+    image = Image(width, height, bit_depth, color_type, [], kinds.get(b"PLTE"), kinds.get(b"tRNS"),
+                  [(kind, body) for kind, body in chunks if kind in COLOR_CHUNKS])
+    bpp, prev = image.bpp, bytes(stride)
+    low, high, full = _masks(stride)
+    for y in range(height):
+        start = y * (stride + 1)
+        kind, row = raw[start], raw[start + 1:start + 1 + stride]
+        if kind == 1:
+            row = _unfilter_sub(int.from_bytes(row, "little"), bpp, stride).to_bytes(stride, "little")
+        elif kind == 2:
+            row = _add(int.from_bytes(row, "little"), int.from_bytes(prev, "little"), low, high).to_bytes(stride, "little")
+        elif kind == 3:
+            row = _unfilter_average(row, prev, bpp)
+        elif kind == 4:
+            row = _unfilter_paeth(row, prev, bpp)
+        elif kind != 0:
+            raise PNGError(f"filtro desconocido {kind}")
+        image.rows.append(row)
+        prev = row
+    return image
+
+# Codificación
+_SIGNED_ABS = bytes(min(value, 256 - value) for value in range(256))
+
+def _filtered(image, adaptive):
+    """Filtered scanlines: all None, or per row the cheapest of None/Sub/Up."""
+    if not image.rows:
+        return b""
+    stride = len(image.rows[0])
+    low, high, full = _masks(stride)
+    shift = 8 * image.bpp
+    out, prev = [], 0
+    for row in image.rows:
+        if not adaptive:
+            out.append(b"\0" + row)
+            continue
+        x = int.from_bytes(row, "little")
+        candidates = (
+            (0, row),
+            (1, _sub(x, (x << shift) & full, low, high).to_bytes(stride, "little")),
+            (2, _sub(x, prev, low, high).to_bytes(stride, "little")),
+        )
+        kind, best = min(candidates, key=lambda item: sum(item[1].translate(_SIGNED_ABS)))
+        out.append(bytes((kind,)) + best)
+        prev = x
+    return b"".join(out)
+
+def _chunk(kind, body):
+    return struct.pack(">I", len(body)) + kind + body + struct.pack(">I", zlib.crc32(kind + body))
+
+def encode(image):
+    """Smallest PNG for `image` among the filter strategies tried."""
+    streams = [_filtered(image, adaptive=False)]
+    if image.color_type != 3 and image.bit_depth >= 8:
+        streams.append(_filtered(image, adaptive=True))
+    idat = min((zlib.compress(stream, PNG_OPTIMIZE_LEVEL) for stream in streams), key=len)
+
+    parts = [PNG_SIGNATURE, _chunk(b"IHDR", struct.pack(
+        ">IIBBBBB", image.width, image.height, image.bit_depth, image.color_type, 0, 0, 0,
+    ))]
+    parts.extend(_chunk(kind, body) for kind, body in image.color_chunks)
+    if image.palette is not None:
+        parts.append(_chunk(b"PLTE", image.palette))
+    if image.trns:
+        parts.append(_chunk(b"tRNS", image.trns))
+    for start in range(0, len(idat), IDAT_CHUNK_BYTES):
+        parts.append(_chunk(b"IDAT", idat[start:start + IDAT_CHUNK_BYTES]))
+    parts.append(_chunk(b"IEND", b""))
+    return b"".join(parts)
+
+# Reducción de color sin pérdida (solo 8 bits por canal y sin tRNS previo)
+@lru_cache(maxsize=None)
+def _bit_tables(depth, k):
+    """translate() tables placing a sample at / extracting it from slot k of a byte."""
+    shift = 8 - depth * (k + 1)
+    mask = (1 << depth) - 1
+    return (bytes((v << shift) & 0xFF for v in range(256)), bytes((v >> shift) & mask for v in range(256)))
+
+def _pack(indices, depth):
+    per = 8 // depth
+    if per == 1:
+        return indices
+    padded = indices + bytes(-len(indices) % per)
+    packed = 0
+    for k in range(per):
+        packed |= int.from_bytes(padded[k::per].translate(_bit_tables(depth, k)[0]), "big")
+    return packed.to_bytes(len(padded) // per, "big")
+
+def _unpack(row, depth, width):
+    per = 8 // depth
+    if per == 1:
+        return row[:width]
+    out = bytearray(len(row) * per)
+    for k in range(per):
+        out[k::per] = row.translate(_bit_tables(depth, k)[1])
+    return bytes(out[:width])
+
+def rgba(image):
+    """Canonical 8-bit RGBA pixels, to check that a reduction changed nothing."""
+    pixels = b"".join(image.rows)
+    count = image.width * image.height
+    if image.color_type == 3:
+        palette = image.palette
+        trns = image.trns or b""
+        table = [palette[3 * i:3 * i + 3] + bytes((trns[i] if i < len(trns) else 255,)) for i in range(len(palette) // 3)]
+        indices = b"".join(_unpack(row, image.bit_depth, image.width) for row in image.rows)
+        return b"".join(map(table.__getitem__, indices))
+    out = bytearray(b"\xff" * (4 * count))
+    if image.color_type == 6:
+        return pixels
+    if image.color_type == 2:
+        for k in range(3):
+            out[k::4] = pixels[k::3]
+    elif image.color_type == 0:
+        for k in range(3):
+            out[k::4] = pixels
+    elif image.color_type == 4:
+        for k in range(3):
+            out[k::4] = pixels[0::2]
+        out[3::4] = pixels[1::2]
+    return bytes(out)
+
+def _rows(pixels, row_bytes):
+    return [pixels[start:start + row_bytes] for start in range(0, len(pixels), row_bytes)]
+
+def reduce_color(image):
+    """Return a smaller-color-type copy of `image` when that is lossless, else None."""
+    if image.bit_depth != 8 or image.trns is not None or image.color_type not in (2, 4, 6):
+        return None
+    width, pixels = image.width, b"".join(image.rows)
+    channels = CHANNELS[image.color_type]
+    color = pixels if image.color_type != 4 else None
+    opaque = image.color_type == 2 or pixels[channels - 1::channels].count(255) * channels == len(pixels)
+    gray = image.color_type == 4 or pixels[0::channels] == pixels[1::channels] == pixels[2::channels]
+    # Un perfil ICC de color no es válido en una imagen en escala de grises.
+    gray = gray and not any(kind == b"iCCP" for kind, _ in image.color_chunks)
+    if image.color_type == 4 and not opaque:
+        return None
+
+    if color is not None:
+        keys = array("I", pixels) if channels == 4 else list(zip(pixels[0::3], pixels[1::3], pixels[2::3]))
+        colors = set(keys)
+        if len(colors) <= 256 and (not gray or len(colors) <= 16):
+            return _to_palette(image, keys, colors)
+    if gray:
+        if image.color_type == 2:
+            values = pixels[0::3]
+        elif opaque:
+            values = pixels[0::channels]
+        else:
+            values = bytearray(2 * width * image.height)
+            values[0::2] = pixels[0::channels]
+            values[1::2] = pixels[channels - 1::channels]
+            values = bytes(values)
+        kind = 0 if opaque else 4
+        return Image(width, image.height, 8, kind, _rows(values, width * CHANNELS[kind]), color_chunks=image.color_chunks)
+    if image.color_type == 6 and opaque:
+        out = bytearray(3 * width * image.height)
+        for k in range(3):
+            out[k::3] = pixels[k::4]
+        return Image(width, image.height, 8, 2, _rows(bytes(out), 3 * width), color_chunks=image.color_chunks)
+    return None
+
+def _to_palette(image, keys, colors):
+    colors = list(colors)
+    if isinstance(colors[0], int):
+        entries = [value.to_bytes(4, sys.byteorder) for value in colors]
+    else:
+        entries = [bytes(value) + b"\xff" for value in colors]
+    # Las entradas con transparencia van primero para que tRNS sea lo más corto posible.
+    order = sorted(range(len(entries)), key=lambda i: (entries[i][3] == 255, entries[i]))
+    index = {colors[i]: position for position, i in enumerate(order)}
+    palette = b"".join(entries[i][:3] for i in order)
+    alphas = bytes(entries[i][3] for i in order).rstrip(b"\xff")
+
+    depth = next(depth for depth in (1, 2, 4, 8) if len(entries) <= 1 << depth)
+    indices = bytes(map(index.__getitem__, keys))
+    width = image.width
+    rows = [_pack(indices[start:start + width], depth) for start in range(0, len(indices), width)]
+    return Image(width, image.height, depth, 3, rows, palette, alphas or None, image.color_chunks)
+
+def optimize(data, reduce=PNG_OPTIMIZE_REDUCE):
+    """Re-encode a PNG losslessly; returns (smaller bytes, details) or None.
+
+    Pixels are compared after re-decoding the result, so any mismatch leaves
+    the original in place.
+    """
+    try:
+        image = decode(data)
+    except (PNGError, zlib.error):
+        return None
+    candidate = (reduce_color(image) if reduce else None) or image
+    optimized = encode(candidate)
+    if len(optimized) >= len(data):
+        return None
+    check = decode(optimized)
+    same = rgba(check) == rgba(image) if candidate is not image else check.rows == image.rows
+    if not same:
+        return None
+    return optimized, {
+        "color_type": candidate.color_type,
+        "bit_depth": candidate.bit_depth,
+        "original_color_type": image.color_type,
+        "original_bit_depth": image.bit_depth,
+    }
+
+def _optimize_child(conn, data, reduce, memory_mb):
+    if memory_mb > 0:
+        try:
+            import resource
+            limit = memory_mb * 1024 * 1024
+            resource.setrlimit(resource.RLIMIT_AS, (limit, limit))
+        except (ImportError, ValueError, OSError):  # sin resource (Windows) o tope no permitido
+            pass
+    try:
+        conn.send(optimize(data, reduce))
+    except MemoryError:
+        conn.send(None)
+    finally:
+        conn.close()
+
+def optimize_in_subprocess(data, timeout=None, memory_mb=None):
+    """Run optimize() in a spawned process; None on timeout, memory cap or crash."""
+    timeout = PNG_OPTIMIZE_TIMEOUT if timeout is None else timeout
+    memory_mb = PNG_OPTIMIZE_MEMORY_MB if memory_mb is None else memory_mb
+    # spawn y no fork: el worker tiene hilos (y sockets de Firebase) que no
+    # deben copiarse al hijo.
+    context = multiprocessing.get_context("spawn")
+    receiver, sender = context.Pipe(duplex=False)
+    process = context.Process(
+        target=_optimize_child, args=(sender, data, PNG_OPTIMIZE_REDUCE, memory_mb),
+        name="png-optimize", daemon=True,
+    )
+    process.start()
+    sender.close()
+    try:
+        return receiver.recv() if receiver.poll(timeout) else None
+    except EOFError:  # el hijo murió sin responder (p. ej. sin memoria)
+        return None
+    finally:
+        receiver.close()
+        if process.is_alive():
+            process.terminate()
+        process.join()
+
+# Un hilo despacha los trabajos de a uno: a lo sumo un proceso hijo por worker.
+_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="png-optimize")
+
+def schedule_optimization(store, digest, on_optimized):
+    """Optimize blob `digest` in the background.
+
+    The optimized bytes are stored under their own sha256 and
+    on_optimized(new_digest, original_size, optimized_size, details) is called;
+    nothing happens when the PNG cannot be made smaller.
+    """
+    if not PNG_OPTIMIZE:
+        return None
+
+    def run():
+        # Nadie lee el Future: un error que no se registre aquí se pierde.
+        try:
+            data = store.read(digest)
+            result = optimize_in_subprocess(data) if data else None
+            if result is None:
+                return None
+            optimized, details = result
+            new_digest = hashlib.sha256(optimized).hexdigest()
+            store.put(new_digest, optimized)
+            on_optimized(new_digest, len(data), len(optimized), details)
+            return new_digest
+        except Exception as exc:
+            print(f"[png] no se pudo optimizar {digest}: {exc}")
+            return None
+
+    return _executor.submit(run)
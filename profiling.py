@@ -0,0 +1,197 @@
+# profiling.py — perfilador por muestreo bajo demanda y captura de peticiones lentas
+import contextvars, json, os, random, re, sys, threading, time
+from collections import Counter
+
+PROFILE_ENABLED = os.getenv("PROFILE_ENABLED", "") == "1"
+PROFILE_SAMPLE_RATE = float(os.getenv("PROFILE_SAMPLE_RATE", "0.01"))  # fracción de peticiones guardadas
+PROFILE_SLOW_MS = float(os.getenv("PROFILE_SLOW_MS", "1000"))  # toda petición más lenta se guarda
+PROFILE_INTERVAL = float(os.getenv("PROFILE_INTERVAL", "0.005"))  # segundos entre muestras
+PROFILE_DIR = os.getenv("PROFILE_DIR", "/tmp/servidor_sync_profiles")
+# Archivo de control compartido: /admin/profiling lo escribe y todos los
+# workers lo releen (como mucho una vez por segundo).
+PROFILE_CONTROL_PATH = os.getenv("PROFILE_CONTROL_PATH", os.path.join(PROFILE_DIR, "control.json"))
+
+_current = contextvars.ContextVar("request_profile", default=None)
+
+class RequestProfile:
+    def __init__(self, route, method, thread_id, sampled):
+        self.route = route
+        self.method = method
+        self.thread_id = thread_id
+        self.sampled = sampled
+        self.started = time.perf_counter()
+        self.started_at = time.time()
+        self.stacks = Counter()
+        self.firebase = []
+        self._lock = threading.Lock()
+
+    def add_firebase(self, op, path, seconds, error=None):
+        with self._lock:
+            self.firebase.append({
+                "op": op,
+                "path": path,
+                "ms": round(seconds * 1000, 2),
+                "offset_ms": round((time.perf_counter() - self.started - seconds) * 1000, 2),
+                **({"error": error} if error else {}),
+            })
+
+def record_firebase(op, path, seconds, error=None):
+    """Attach one RTDB call to the profile of the request that issued it."""
+    profile = _current.get()
+    if profile is not None:
+        profile.add_firebase(op, path, seconds, error)
+
+def collapse(frame):
+    """Root-first `a;b;c` stack for one frame (collapsed-stack format)."""
+    names = []
+    while frame is not None:
+        code = frame.f_code
+        names.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+        frame = frame.f_back
+    return ";".join(reversed(names))
+
+class Profiler:
+    """Samples the stacks of in-flight requests while enabled.
+
+    When disabled, begin() is a single attribute check and returns None.
+    """
+
+    def __init__(self, enabled=PROFILE_ENABLED, sample_rate=PROFILE_SAMPLE_RATE, slow_ms=PROFILE_SLOW_MS,
+                 interval=PROFILE_INTERVAL, out_dir=PROFILE_DIR, control_path=PROFILE_CONTROL_PATH):
+        self.enabled = enabled
+        self.sample_rate = sample_rate
+        self.slow_ms = slow_ms
+        self.interval = interval
+        self.out_dir = out_dir
+        self.control_path = control_path
+        self._active = {}
+        self._lock = threading.Lock()
+        self._sampler = None
+        self._control_checked = 0.0
+        self._control_mtime = None
+
+    def settings(self):
+        return {
+            "enabled": self.enabled,
+            "sample_rate": self.sample_rate,
+            "slow_ms": self.slow_ms,
+            "interval": self.interval,
+            "out_dir": self.out_dir,
+        }
+
+    def configure(self, enabled=None, sample_rate=None, slow_ms=None):
+        """Change the settings here and, via the control file, in every worker."""
+        if enabled is not None:
+            self.enabled = bool(enabled)
+        if sample_rate is not None:
+            self.sample_rate = min(1.0, max(0.0, float(sample_rate)))
+        if slow_ms is not None:
+            self.slow_ms = max(0.0, float(slow_ms))
+        os.makedirs(os.path.dirname(self.control_path) or ".", exist_ok=True)
+        tmp = f"{self.control_path}.{os.getpid()}.tmp"
+        with open(tmp, "w") as fh:
+            json.dump({"enabled": self.enabled, "sample_rate": self.sample_rate, "slow_ms": self.slow_ms}, fh)
+        os.replace(tmp, self.control_path)
+        self._control_mtime = os.stat(self.control_path).st_mtime_ns
+        return self.settings()
+
+    def refresh(self):
+        """Pick up settings written by another worker (throttled to 1/s)."""
+        now = time.monotonic()
+        if now - self._control_checked < 1.0:
+            return
+        self._control_checked = now
+        try:
+            mtime = os.stat(self.control_path).st_mtime_ns
+        except OSError:
+            return
+        if mtime == self._control_mtime:
+            return
+        self._control_mtime = mtime
+        try:
+            with open(self.control_path) as fh:
+                control = json.load(fh)
+        except (OSError, ValueError):
+            return
+        self.enabled = bool(control.get("enabled", self.enabled))
+        self.sample_rate = float(control.get("sample_rate", self.sample_rate))
+        self.slow_ms = float(control.get("slow_ms", self.slow_ms))
+
+    def begin(self, route, method):
+        self.refresh()
+        if not self.enabled:
+            return None
+        profile = RequestProfile(route, method, threading.get_ident(), random.random() < self.sample_rate)
+        profile.token = _current.set(profile)
+        with self._lock:
+            self._active[profile.thread_id] = profile
+            if self._sampler is None or not self._sampler.is_alive():
+                self._sampler = threading.Thread(target=self._sample_loop, name="profiler", daemon=True)
+                self._sampler.start()
+        return profile
+
+    def end(self, profile, status):
+        """Stop sampling a request; returns the written file path, if any."""
+        if profile is None:
+            return None
+        with self._lock:
+            self._active.pop(profile.thread_id, None)
+        try:
+            _current.reset(profile.token)
+        except ValueError:
+            pass
+        duration_ms = (time.perf_counter() - profile.started) * 1000
+        reason = "slow" if duration_ms >= self.slow_ms else "sampled" if profile.sampled else None
+        if reason is None:
+            return None
+        try:
+            return self.write(profile, status, duration_ms, reason)
+        except OSError as exc:
+            print(f"[profiling] no se pudo guardar el perfil: {exc}")
+            return None
+
+    def _sample_loop(self):
+        me = threading.get_ident()
+        while self.enabled:
+            time.sleep(self.interval)
+            with self._lock:
+                active = list(self._active.values())
+            if not active:
+                continue
+            frames = sys._current_frames()
+            for profile in active:
+                frame = frames.get(profile.thread_id)
+                if frame is not None and profile.thread_id != me:
+                    profile.stacks[collapse(frame)] += 1
+        with self._lock:
+            self._sampler = None
+
+    def write(self, profile, status, duration_ms, reason):
+        """Write `<name>.collapsed` (speedscope-compatible) and `<name>.json`."""
+        os.makedirs(self.out_dir, exist_ok=True)
+        slug = re.sub(r"[^A-Za-z0-9_.-]+", "_", profile.route).strip("_") or "root"
+        name = f"{int(profile.started_at * 1000)}-{os.getpid()}-{slug}-{int(duration_ms)}ms"
+        base = os.path.join(self.out_dir, name)
+        with open(f"{base}.collapsed", "w") as fh:
+            for stack, count in profile.stacks.most_common():
+                fh.write(f"{stack} {count}\n")
+        totals = {}
+        for call in profile.firebase:
+            total = totals.setdefault(call["op"], {"calls": 0, "ms": 0.0})
+            total["calls"] += 1
+            total["ms"] = round(total["ms"] + call["ms"], 2)
+        with open(f"{base}.json", "w") as fh:
+            json.dump({
+                "route": profile.route,
+                "method": profile.method,
+                "status": status,
+                "reason": reason,
+                "duration_ms": round(duration_ms, 2),
+                "samples": sum(profile.stacks.values()),
+                "interval_ms": self.interval * 1000,
+                "firebase_totals": totals,
+                "firebase_calls": profile.firebase,
+            }, fh, indent=2)
+        return f"{base}.collapsed"
+
+profiler = Profiler()
@@ -0,0 +1,49 @@
+# push_ids.py — push IDs de Firebase generados localmente
+import secrets, threading, time
+
+# Push IDs generados localmente con el mismo formato que Firebase: 8 caracteres
+# de timestamp + 12 aleatorios, ordenables lexicográficamente por tiempo.
+PUSH_CHARS = "-0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZ_abcdefghijklmnopqrstuvwxyz"
+_push_id_lock = threading.Lock()
+_last_push_time = 0
+_last_rand_chars = [0] * 12
+
+def generate_push_id(now_ms=None):
+    """Return a Firebase-compatible, time-ordered push ID without a round trip."""
+    global _last_push_time
+    now = int(time.time() * 1000) if now_ms is None else int(now_ms)
+    with _push_id_lock:
+        duplicate_time = now <= _last_push_time
+        if duplicate_time:
+            # Mismo milisegundo (o reloj atrasado): incrementar la parte aleatoria
+            # conserva el orden respecto al ID anterior.
+            now = _last_push_time
+            for i in range(11, -1, -1):
+                if _last_rand_chars[i] != 63:
+                    _last_rand_chars[i] += 1
+                    break
+                _last_rand_chars[i] = 0
+        else:
+            for i in range(12):
+                _last_rand_chars[i] = secrets.randbelow(64)
+        _last_push_time = now
+        return push_id_prefix(now) + "".join(PUSH_CHARS[c] for c in _last_rand_chars)
+
+def push_id_prefix(now_ms):
+    """The 8-character time prefix shared by every push ID of that millisecond."""
+    now = max(0, int(now_ms))
+    time_chars = []
+    for _ in range(8):
+        time_chars.append(PUSH_CHARS[now % 64])
+        now //= 64
+    return "".join(reversed(time_chars))
+
+def push_id_timestamp(key):
+    """Decode the millisecond timestamp embedded in a push ID (0 if invalid)."""
+    ts = 0
+    for char in str(key)[:8]:
+        idx = PUSH_CHARS.find(char)
+        if idx < 0:
+            return 0
+        ts = ts * 64 + idx
+    return ts
@@ -0,0 +1,168 @@
+# read_cache.py — caché read-through (LRU + TTL) para lecturas de RTDB
+import json, os, sqlite3, threading, time
+from collections import OrderedDict
+
+# memory | sqlite | off. "memory" es por proceso: solo es coherente con un único
+# worker (gunicorn.conf.py elige sqlite cuando hay más de uno).
+READ_CACHE_BACKEND = os.getenv("READ_CACHE_BACKEND", "memory")
+READ_CACHE_MAX_ENTRIES = int(os.getenv("READ_CACHE_MAX_ENTRIES", "1024"))
+READ_CACHE_TTL = float(os.getenv("READ_CACHE_TTL", "300"))  # segundos
+READ_CACHE_PATH = os.getenv("READ_CACHE_PATH", "/tmp/servidor_sync_cache.sqlite3")
+
+_MISSING = object()
+
+class MemoryBackend:
+    """Per-process LRU with a size limit and per-entry expiry."""
+
+    def __init__(self, max_entries=READ_CACHE_MAX_ENTRIES):
+        self.max_entries = max_entries
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        now = time.monotonic()
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                return _MISSING
+            expires, value = item
+            if expires <= now:
+                del self._data[key]
+                return _MISSING
+            self._data.move_to_end(key)
+            return value
+
+    def set(self, key, value, ttl):
+        with self._lock:
+            self._data[key] = (time.monotonic() + ttl, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_entries:
+                self._data.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+class SQLiteBackend:
+    """Local-disk cache shared by every gunicorn worker on the same host."""
+
+    def __init__(self, path=READ_CACHE_PATH, max_entries=READ_CACHE_MAX_ENTRIES):
+        self.path = path
+        self.max_entries = max_entries
+        self._local = threading.local()
+        self._writes = 0
+        with self._conn() as conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS cache ("
+                " key TEXT PRIMARY KEY, value TEXT NOT NULL,"
+                " expires REAL NOT NULL, accessed REAL NOT NULL)"
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS cache_accessed ON cache (accessed)")
+
+    def _conn(self):
+        # Una conexión heredada por fork (gunicorn --preload) no debe reutilizarse.
+        conn = getattr(self._local, "conn", None)
+        if conn is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    def get(self, key):
+        now = time.time()
+        row = self._conn().execute("SELECT value, expires FROM cache WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            return _MISSING
+        if row[1] <= now:
+            self.delete(key)
+            return _MISSING
+        self._conn().execute("UPDATE cache SET accessed = ? WHERE key = ?", (now, key))
+        return json.loads(row[0])
+
+    def set(self, key, value, ttl):
+        now = time.time()
+        conn = self._conn()
+        conn.execute(
+            "INSERT OR REPLACE INTO cache (key, value, expires, accessed) VALUES (?, ?, ?, ?)",
+            (key, json.dumps(value, separators=(",", ":")), now + ttl, now),
+        )
+        self._writes += 1
+        if self._writes % 64 == 0:
+            conn.execute("DELETE FROM cache WHERE expires <= ?", (now,))
+            conn.execute(
+                "DELETE FROM cache WHERE key IN (SELECT key FROM cache ORDER BY accessed DESC LIMIT -1 OFFSET ?)",
+                (self.max_entries,),
+            )
+
+    def delete(self, key):
+        self._conn().execute("DELETE FROM cache WHERE key = ?", (key,))
+
+    def clear(self):
+        self._conn().execute("DELETE FROM cache")
+
+class ReadThroughCache:
+    def __init__(self, backend=None, ttl=READ_CACHE_TTL):
+        self.backend = backend
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+    def get_or_load(self, key, loader):
+        """Return the cached value for key, calling loader() on a miss.
+
+        Cached values are shared between requests and must not be mutated.
+        """
+        if self.backend is None:
+            return loader()
+        value = self.backend.get(key)
+        with self._lock:
+            if value is _MISSING:
+                self.misses += 1
+            else:
+                self.hits += 1
+        if value is _MISSING:
+            value = loader()
+            self.backend.set(key, value, self.ttl)
+        return value
+
+    def put(self, key, value):
+        """Write-through: store a value the caller just persisted."""
+        if self.backend is not None:
+            self.backend.set(key, value, self.ttl)
+
+    def invalidate(self, key):
+        if self.backend is not None:
+            self.backend.delete(key)
+
+    def clear(self):
+        if self.backend is not None:
+            self.backend.clear()
+        with self._lock:
+            self.hits = self.misses = 0
+
+    def stats(self):
+        with self._lock:
+            hits, misses = self.hits, self.misses
+        total = hits + misses
+        return {
+            "backend": type(self.backend).__name__ if self.backend else None,
+            "hits": hits,
+            "misses": misses,
+            "hit_ratio": round(hits / total, 4) if total else None,
+        }
+
+def build_cache():
+    if READ_CACHE_BACKEND == "off":
+        return ReadThroughCache(None)
+    if READ_CACHE_BACKEND == "sqlite":
+        return ReadThroughCache(SQLiteBackend())
+    if READ_CACHE_BACKEND == "memory":
+        return ReadThroughCache(MemoryBackend())
+    raise RuntimeError(f"READ_CACHE_BACKEND desconocido: {READ_CACHE_BACKEND}")
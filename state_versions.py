@@ -0,0 +1,294 @@
+# state_versions.py — historial versionado de estado_reporte (snapshots + deltas JSON Patch)
+import copy, json, os, time
+from concurrent.futures import ThreadPoolExecutor
+from firebase_io import fio
+
+STATE_SNAPSHOT_EVERY = int(os.getenv("STATE_SNAPSHOT_EVERY", "20"))  # deltas máximos antes de un snapshot
+STATE_HISTORY_SNAPSHOTS = int(os.getenv("STATE_HISTORY_SNAPSHOTS", "5"))  # snapshots conservados
+STATE_CLAIM_TTL = float(os.getenv("STATE_CLAIM_TTL", "60"))  # segundos; reservas de procesos caídos
+
+PATCH_OPS = ("add", "remove", "replace")
+
+class PatchError(ValueError):
+    pass
+
+class VersionConflict(Exception):
+    """Another save wrote, or is writing, the version this one was planned for."""
+
+def version_key(version):
+    # Llaves no numéricas: RTDB convertiría "1", "2", ... en un arreglo.
+    return f"v{int(version):08d}"
+
+def version_from_key(key):
+    try:
+        return int(str(key)[1:]) if str(key).startswith("v") else None
+    except ValueError:
+        return None
+
+def _escape(token):
+    return str(token).replace("~", "~0").replace("/", "~1")
+
+def _unescape(token):
+    return token.replace("~1", "/").replace("~0", "~")
+
+def pointer_tokens(pointer):
+    if pointer == "":
+        return []
+    if not isinstance(pointer, str) or not pointer.startswith("/"):
+        raise PatchError(f"path inválido: {pointer!r}")
+    return [_unescape(token) for token in pointer[1:].split("/")]
+
+def diff(old, new, pointer=""):
+    """Return RFC 6902 operations turning `old` into `new`.
+
+    Objects are compared key by key; lists and scalars are replaced whole,
+    which matches how RTDB stores them.
+    """
+    if isinstance(old, dict) and isinstance(new, dict):
+        ops = []
+        for key in old:
+            if key not in new:
+                ops.append({"op": "remove", "path": f"{pointer}/{_escape(key)}"})
+        for key, value in new.items():
+            child = f"{pointer}/{_escape(key)}"
+            if key not in old:
+                ops.append({"op": "add", "path": child, "value": value})
+            elif old[key] != value:
+                ops.extend(diff(old[key], value, child))
+        return ops
+    if old == new:
+        return []
+    return [{"op": "replace", "path": pointer, "value": new}]
+
+def validate_patch(ops):
+    if isinstance(ops, str):
+        try:
+            ops = json.loads(ops)
+        except ValueError as exc:
+            raise PatchError("estado_reporte_patch debe ser JSON válido") from exc
+    if not isinstance(ops, list):
+        raise PatchError("estado_reporte_patch debe ser una lista de operaciones")
+    for op in ops:
+        if not isinstance(op, dict) or op.get("op") not in PATCH_OPS:
+            raise PatchError("estado_reporte_patch solo admite add, remove y replace")
+        pointer_tokens(op.get("path"))
+        if op["op"] != "remove" and "value" not in op:
+            raise PatchError(f"falta value en {op['path']}")
+    return ops
+
+def apply_patch(document, ops):
+    """Apply add/remove/replace operations to a copy of `document`."""
+    doc = copy.deepcopy(document)
+    for op in ops:
+        tokens = pointer_tokens(op["path"])
+        if not tokens:
+            if op["op"] == "remove":
+                raise PatchError("no se puede eliminar la raíz")
+            doc = copy.deepcopy(op["value"])
+            continue
+        parent = doc
+        for token in tokens[:-1]:
+            if isinstance(parent, list):
+                parent = parent[int(token)]
+            elif isinstance(parent, dict) and token in parent:
+                parent = parent[token]
+            else:
+                raise PatchError(f"ruta inexistente: {op['path']}")
+        last = tokens[-1]
+        if isinstance(parent, list):
+            index = len(parent) if last == "-" else int(last)
+            if op["op"] == "add":
+                parent.insert(index, copy.deepcopy(op["value"]))
+            elif op["op"] == "remove":
+                del parent[index]
+            else:
+                parent[index] = copy.deepcopy(op["value"])
+        elif isinstance(parent, dict):
+            if op["op"] == "remove":
+                if last not in parent:
+                    raise PatchError(f"ruta inexistente: {op['path']}")
+                del parent[last]
+            else:
+                if op["op"] == "replace" and last not in parent:
+                    raise PatchError(f"ruta inexistente: {op['path']}")
+                parent[last] = copy.deepcopy(op["value"])
+        else:
+            raise PatchError(f"ruta inexistente: {op['path']}")
+    return doc
+
+def history_base(key):
+    return f"estados_reportes_historial/{key}"
+
+def plan_state_write(centro_id, key, head, record, new_state):
+    """Build the multi-path updates (relative to /ecosistemas/{centro_id}).
+
+    Returns (updates, new_head). When a versioned head exists only the changed
+    leaves of estado_reporte travel to Firebase, plus the delta in history;
+    otherwise the full head and a first snapshot are written.
+    """
+    head_path = f"estados_reportes/{key}"
+    history = history_base(key)
+    previous = head.get("version") if isinstance(head, dict) else None
+    updated_at = record["updatedAt"]
+
+    if not isinstance(previous, int) or not isinstance(head.get("estado_reporte"), dict):
+        version = 1 if not isinstance(previous, int) else previous + 1
+        new_head = {**record, "estado_reporte": new_state, "version": version, "snapshot_version": version}
+        return {
+            head_path: new_head,
+            f"{history}/snapshots/{version_key(version)}": {"estado_reporte": new_state, "updatedAt": updated_at},
+        }, new_head
+
+    version = previous + 1
+    ops = diff(head["estado_reporte"], new_state)
+    new_head = {
+        **record,
+        "estado_reporte": new_state,
+        "version": version,
+        "snapshot_version": head.get("snapshot_version", version),
+    }
+    updates = {}
+    for op in ops:
+        tokens = pointer_tokens(op["path"])
+        leaf = "/".join([head_path, "estado_reporte", *tokens])
+        updates[leaf] = None if op["op"] == "remove" else op["value"]
+    for field, value in record.items():
+        if field != "estado_reporte":
+            updates[f"{head_path}/{field}"] = value
+    updates[f"{head_path}/version"] = version
+    updates[f"{history}/deltas/{version_key(version)}"] = {"patch": ops, "updatedAt": updated_at}
+    return updates, new_head
+
+def lock_key(key):
+    return f"estados_reportes_lock/{key}"
+
+def lock_path(centro_id, key):
+    return f"/ecosistemas/{centro_id}/{lock_key(key)}"
+
+def claim_version(centro_id, key, base_version):
+    """Reserve the version after `base_version` before writing it.
+
+    A delta write cannot be made conditional, so a small lock node holds the
+    last committed version: an RTDB transaction adds a `reservada` timestamp
+    to it, but only while that version is still `base_version` and no other
+    save holds a live reservation. The update that follows rewrites the lock
+    with the new version, which drops the reservation. The meta node is never
+    touched here, so readers only ever see committed summaries.
+    Returns the claim to hand to release_claim if that update fails.
+    """
+    claimed_at = int(time.time() * 1000)
+
+    def update(current):
+        current = current if isinstance(current, dict) else None
+        reserved = current.get("reservada") if current else None
+        if isinstance(reserved, (int, float)) and claimed_at - reserved < STATE_CLAIM_TTL * 1000:
+            raise VersionConflict("Otro guardado del mismo estado está en curso")
+        # Sin lock: estado guardado antes de existir, o ninguno todavía.
+        stored = current.get("version") if current else base_version
+        if stored != base_version:
+            raise VersionConflict(f"El estado ya va en la versión {stored}")
+        return {"version": base_version, "reservada": claimed_at}
+
+    fio.transaction(lock_path(centro_id, key), update)
+    return claimed_at
+
+def release_claim(centro_id, key, claimed_at):
+    """Undo a reservation whose write failed; a no-op if the write landed after all."""
+
+    def update(current):
+        if isinstance(current, dict) and current.get("reservada") == claimed_at:
+            return {k: v for k, v in current.items() if k != "reservada"} or None
+        return current
+
+    fio.transaction(lock_path(centro_id, key), update)
+
+def needs_snapshot(head):
+    version = head.get("version") or 0
+    return version - (head.get("snapshot_version") or version) >= STATE_SNAPSHOT_EVERY
+
+def _query_range(path, start, end):
+    """Children of `path` whose keys fall in [start, end] (ordered by key)."""
+    return fio.query(path, start_at=start, end_at=end)
+
+def rebuild_version(centro_id, key, version):
+    """Rebuild estado_reporte at `version` from the nearest snapshot and deltas."""
+    base = f"/ecosistemas/{centro_id}/{history_base(key)}"
+    snapshots = fio.get(f"{base}/snapshots", shallow=True)
+    candidates = [
+        v for v in (version_from_key(k) for k in (snapshots or {}))
+        if v is not None and v <= version
+    ] if isinstance(snapshots, dict) else []
+    if not candidates:
+        return None
+    start = max(candidates)
+    snapshot = fio.get(f"{base}/snapshots/{version_key(start)}")
+    if not isinstance(snapshot, dict) or not isinstance(snapshot.get("estado_reporte"), dict):
+        return None
+    state = snapshot["estado_reporte"]
+    if start == version:
+        return state
+    deltas = _query_range(f"{base}/deltas", version_key(start + 1), version_key(version))
+    for expected in range(start + 1, version + 1):
+        delta = deltas.get(version_key(expected))
+        if not isinstance(delta, dict):
+            return None
+        state = apply_patch(state, delta.get("patch") or [])
+    return state
+
+def compact_history(centro_id, key, head=None):
+    """Snapshot a long delta chain and drop history older than the kept snapshots."""
+    head = head if isinstance(head, dict) else fio.get(f"/ecosistemas/{centro_id}/estados_reportes/{key}")
+    if not isinstance(head, dict) or not isinstance(head.get("version"), int):
+        return False
+    version = head["version"]
+    base = history_base(key)
+    updates = {}
+    if needs_snapshot(head):
+        updates[f"{base}/snapshots/{version_key(version)}"] = {
+            "estado_reporte": head.get("estado_reporte"),
+            "updatedAt": head.get("updatedAt"),
+        }
+        updates[f"estados_reportes/{key}/snapshot_version"] = version
+
+    # Se conservan los STATE_HISTORY_SNAPSHOTS snapshots más recientes; los
+    # deltas anteriores al más antiguo ya no sirven para reconstruir nada.
+    listed, deltas = fio.gather(
+        fio.submit(fio.get, f"/ecosistemas/{centro_id}/{base}/snapshots", shallow=True),
+        fio.submit(fio.get, f"/ecosistemas/{centro_id}/{base}/deltas", shallow=True),
+    )
+    listed, deltas = listed or {}, deltas or {}
+    snapshot_versions = {v for v in map(version_from_key, listed) if v is not None}
+    if updates:
+        snapshot_versions.add(version)
+    kept = sorted(snapshot_versions, reverse=True)[:max(1, STATE_HISTORY_SNAPSHOTS)]
+    if kept:
+        oldest = min(kept)
+        for v in snapshot_versions:
+            if v < oldest:
+                updates[f"{base}/snapshots/{version_key(v)}"] = None
+        for delta_key in deltas:
+            v = version_from_key(delta_key)
+            if v is not None and v <= oldest:
+                updates[f"{base}/deltas/{delta_key}"] = None
+    if updates:
+        fio.update(f"/ecosistemas/{centro_id}", updates)
+    return bool(updates)
+
+_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="state-history")
+
+def schedule_compaction(centro_id, key, head, on_done=None):
+    """Compact in the background when the delta chain has grown too long.
+
+    `on_done` runs after a compaction that changed something (the app uses it
+    to drop its cached head, whose snapshot_version is now stale).
+    """
+    if not isinstance(head, dict) or not needs_snapshot(head):
+        return None
+
+    def run():
+        changed = compact_history(centro_id, key, head)
+        if changed and on_done is not None:
+            on_done()
+        return changed
+
+    return _executor.submit(run)
@@ -0,0 +1,467 @@
+# storage.py — backends de persistencia detrás de firebase_io: Firebase RTDB o SQLite local
+import copy, json, os, sqlite3, threading
+from contextlib import contextmanager
+from push_ids import generate_push_id
+
+STORAGE_BACKEND = os.getenv("STORAGE_BACKEND", "firebase")  # firebase | sqlite
+SQLITE_STORE_PATH = os.getenv(
+    "SQLITE_STORE_PATH", os.path.join(os.path.dirname(os.path.abspath(__file__)), "data", "rtdb.sqlite3")
+)
+
+# Colecciones cuyos hijos se guardan como un documento JSON por fila. Fuera de
+# ellas cada hoja escalar es su propia fila (registro de dispositivos, etc.).
+DOCUMENT_COLLECTIONS = (
+    "ecosistemas/*/dispositivos/*/feed_estudios",
+    "ecosistemas/*/feed_centro",
+    "ecosistemas/*/dispositivos_index",
+    "ecosistemas/*/estados_reportes",
+    "ecosistemas/*/estados_reportes_meta",
+    "ecosistemas/*/estados_reportes_lock",
+    "ecosistemas/*/estados_reportes_historial/*/snapshots",
+    "ecosistemas/*/estados_reportes_historial/*/deltas",
+    "ecosistemas/*/adjuntos_reportes/*",
+)
+
+# Separador menor que cualquier carácter válido en una llave de RTDB: así el
+# orden de `path` es el orden del árbol y un subárbol es un rango contiguo.
+SEP = "\x1f"
+AFTER = "\x20"
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS nodes (
+    path TEXT PRIMARY KEY,
+    parent TEXT NOT NULL,
+    key TEXT NOT NULL,
+    value TEXT NOT NULL,
+    centro_id TEXT,
+    codigo_unico TEXT,
+    updated_at INTEGER
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS nodes_children ON nodes (parent, key);
+CREATE INDEX IF NOT EXISTS nodes_report ON nodes (centro_id, codigo_unico);
+CREATE INDEX IF NOT EXISTS nodes_updated ON nodes (parent, updated_at);
+"""
+
+# Hijos de un documento por los que se puede ordenar con índice
+# (order_by_child): columna e índice que los sirven.
+INDEXED_CHILDREN = {
+    "updatedAt": ("updated_at", "nodes_updated"),
+    "codigo_unico": ("codigo_unico", "nodes_report"),
+}
+
+def split_path(path):
+    return [segment for segment in str(path or "").split("/") if segment]
+
+_PATTERNS = [split_path(pattern) for pattern in DOCUMENT_COLLECTIONS]
+
+def document_depth(segments):
+    """Depth of the document that contains `segments`, or None if it is in no collection."""
+    for pattern in _PATTERNS:
+        if len(segments) > len(pattern) and all(p in ("*", s) for p, s in zip(pattern, segments)):
+            return len(pattern) + 1
+    return None
+
+def _prune(value):
+    """Drop nulls and empty objects, as RTDB does on write."""
+    if isinstance(value, dict):
+        pruned = {str(k): _prune(v) for k, v in value.items()}
+        return {k: v for k, v in pruned.items() if v is not None} or None
+    return value
+
+def _set_in(document, segments, value):
+    if not segments:
+        return value
+    node = document if isinstance(document, dict) else {}
+    child = _set_in(node.get(segments[0]), segments[1:], value)
+    node = dict(node)
+    if child is None:
+        node.pop(segments[0], None)
+    else:
+        node[segments[0]] = child
+    return node or None
+
+def _get_in(document, segments):
+    for segment in segments:
+        if not isinstance(document, dict) or segment not in document:
+            return None
+        document = document[segment]
+    return document
+
+def _shallow(value):
+    return {key: True for key in value} if isinstance(value, dict) else value
+
+class ListenerEvent:
+    def __init__(self, event_type, path, data):
+        self.event_type = event_type
+        self.path = path
+        self.data = data
+
+class ListenerRegistration:
+    def __init__(self, store, entry):
+        self._store = store
+        self._entry = entry
+
+    def close(self):
+        with self._store._lock:
+            if self._entry in self._store._listeners:
+                self._store._listeners.remove(self._entry)
+
+class SQLiteStore:
+    """RTDB-shaped tree persisted in SQLite (WAL).
+
+    Children of DOCUMENT_COLLECTIONS are stored one JSON document per row,
+    indexed by (parent, key), by (centro_id, codigo_unico) and by
+    (parent, updatedAt); other scalars are stored one per row. Listeners
+    only see writes made by this process.
+    """
+
+    name = "sqlite"
+
+    def __init__(self, path=SQLITE_STORE_PATH):
+        self.path = path
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._listeners = []
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self._conn().executescript(SCHEMA)
+
+    def _conn(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    @contextmanager
+    def _transaction(self, write=False):
+        conn = self._conn()
+        conn.execute("BEGIN IMMEDIATE" if write else "BEGIN")
+        try:
+            yield conn
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+
+    def reference(self, path="/"):
+        return SQLiteReference(self, split_path(path))
+
+    # Lecturas
+    def _load(self, conn, segments):
+        row = conn.execute("SELECT value FROM nodes WHERE path = ?", (SEP.join(segments),)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def read(self, segments, shallow=False):
+        with self._transaction() as conn:
+            return self._read(conn, segments, shallow)
+
+    def _read(self, conn, segments, shallow=False):
+        depth = document_depth(segments)
+        if depth is not None and len(segments) > depth:
+            value = _get_in(self._load(conn, segments[:depth]), segments[depth:])
+            return _shallow(value) if shallow else value
+        own = self._load(conn, segments)
+        if own is not None:
+            return _shallow(own) if shallow else own
+        if shallow:
+            keys = self._child_keys(conn, segments)
+            return {key: True for key in keys} or None
+        prefix = SEP.join(segments) + SEP if segments else ""
+        tree = None
+        for path, value in self._range(conn, segments):
+            tree = _set_in(tree, path[len(prefix):].split(SEP), json.loads(value))
+        return tree
+
+    def _range(self, conn, segments):
+        if not segments:
+            return conn.execute("SELECT path, value FROM nodes ORDER BY path")
+        base = SEP.join(segments)
+        return conn.execute(
+            "SELECT path, value FROM nodes WHERE path > ? AND path < ? ORDER BY path",
+            (base + SEP, base + AFTER),
+        )
+
+    def _child_keys(self, conn, segments):
+        """Immediate child keys via index seeks (one per child, not per row)."""
+        prefix = SEP.join(segments) + SEP if segments else ""
+        upper = SEP.join(segments) + AFTER if segments else None
+        keys, cursor = [], prefix
+        while True:
+            if upper is None:
+                row = conn.execute("SELECT path FROM nodes WHERE path >= ? ORDER BY path LIMIT 1", (cursor,)).fetchone()
+            else:
+                row = conn.execute(
+                    "SELECT path FROM nodes WHERE path >= ? AND path < ? ORDER BY path LIMIT 1", (cursor, upper)
+                ).fetchone()
+            if row is None:
+                return keys
+            key = row[0][len(prefix):].split(SEP, 1)[0]
+            keys.append(key)
+            cursor = prefix + key + AFTER
+
+    def query(self, segments, start_at=None, end_at=None, limit_to_first=None, limit_to_last=None,
+              order_by=None, equal_to=None):
+        """Children ordered by key (string order) or by the child `order_by`, bounded and limited."""
+        if equal_to is not None:
+            start_at = end_at = equal_to
+        if order_by is not None:
+            children = self._query_child(segments, order_by, start_at, end_at)
+            start_at = end_at = None
+        elif document_depth(segments + ["_"]) != len(segments) + 1:
+            value = self.read(segments)
+            children = sorted(value.items()) if isinstance(value, dict) else []
+        else:
+            sql, args = "SELECT key, value FROM nodes WHERE parent = ?", [SEP.join(segments)]
+            if start_at is not None:
+                sql, args = sql + " AND key >= ?", args + [str(start_at)]
+            if end_at is not None:
+                sql, args = sql + " AND key <= ?", args + [str(end_at)]
+            with self._transaction() as conn:
+                children = [(key, json.loads(value)) for key, value in conn.execute(sql + " ORDER BY key", args)]
+            start_at = end_at = None
+        children = [
+            (key, value) for key, value in children
+            if (start_at is None or key >= str(start_at)) and (end_at is None or key <= str(end_at))
+        ]
+        if limit_to_first is not None:
+            children = children[:limit_to_first]
+        if limit_to_last is not None:
+            children = children[-limit_to_last:] if limit_to_last else []
+        return dict(children)
+
+    def child_query_sql(self, segments, order_by, start_at=None, end_at=None):
+        """(sql, args) reading documents under `segments` by an indexed child, or None."""
+        if order_by not in INDEXED_CHILDREN or document_depth(segments + ["_"]) != len(segments) + 1:
+            return None
+        column, index = INDEXED_CHILDREN[order_by]
+        sql = f"SELECT key, value FROM nodes INDEXED BY {index} WHERE parent = ?"
+        args = [SEP.join(segments)]
+        if column == "codigo_unico":
+            # El índice va por centro: la colección siempre cuelga de uno.
+            sql, args = sql + " AND centro_id = ?", args + [segments[1] if segments[0] == "ecosistemas" else None]
+        sql += f" AND {column} IS NOT NULL"
+        if start_at is not None:
+            sql, args = sql + f" AND {column} >= ?", args + [start_at]
+        if end_at is not None:
+            sql, args = sql + f" AND {column} <= ?", args + [end_at]
+        return sql + f" ORDER BY {column}, key", args
+
+    def _query_child(self, segments, order_by, start_at, end_at):
+        query = self.child_query_sql(segments, order_by, start_at, end_at)
+        if query is not None:
+            with self._transaction() as conn:
+                return [(key, json.loads(value)) for key, value in conn.execute(*query)]
+        # Sin índice: se ordena en memoria, como RTDB sin .indexOn.
+        value = self.read(segments)
+        children = [
+            (child.get(order_by), key, child) for key, child in (value.items() if isinstance(value, dict) else ())
+            if isinstance(child, dict) and child.get(order_by) is not None
+            and (start_at is None or child[order_by] >= start_at) and (end_at is None or child[order_by] <= end_at)
+        ]
+        return [(key, child) for _, key, child in sorted(children, key=lambda item: (item[0], item[1]))]
+
+    # Escrituras
+    def write(self, segments, value):
+        if segments:
+            self.update(segments[:-1], {segments[-1]: value})
+            return
+        with self._transaction(write=True) as conn:
+            self._replace(conn, [], _prune(copy.deepcopy(value)))
+        self._notify([[]])
+
+    def update(self, segments, values):
+        """Apply a multi-path update atomically (paths must not overlap)."""
+        targets = []
+        for key, value in values.items():
+            targets.append((segments + split_path(key), _prune(copy.deepcopy(value))))
+        paths = sorted(SEP.join(target) for target, _ in targets)
+        for first, second in zip(paths, paths[1:]):
+            if second == first or second.startswith(first + SEP) or not first:
+                raise ValueError(f"Rutas superpuestas en el update: {first!r} y {second!r}")
+
+        with self._transaction(write=True) as conn:
+            self._apply(conn, targets)
+        self._notify([target for target, _ in targets])
+
+    def transaction(self, segments, update):
+        """Read-modify-write of one node under the write lock (RTDB transaction)."""
+        if not segments:
+            raise ValueError("La raíz no admite transacciones")
+        with self._transaction(write=True) as conn:
+            value = update(self._read(conn, segments))
+            self._apply(conn, [(segments, _prune(copy.deepcopy(value)))])
+        self._notify([segments])
+        return value
+
+    def _apply(self, conn, targets):
+        documents = {}
+        for target, value in targets:
+            depth = document_depth(target)
+            if depth is not None and len(target) > depth:
+                # Escritura dentro de un documento: se combina en memoria.
+                doc_key = tuple(target[:depth])
+                if doc_key not in documents:
+                    documents[doc_key] = self._load(conn, list(doc_key))
+                documents[doc_key] = _set_in(documents[doc_key], target[depth:], value)
+            else:
+                self._replace(conn, target, value)
+        for doc_key, document in documents.items():
+            self._replace(conn, list(doc_key), document)
+
+    def _replace(self, conn, segments, value):
+        base = SEP.join(segments)
+        conn.execute("DELETE FROM nodes WHERE path = ?", (base,))
+        if segments:
+            conn.execute("DELETE FROM nodes WHERE path > ? AND path < ?", (base + SEP, base + AFTER))
+        else:
+            conn.execute("DELETE FROM nodes")
+        # Un escalar guardado en un ancestro deja de existir (RTDB lo reemplaza).
+        ancestors = [SEP.join(segments[:n]) for n in range(1, len(segments))]
+        if ancestors:
+            conn.execute(f"DELETE FROM nodes WHERE path IN ({','.join('?' * len(ancestors))})", ancestors)
+        rows = []
+        self._explode(segments, value, rows)
+        conn.executemany(
+            "INSERT INTO nodes (path, parent, key, value, centro_id, codigo_unico, updated_at)"
+            " VALUES (?, ?, ?, ?, ?, ?, ?)",
+            rows,
+        )
+
+    def _explode(self, segments, value, rows):
+        if value is None:
+            return
+        if isinstance(value, dict) and document_depth(segments) != len(segments):
+            for key, child in value.items():
+                self._explode(segments + [key], child, rows)
+            return
+        if not segments:
+            raise ValueError("La raíz solo admite objetos")
+        record = value if isinstance(value, dict) else {}
+        updated_at = record.get("updatedAt")
+        rows.append((
+            SEP.join(segments),
+            SEP.join(segments[:-1]),
+            segments[-1],
+            json.dumps(value, separators=(",", ":"), ensure_ascii=False),
+            segments[1] if len(segments) > 1 and segments[0] == "ecosistemas" else None,
+            str(record["codigo_unico"]) if record.get("codigo_unico") is not None else None,
+            int(updated_at) if isinstance(updated_at, (int, float)) else None,
+        ))
+
+    # Listeners (solo dentro de este proceso)
+    def listen(self, segments, callback):
+        entry = (tuple(segments), callback)
+        callback(ListenerEvent("put", "/", self.read(segments)))
+        with self._lock:
+            self._listeners.append(entry)
+        return ListenerRegistration(self, entry)
+
+    def _notify(self, targets):
+        with self._lock:
+            listeners = list(self._listeners)
+        for prefix, callback in listeners:
+            for target in targets:
+                n = min(len(prefix), len(target))
+                if list(prefix[:n]) == target[:n]:
+                    relative = "/" + "/".join(target[len(prefix):]) if len(target) > len(prefix) else "/"
+                    try:
+                        callback(ListenerEvent("patch", relative, self.read(list(prefix))))
+                    except Exception as exc:
+                        print(f"[storage] listener falló: {exc}")
+                    break
+
+class SQLiteReference:
+    """Subset of firebase_admin.db.Reference backed by SQLiteStore."""
+
+    def __init__(self, store, segments):
+        self._store = store
+        self._segments = list(segments)
+        self.key = self._segments[-1] if self._segments else None
+        self.path = "/" + "/".join(self._segments)
+
+    def child(self, path):
+        return SQLiteReference(self._store, self._segments + split_path(path))
+
+    def get(self, shallow=False):
+        return self._store.read(self._segments, shallow=shallow)
+
+    def set(self, value):
+        self._store.write(self._segments, value)
+
+    def update(self, value):
+        if not isinstance(value, dict) or not value:
+            raise ValueError("update requiere un diccionario no vacío")
+        self._store.update(self._segments, value)
+
+    def delete(self):
+        self._store.write(self._segments, None)
+
+    def transaction(self, update):
+        return self._store.transaction(self._segments, update)
+
+    def push(self, value=""):
+        child = self.child(generate_push_id())
+        child.set(value)
+        return child
+
+    def order_by_key(self):
+        return SQLiteQuery(self._store, self._segments)
+
+    def order_by_child(self, path):
+        return SQLiteQuery(self._store, self._segments, order_by=path)
+
+    def listen(self, callback):
+        return self._store.listen(self._segments, callback)
+
+class SQLiteQuery:
+    def __init__(self, store, segments, order_by=None):
+        self._store = store
+        self._segments = segments
+        self._params = {"order_by": order_by}
+
+    def start_at(self, value):
+        self._params["start_at"] = value
+        return self
+
+    def end_at(self, value):
+        self._params["end_at"] = value
+        return self
+
+    def equal_to(self, value):
+        self._params["equal_to"] = value
+        return self
+
+    def limit_to_first(self, limit):
+        self._params["limit_to_first"] = limit
+        return self
+
+    def limit_to_last(self, limit):
+        self._params["limit_to_last"] = limit
+        return self
+
+    def get(self):
+        return self._store.query(self._segments, **self._params)
+
+class FirebaseStore:
+    """Firebase RTDB through firebase-admin (the production backend)."""
+
+    name = "firebase"
+
+    def reference(self, path="/"):
+        from firebase_admin import db
+        return db.reference(path)
+
+    def http_session(self):
+        from firebase_admin import db
+        return db.reference("/")._client.session
+
+def build_store(backend=STORAGE_BACKEND):
+    if backend == "firebase":
+        return FirebaseStore()
+    if backend == "sqlite":
+        return SQLiteStore()
+    raise RuntimeError(f"STORAGE_BACKEND desconocido: {backend}")
@@ -0,0 +1,168 @@
+"""In-memory stand-in for firebase_admin shared by the test modules."""
+import copy
+import sys
+import types
+
+
+def _segments(path):
+    return [segment for segment in str(path).split("/") if segment]
+
+
+class FakeReference:
+    """Tree-backed imitation of firebase_admin.db.Reference."""
+
+    root = {}
+    pushes = []
+    updates = []
+    gets = []
+
+    def __init__(self, path):
+        self.path = "/" + "/".join(_segments(path))
+        self.key = _segments(path)[-1] if _segments(path) else None
+
+    @classmethod
+    def reset(cls, values=None):
+        cls.root = {}
+        cls.pushes = []
+        cls.updates = []
+        cls.gets = []
+        for path, value in (values or {}).items():
+            cls(path).set(value)
+
+    @classmethod
+    def read(cls, path):
+        node = cls.root
+        for segment in _segments(path):
+            if not isinstance(node, dict) or segment not in node:
+                return None
+            node = node[segment]
+        return copy.deepcopy(node)
+
+    @classmethod
+    def write(cls, path, value):
+        segments = _segments(path)
+        if not segments:
+            cls.root = copy.deepcopy(value) if isinstance(value, dict) else {}
+            return
+        node = cls.root
+        for segment in segments[:-1]:
+            if not isinstance(node.get(segment), dict):
+                if value is None:
+                    return
+                node[segment] = {}
+            node = node[segment]
+        if value is None:
+            node.pop(segments[-1], None)
+        else:
+            node[segments[-1]] = copy.deepcopy(value)
+
+    def get(self, shallow=False):
+        self.gets.append((self.path, shallow))
+        value = self.read(self.path)
+        if shallow and isinstance(value, dict):
+            return {key: True for key in value}
+        return value
+
+    def set(self, value):
+        self.write(self.path, value)
+
+    def update(self, value):
+        self.updates.append((self.path, value))
+        for key, item in value.items():
+            path = f"{self.path.rstrip('/')}/{key}"
+            self.write(path, item)
+            if "/feed_estudios/" in path and item is not None:
+                self.pushes.append((path.rsplit("/", 1)[0], item))
+
+    def transaction(self, update):
+        value = update(self.read(self.path))
+        self.write(self.path, value)
+        return value
+
+    def push(self, value):
+        self.pushes.append((self.path, value))
+        key = f"push-{len(self.pushes)}"
+        self.write(f"{self.path}/{key}", value)
+        return FakeReference(f"{self.path}/{key}")
+
+    def delete(self):
+        self.write(self.path, None)
+
+    def child(self, path):
+        return FakeReference(f"{self.path.rstrip('/')}/{path}")
+
+    def order_by_key(self):
+        return FakeQuery(self)
+
+    def order_by_child(self, path):
+        return FakeQuery(self, order_by=path)
+
+
+class FakeQuery:
+    """Subset of firebase_admin.db.Query ordered by key or by a child."""
+
+    def __init__(self, reference, order_by=None):
+        self.reference = reference
+        self.order_by = order_by
+        self.start = None
+        self.end = None
+        self.first = None
+        self.last = None
+
+    def start_at(self, value):
+        self.start = value
+        return self
+
+    def end_at(self, value):
+        self.end = value
+        return self
+
+    def equal_to(self, value):
+        self.start = self.end = value
+        return self
+
+    def limit_to_first(self, limit):
+        self.first = limit
+        return self
+
+    def limit_to_last(self, limit):
+        self.last = limit
+        return self
+
+    def get(self):
+        self.reference.gets.append((self.reference.path, "query"))
+        value = self.reference.read(self.reference.path)
+        if not isinstance(value, dict):
+            return {}
+        if self.order_by is None:
+            sort_key = {key: key for key in value}
+        else:
+            sort_key = {
+                key: child[self.order_by] for key, child in value.items()
+                if isinstance(child, dict) and child.get(self.order_by) is not None
+            }
+        keys = sorted(
+            (key for key, bound in sort_key.items()
+             if (self.start is None or bound >= self.start) and (self.end is None or bound <= self.end)),
+            key=lambda key: (sort_key[key], key),
+        )
+        if self.first is not None:
+            keys = keys[:self.first]
+        if self.last is not None:
+            keys = keys[-self.last:] if self.last else []
+        return {key: value[key] for key in keys}
+
+
+fake_db = types.ModuleType("firebase_admin.db")
+fake_db.reference = lambda path="/": FakeReference(path)
+fake_credentials = types.ModuleType("firebase_admin.credentials")
+fake_credentials.Certificate = lambda value: value
+fake_firebase = types.ModuleType("firebase_admin")
+fake_firebase._apps = [object()]
+fake_firebase.credentials = fake_credentials
+fake_firebase.db = fake_db
+fake_firebase.initialize_app = lambda *args, **kwargs: None
+
+sys.modules["firebase_admin"] = fake_firebase
+sys.modules["firebase_admin.credentials"] = fake_credentials
+sys.modules["firebase_admin.db"] = fake_db
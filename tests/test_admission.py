@@ -0,0 +1,120 @@
+import importlib
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+from fake_firebase import FakeReference
+
+os.environ.setdefault("PUSH_FEED_TOKEN", "test-token")
+service = importlib.import_module("app")
+import admission
+from admission import AdmissionController, Limit
+
+
+class AdmissionControllerTest(unittest.TestCase):
+    def controller(self, backend, **kwargs):
+        return AdmissionController(backend, centro_limit=Limit(1, 2), token_limit=Limit(100, 100), **kwargs)
+
+    def test_centro_bucket_refills_and_overrides_apply(self):
+        controller = self.controller(admission.MemoryBackend(), centro_limits={"grande": Limit(1, 5)})
+        with mock.patch.object(admission.time, "time", return_value=1000.0):
+            self.assertTrue(controller.admit(["c1"]).admitted)
+            self.assertTrue(controller.admit(["c1"]).admitted)
+            denied = controller.admit(["c1"])
+            self.assertEqual((denied.admitted, denied.reason, denied.retry_after_header), (False, "centro", "1"))
+            self.assertTrue(controller.admit(["c2"]).admitted)
+            self.assertEqual(sum(controller.admit(["grande"]).admitted for _ in range(6)), 5)
+        with mock.patch.object(admission.time, "time", return_value=1001.0):
+            self.assertTrue(controller.admit(["c1"]).admitted)
+
+    def test_batches_pay_one_token_per_report(self):
+        controller = self.controller(admission.MemoryBackend())
+        with mock.patch.object(admission.time, "time", return_value=1000.0):
+            self.assertTrue(controller.admit(["c1", "c1"]).admitted)
+            self.assertEqual(controller.admit(["c1"]).reason, "centro")
+            # Un lote mayor que la ráfaga paga la ráfaga completa en vez de no caber nunca.
+            self.assertTrue(controller.admit(["c2"] * 5).admitted)
+            self.assertEqual(controller.admit(["c2"]).reason, "centro")
+
+    def test_lease_is_released_when_the_bucket_check_fails(self):
+        backend = admission.MemoryBackend()
+        controller = self.controller(backend, max_in_flight=1)
+        with mock.patch.object(backend, "take", side_effect=OSError("disk I/O error")):
+            with self.assertRaises(OSError):
+                controller.admit(["c1"])
+        self.assertEqual(backend._leases, {})
+        self.assertTrue(controller.admit(["c1"]).admitted)
+
+    def test_sqlite_counters_and_leases_are_shared_between_workers(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        path = os.path.join(tmp.name, "admission.sqlite3")
+        first = self.controller(admission.SQLiteBackend(path), max_in_flight=1)
+        second = self.controller(admission.SQLiteBackend(path), max_in_flight=1)
+
+        held = first.admit(["c1"], "Bearer a")
+        self.assertTrue(held.admitted)
+        self.assertEqual(second.admit(["c1"], "Bearer a").reason, "in_flight")
+        first.release(held)
+        second.release(second.admit(["c1"], "Bearer a"))
+        self.assertEqual(first.admit(["c1"], "Bearer a").reason, "centro")
+
+
+class AdmissionAppTest(unittest.TestCase):
+    def setUp(self):
+        FakeReference.reset({
+            "/ecosistemas/centro-a/dispositivos": {"equipo-1": {}},
+            "/ecosistemas/centro-b/dispositivos": {"equipo-1": {}},
+        })
+        service.invalidate_devices()
+        service.cache.clear()
+        controller = AdmissionController(admission.MemoryBackend(), centro_limit=Limit(0.01, 2),
+                                         token_limit=Limit(100, 100), centro_limits={}, max_in_flight=4)
+        patcher = mock.patch.object(service, "admission_control", controller)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.client = service.app.test_client()
+        self.headers = {"Authorization": f"Bearer {os.environ['PUSH_FEED_TOKEN']}"}
+
+    def save(self, centro_id, path="/push_feed"):
+        return self.client.post(path, headers=self.headers, json={
+            "codigo_unico": "ADM-1", "centro_id": centro_id, "email_usuario": "a@example.com",
+        })
+
+    def test_looping_centro_gets_429_while_others_proceed(self):
+        self.assertEqual(self.save("centro-a").status_code, 200)
+        self.assertEqual(self.save("centro-a", "/guardar-reporte").status_code, 200)
+        shed = self.save("centro-a")
+        self.assertEqual(shed.status_code, 429)
+        self.assertGreaterEqual(int(shed.headers["Retry-After"]), 1)
+        self.assertEqual(len(FakeReference.updates), 2)
+        self.assertEqual(self.save("centro-b").status_code, 200)
+        self.assertEqual(service.admission_control.backend._leases, {})
+
+        scrape = self.client.get("/metrics", headers=self.headers).get_data(as_text=True)
+        self.assertIn('admission_rejected_total{reason="centro"}', scrape)
+
+    def test_coalesced_autosaves_do_not_spend_admission(self):
+        from coalescer import SaveCoalescer
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        saves = SaveCoalescer(service.flush_autosave, path=os.path.join(tmp.name, "coalesce.sqlite3"), debounce=60)
+        with mock.patch.object(service, "save_coalescer", saves):
+            for n in range(5):
+                autosave = self.client.post("/push_feed", headers=self.headers, json={
+                    "codigo_unico": "ADM-1", "centro_id": "centro-a", "email_usuario": "a@example.com",
+                    "estatus": "EN_PROCESO", "estado_reporte": {"n": n},
+                })
+                self.assertEqual(autosave.status_code, 202)
+            self.assertEqual(self.save("centro-a").status_code, 200)
+
+    def test_admission_backend_errors_fail_open(self):
+        import sqlite3
+        with mock.patch.object(service.admission_control.backend, "acquire",
+                               side_effect=sqlite3.OperationalError("database is locked")):
+            self.assertEqual(self.save("centro-a").status_code, 200)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,51 +1,40 @@
 import importlib
 import os
-import sys
-import types
+import tempfile
+import time
 import unittest
+from unittest import mock
 
+from fake_firebase import FakeReference
 
-class FakeReference:
-    values = {}
-    pushes = []
 
-    def __init__(self, path):
-        self.path = path
-
-    def get(self):
-        return self.values.get(self.path)
-
-    def set(self, value):
-        self.values[self.path] = value
-
-    def push(self, value):
-        self.pushes.append((self.path, value))
-        return types.SimpleNamespace(key=f"push-{len(self.pushes)}")
+os.environ["PUSH_FEED_TOKEN"] = "test-token"
+service = importlib.import_module("app")
+import blob_store
+import centro_feed
 
 
-fake_db = types.ModuleType("firebase_admin.db")
-fake_db.reference = lambda path: FakeReference(path)
-fake_credentials = types.ModuleType("firebase_admin.credentials")
-fake_credentials.Certificate = lambda value: value
-fake_firebase = types.ModuleType("firebase_admin")
-fake_firebase._apps = [object()]
-fake_firebase.credentials = fake_credentials
-fake_firebase.db = fake_db
-fake_firebase.initialize_app = lambda *args, **kwargs: None
+class InlineExecutor:
+    """Runs background submissions synchronously so tests stay deterministic."""
 
-sys.modules["firebase_admin"] = fake_firebase
-sys.modules["firebase_admin.credentials"] = fake_credentials
-sys.modules["firebase_admin.db"] = fake_db
-os.environ["PUSH_FEED_TOKEN"] = "test-token"
-service = importlib.import_module("app")
+    def submit(self, fn, *args, **kwargs):
+        from concurrent.futures import Future
+        future = Future()
+        future.set_result(fn(*args, **kwargs))
+        return future
 
 
 class ServidorSyncBubbleTest(unittest.TestCase):
     def setUp(self):
-        FakeReference.values = {
+        FakeReference.reset({
             "/ecosistemas/centro-test/dispositivos": {"equipo-1": {}}
-        }
-        FakeReference.pushes = []
+        })
+        service.invalidate_devices()
+        service.cache.clear()
+        self.blob_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.blob_dir.cleanup)
+        self.blobs = blob_store.LocalBlobStore(self.blob_dir.name)
+        blob_store.set_blob_store(self.blobs)
         self.client = service.app.test_client()
         self.headers = {"Authorization": "Bearer test-token"}
         self.identity = {
@@ -78,6 +67,756 @@ class ServidorSyncBubbleTest(unittest.TestCase):
         self.assertEqual(restore.status_code, 200)
         self.assertEqual(restore.get_json()["estado_reporte"], state)
 
+    def test_push_feed_fans_out_in_a_single_update(self):
+        FakeReference.reset({"/ecosistemas/centro-test/dispositivos": {
+            "equipo-1": {},
+            "equipo-2": {},
+            "equipo-3": {},
+        }})
+        save = self.client.post("/push_feed", headers=self.headers, json={
+            **self.identity,
+            "estado_reporte": {"version": "v1"},
+        })
+        self.assertEqual(save.status_code, 200)
+        pushed = save.get_json()["pushed"]
+        self.assertEqual(set(pushed), {"equipo-1", "equipo-2", "equipo-3"})
+        self.assertEqual(len(FakeReference.updates), 1)
+
+        path, update = FakeReference.updates[0]
+        self.assertEqual(path, "/ecosistemas/centro-test")
+        state_key = service.report_state_key("centro-test", "TEST-ESTADO-001")
+        self.assertIn(f"estados_reportes/{state_key}", update)
+        for dev_id, key in pushed.items():
+            self.assertIn(f"dispositivos/{dev_id}/feed_estudios/{key}", update)
+
+    def test_device_lookup_is_shallow_and_cached(self):
+        payload = {**self.identity, "estado_reporte": {"version": "v1"}}
+        self.client.post("/push_feed", headers=self.headers, json=payload)
+        self.client.post("/push_feed", headers=self.headers, json=payload)
+
+        device_reads = [
+            read for read in FakeReference.gets
+            if read[0] == "/ecosistemas/centro-test/dispositivos"
+        ]
+        self.assertEqual(device_reads, [("/ecosistemas/centro-test/dispositivos", True)])
+
+        FakeReference.write("/ecosistemas/centro-test/dispositivos/equipo-2", {})
+        service.invalidate_devices("centro-test")
+        self.assertEqual(service.list_devices("centro-test"), ["equipo-1", "equipo-2"])
+
+    def test_readyz_reports_rtdb_round_trip(self):
+        ready = self.client.get("/readyz")
+        self.assertEqual(ready.status_code, 200)
+        self.assertEqual(ready.get_json()["status"], "ready")
+        self.assertIn("firebase_ms", ready.get_json())
+        self.assertIn((service.READYZ_PROBE_PATH, True), FakeReference.gets)
+
+        with mock.patch.object(FakeReference, "get", side_effect=ConnectionError("sin red")):
+            down = self.client.get("/readyz")
+        self.assertEqual(down.status_code, 503)
+        self.assertEqual(down.get_json()["status"], "unavailable")
+        self.assertEqual(self.client.get("/healthz").status_code, 200)
+
+    def test_metrics_expose_route_firebase_and_fanout_series(self):
+        FakeReference.reset({"/ecosistemas/centro-test/dispositivos": {"equipo-1": {}, "equipo-2": {}}})
+        self.client.post("/push_feed", headers=self.headers, json={**self.identity, "estado_reporte": {"v": 1}})
+        self.assertEqual(self.client.get("/metrics").status_code, 401)
+
+        scrape = self.client.get("/metrics", headers=self.headers)
+        self.assertEqual(scrape.status_code, 200)
+        text = scrape.get_data(as_text=True)
+        self.assertIn('http_requests_total{method="POST",route="/push_feed",status="200"}', text)
+        self.assertIn('firebase_op_duration_seconds_count{op="update"}', text)
+        self.assertRegex(text, r"\nfeed_fanout_entries_total \d")
+        self.assertNotIn("centro_id=", text)
+        self.assertIn('http_requests_in_flight{route="/metrics"} 1.0', text)
+
+    def test_profiler_captures_slow_requests_with_firebase_breakdown(self):
+        import json
+        from profiling import Profiler
+        out_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(out_dir.cleanup)
+        profiler = Profiler(enabled=False, sample_rate=0, slow_ms=0, interval=0.001, out_dir=out_dir.name,
+                            control_path=os.path.join(out_dir.name, "control.json"))
+        self.addCleanup(setattr, profiler, "enabled", False)
+        with mock.patch.object(service, "profiler", profiler):
+            self.client.post("/push_feed", headers=self.headers, json={**self.identity, "estado_reporte": {"v": 1}})
+            self.assertEqual(os.listdir(out_dir.name), [])
+
+            toggle = self.client.post("/admin/profiling", headers=self.headers, json={"enabled": True})
+            self.assertTrue(toggle.get_json()["profiling"]["enabled"])
+            self.client.post("/push_feed", headers=self.headers, json={**self.identity, "estado_reporte": {"v": 2}})
+
+        reports = [name for name in os.listdir(out_dir.name) if "push_feed" in name and name.endswith(".json")]
+        self.assertEqual(len(reports), 1)
+        with open(os.path.join(out_dir.name, reports[0])) as fh:
+            report = json.load(fh)
+        self.assertEqual(report["reason"], "slow")
+        self.assertEqual(report["firebase_totals"]["update"]["calls"], 1)
+        self.assertTrue(any(call["op"] == "get" for call in report["firebase_calls"]))
+        self.assertTrue(os.path.exists(os.path.join(out_dir.name, reports[0][:-5] + ".collapsed")))
+
+    def test_firebase_is_initialized_once_on_first_use(self):
+        from firebase_io import FirebaseIO
+        io = FirebaseIO(concurrency=2)
+        init = mock.Mock()
+        io.configure(init)
+        init.assert_not_called()
+        io.get("/ecosistemas/centro-test/dispositivos", shallow=True)
+        io.get("/ecosistemas/centro-test/dispositivos", shallow=True)
+        init.assert_called_once()
+        self.assertTrue(io.ready)
+
+    def test_gzip_request_bodies_and_negotiated_response_compression(self):
+        import gzip
+        import json
+        big_state = {"hallazgos": ["sin alteraciones significativas"] * 400}
+        body = gzip.compress(json.dumps({**self.identity, "estado_reporte": big_state}).encode())
+        save = self.client.post("/push_feed", data=body, headers={
+            **self.headers, "Content-Type": "application/json", "Content-Encoding": "gzip",
+        })
+        self.assertEqual(save.status_code, 200)
+
+        restore = self.client.post("/recuperar_estado_reporte", json=self.identity,
+                                   headers={**self.headers, "Accept-Encoding": "br;q=0, gzip"})
+        self.assertEqual(restore.headers["Content-Encoding"], "gzip")
+        self.assertIn("Accept-Encoding", restore.headers["Vary"])
+        self.assertEqual(json.loads(gzip.decompress(restore.get_data()))["estado_reporte"], big_state)
+
+        small = self.client.get("/healthz", headers={"Accept-Encoding": "gzip"})
+        self.assertNotIn("Content-Encoding", small.headers)
+        plain = self.client.post("/recuperar_estado_reporte", json=self.identity, headers=self.headers)
+        self.assertEqual(plain.get_json()["estado_reporte"], big_state)
+
+    def test_large_responses_are_compressed_in_chunks(self):
+        import gzip
+        import json
+        big_state = {"texto": "x" * 200_000}
+        self.client.post("/push_feed", headers=self.headers, json={**self.identity, "estado_reporte": big_state})
+        with mock.patch("http_codec.COMPRESS_STREAM_BYTES", 1024):
+            restore = self.client.post("/recuperar_estado_reporte", json=self.identity,
+                                       headers={**self.headers, "Accept-Encoding": "gzip"})
+        self.assertTrue(restore.is_streamed)
+        self.assertNotIn("Content-Length", restore.headers)
+        self.assertEqual(json.loads(gzip.decompress(restore.get_data()))["estado_reporte"], big_state)
+
+    def test_compressed_request_bombs_are_rejected(self):
+        import gzip
+        bomb = gzip.compress(b"{" + b" " * 200_000 + b"}")
+        with mock.patch.object(service.app.wsgi_app, "max_bytes", 100_000):
+            rejected = self.client.post("/push_feed", data=bomb, headers={
+                **self.headers, "Content-Type": "application/json", "Content-Encoding": "gzip",
+            })
+        self.assertEqual(rejected.status_code, 413)
+        broken = self.client.post("/push_feed", data=b"no es gzip", headers={
+            **self.headers, "Content-Type": "application/json", "Content-Encoding": "gzip",
+        })
+        self.assertEqual(broken.status_code, 400)
+
+    def test_compressed_uploads_are_inflated_as_they_are_read(self):
+        import gzip
+        import io
+        import http_codec
+        from werkzeug.datastructures import FileStorage
+        from werkzeug.test import encode_multipart
+
+        contenido = b"\x89PNG\r\n\x1a\n" + b"\0" * 300_000
+        boundary, body = encode_multipart({
+            **self.identity, "archivo": FileStorage(io.BytesIO(contenido), "esquema.png", content_type="image/png"),
+        })
+        headers = {
+            **self.headers, "Content-Encoding": "gzip",
+            "Content-Type": f"multipart/form-data; boundary={boundary}",
+        }
+        inflated = []
+        inflate = http_codec.InflatingStream._inflate
+
+        def recording(stream):
+            data = inflate(stream)
+            inflated.append(len(data))
+            return data
+
+        with mock.patch.object(http_codec.InflatingStream, "_inflate", recording):
+            upload = self.client.post("/subir_esquema_prostata", data=gzip.compress(body), headers=headers)
+        self.assertEqual(upload.status_code, 201)
+        self.assertEqual(upload.get_json()["adjunto"]["size_bytes"], len(contenido))
+        self.assertEqual(sum(inflated), len(body))
+        self.assertLessEqual(max(inflated), http_codec.COMPRESS_CHUNK_BYTES)
+
+        with mock.patch.object(service.app.wsgi_app, "max_bytes", 100_000):
+            rejected = self.client.post("/subir_esquema_prostata", data=gzip.compress(body), headers=headers)
+        self.assertEqual(rejected.status_code, 413)
+
+    def test_json_outside_orjson_range_falls_back_to_stdlib(self):
+        decoded = service.app.json.loads('{"n": 18446744073709551616, "x": NaN}')
+        self.assertEqual(decoded["n"], 2 ** 64)
+        self.assertNotEqual(decoded["x"], decoded["x"])
+
+    def test_feed_sync_pages_after_a_cursor(self):
+        for n in range(5):
+            self.client.post("/push_feed", headers=self.headers, json={
+                **self.identity, "codigo_unico": f"SYNC-{n}",
+            })
+        query = {"centro_id": "centro-test", "device_id": "equipo-1", "limit": 2}
+        first = self.client.get("/feed_sync", headers=self.headers, query_string=query).get_json()
+        self.assertEqual([item["data"]["codigo_unico"] for item in first["items"]], ["SYNC-0", "SYNC-1"])
+        self.assertTrue(first["has_more"])
+
+        second = self.client.get("/feed_sync", headers=self.headers,
+                                 query_string={**query, "cursor": first["next_cursor"]}).get_json()
+        self.assertEqual([item["data"]["codigo_unico"] for item in second["items"]], ["SYNC-2", "SYNC-3"])
+
+        since = second["items"][-1]["data"]["updatedAt"]
+        by_time = self.client.get("/feed_sync", headers=self.headers,
+                                  query_string={**query, "cursor": since, "limit": 10}).get_json()
+        codes = [item["data"]["codigo_unico"] for item in by_time["items"]]
+        self.assertEqual(codes[-2:], ["SYNC-3", "SYNC-4"])
+        self.assertFalse(by_time["has_more"])
+        self.assertEqual(FakeReference.gets[-1][1], "query")
+
+        unknown = self.client.get("/feed_sync", headers=self.headers,
+                                  query_string={**query, "device_id": "equipo-x"})
+        self.assertEqual(unknown.status_code, 404)
+        bad = self.client.get("/feed_sync", headers=self.headers, query_string={**query, "cursor": "??"})
+        self.assertEqual(bad.status_code, 400)
+
+    def test_devices_missed_by_a_stale_device_list_are_backfilled(self):
+        with mock.patch.object(centro_feed, "_executor", InlineExecutor()), \
+                mock.patch.object(service, "DEVICE_BACKFILL_DELAY", 0):
+            self.client.post("/push_feed", headers=self.headers, json=self.identity)
+            # Registrado directo en RTDB: la lista cacheada de este worker no lo ve.
+            FakeReference("/ecosistemas/centro-test/dispositivos/equipo-2/registradoEn").set(1)
+            missed = self.client.post("/push_feed", headers=self.headers, json={**self.identity, "codigo_unico": "TARDE-1"})
+            self.assertEqual(list(missed.get_json()["pushed"]), ["equipo-1"])
+
+            sync = self.client.get("/feed_sync", headers=self.headers,
+                                   query_string={"centro_id": "centro-test", "device_id": "equipo-2"})
+            self.assertEqual(sync.status_code, 200)
+            codes = [item["data"]["codigo_unico"] for item in sync.get_json()["items"]]
+            self.assertEqual(codes, ["TEST-ESTADO-001", "TARDE-1"])
+
+            registered = self.client.post("/registrar_dispositivo", headers=self.headers,
+                                          json={"centro_id": "centro-test", "device_id": "equipo-3"})
+            self.assertEqual(registered.status_code, 200)
+            self.assertIsNotNone(FakeReference.read("/ecosistemas/centro-test/dispositivos_index/equipo-3"))
+            after = self.client.post("/push_feed", headers=self.headers, json={**self.identity, "codigo_unico": "TARDE-2"})
+        self.assertEqual(sorted(after.get_json()["pushed"]), ["equipo-1", "equipo-2", "equipo-3"])
+
+    def test_feed_sync_long_poll_wakes_on_new_entries(self):
+        import threading
+        query = {"centro_id": "centro-test", "device_id": "equipo-1", "wait": 5}
+        empty = self.client.get("/feed_sync", headers=self.headers,
+                                query_string={**query, "wait": 0}).get_json()
+        self.assertEqual(empty["items"], [])
+
+        writer = threading.Timer(0.2, lambda: service.app.test_client().post(
+            "/push_feed", headers=self.headers, json=self.identity))
+        writer.start()
+        self.addCleanup(writer.cancel)
+        started = time.monotonic()
+        woke = self.client.get("/feed_sync", headers=self.headers, query_string=query).get_json()
+        self.assertLess(time.monotonic() - started, 2)
+        self.assertEqual(woke["items"][0]["data"]["codigo_unico"], self.identity["codigo_unico"])
+
+    def test_feed_sync_server_sent_events_resume_from_last_event_id(self):
+        import feed_sync
+        for n in range(3):
+            self.client.post("/push_feed", headers=self.headers, json={**self.identity, "codigo_unico": f"SSE-{n}"})
+        with mock.patch.object(feed_sync, "FEED_SYNC_SSE_MAX", 0.2), \
+                mock.patch.object(feed_sync, "FEED_SYNC_POLL_INTERVAL", 0.05):
+            stream = self.client.get("/feed_sync", headers={**self.headers, "Accept": "text/event-stream"},
+                                     query_string={"centro_id": "centro-test", "device_id": "equipo-1"})
+            self.assertEqual(stream.mimetype, "text/event-stream")
+            text = stream.get_data(as_text=True)
+            self.assertEqual(text.count("event: estudio"), 3)
+            ids = [line[4:] for line in text.splitlines() if line.startswith("id: ")]
+
+            resumed = self.client.get("/feed_sync", headers={
+                **self.headers, "Accept": "text/event-stream", "Last-Event-ID": ids[0],
+            }, query_string={"centro_id": "centro-test", "device_id": "equipo-1"}).get_data(as_text=True)
+        self.assertEqual(resumed.count("event: estudio"), 2)
+        self.assertIn("event: fin", resumed)
+
+    def test_feed_sync_caps_open_streams_per_process(self):
+        import feed_sync
+        query = {"centro_id": "centro-test", "device_id": "equipo-1"}
+        with mock.patch.object(feed_sync, "stream_slots", feed_sync.StreamSlots(1)), \
+                mock.patch.object(feed_sync, "FEED_SYNC_SSE_MAX", 0.1), \
+                mock.patch.object(feed_sync, "FEED_SYNC_POLL_INTERVAL", 0.05):
+            stream = self.client.get("/feed_sync", headers={**self.headers, "Accept": "text/event-stream"},
+                                     query_string=query)
+            busy = self.client.get("/feed_sync", headers=self.headers, query_string={**query, "wait": 1})
+            self.assertEqual(busy.status_code, 503)
+            self.assertEqual(busy.headers["Retry-After"], str(feed_sync.FEED_SYNC_RETRY_AFTER))
+            # Sin espera no se ocupa un hilo: la página se sirve igual.
+            self.assertEqual(self.client.get("/feed_sync", headers=self.headers, query_string=query).status_code, 200)
+
+            stream.get_data()
+            stream.close()
+            polled = self.client.get("/feed_sync", headers=self.headers, query_string={**query, "wait": 0.1})
+            self.assertEqual(polled.status_code, 200)
+            self.assertEqual(self.client.get("/feed_sync", headers=self.headers,
+                                             query_string={**query, "wait": 0.1}).status_code, 200)
+
+    def test_centro_feed_mode_writes_each_report_once(self):
+        devices = {f"equipo-{n}": {} for n in range(1, 6)}
+        FakeReference.reset({
+            "/ecosistemas/centro-test/dispositivos": devices,
+            "/ecosistemas/centro-test/feed_config": {"modo": "centro", "legacy": {"equipo-5": True}},
+        })
+        save = self.client.post("/push_feed", headers=self.headers, json=self.identity)
+        self.assertEqual(save.status_code, 200)
+        self.assertEqual(set(save.get_json()["pushed"]), set(devices))
+        _, update = FakeReference.updates[0]
+        feed_paths = sorted(path for path in update if "feed" in path)
+        key = save.get_json()["pushed"]["equipo-1"]
+        self.assertEqual(feed_paths, [f"dispositivos/equipo-5/feed_estudios/{key}", f"feed_centro/{key}"])
+
+        query = {"centro_id": "centro-test", "device_id": "equipo-1"}
+        page = self.client.get("/feed_sync", headers=self.headers, query_string=query).get_json()
+        self.assertEqual([item["key"] for item in page["items"]], [key])
+        legacy = self.client.get("/feed_sync", headers=self.headers,
+                                 query_string={**query, "device_id": "equipo-5"}).get_json()
+        self.assertEqual([item["key"] for item in legacy["items"]], [key])
+
+        ack = self.client.post("/feed_sync/cursor", headers=self.headers, json={**query, "cursor": key})
+        self.assertEqual(ack.status_code, 200)
+        self.assertEqual(self.client.get("/feed_sync", headers=self.headers, query_string=query).get_json()["items"], [])
+        self.client.post("/feed_sync/cursor", headers=self.headers, json={**query, "device_id": "equipo-5", "cursor": key})
+        self.assertFalse(FakeReference.read("/ecosistemas/centro-test/feed_config").get("legacy"))
+        again = self.client.post("/push_feed", headers=self.headers, json=self.identity).get_json()
+        feed_paths = [path for path in FakeReference.updates[-1][1] if "feed" in path]
+        self.assertEqual(feed_paths, [f"feed_centro/{again['pushed']['equipo-1']}"])
+
+    def test_migration_merges_device_feeds_into_centro_feed(self):
+        import centro_feed
+        FakeReference.reset({"/ecosistemas/centro-test/dispositivos": {"equipo-1": {}, "equipo-2": {}, "equipo-3": {}}})
+        for n in range(3):
+            self.client.post("/push_feed", headers=self.headers, json={**self.identity, "codigo_unico": f"MIG-{n}"})
+        FakeReference.write("/ecosistemas/centro-test/dispositivos/equipo-4", {"nombre": "sin feed"})
+
+        stats = centro_feed.migrate_centro("centro-test", legacy=["equipo-3"], drop_device_feeds=True, settle=0)
+        self.assertEqual((stats["entries"], stats["dropped"]), (3, 3))
+        merged = FakeReference.read("/ecosistemas/centro-test/feed_centro")
+        self.assertEqual(sorted(entry["codigo_unico"] for entry in merged.values()), ["MIG-0", "MIG-1", "MIG-2"])
+        self.assertIsNone(FakeReference.read("/ecosistemas/centro-test/dispositivos/equipo-1/feed_estudios"))
+        self.assertEqual(len(FakeReference.read("/ecosistemas/centro-test/dispositivos/equipo-3/feed_estudios")), 3)
+        self.assertEqual(FakeReference.read("/ecosistemas/centro-test/dispositivos/equipo-2/feed_cursor")["key"], max(merged))
+        self.assertIsNone(FakeReference.read("/ecosistemas/centro-test/dispositivos/equipo-4/feed_cursor"))
+
+        query = {"centro_id": "centro-test", "device_id": "equipo-2"}
+        self.assertEqual(self.client.get("/feed_sync", headers=self.headers, query_string=query).get_json()["items"], [])
+        again = centro_feed.migrate_centro("centro-test", legacy=["equipo-3"], settle=0)
+        self.assertEqual(again["entries"], 0)
+
+    def test_push_ids_are_time_ordered(self):
+        ids = [service.generate_push_id(1_700_000_000_000) for _ in range(50)]
+        ids.append(service.generate_push_id(1_700_000_000_001))
+        self.assertEqual(ids, sorted(ids))
+        self.assertEqual(len(set(ids)), len(ids))
+        self.assertTrue(all(len(push_id) == 20 for push_id in ids))
+
+    def test_restore_is_served_from_cache_until_next_save(self):
+        self.client.post("/push_feed", headers=self.headers, json={
+            **self.identity,
+            "estado_reporte": {"version": "v1"},
+        })
+        state_path = "/ecosistemas/centro-test/estados_reportes/" + service.report_state_key(
+            "centro-test", "TEST-ESTADO-001"
+        )
+        for _ in range(3):
+            restore = self.client.post("/recuperar_estado_reporte", headers=self.headers,
+                                       json=self.identity)
+            self.assertEqual(restore.get_json()["estado_reporte"], {"version": "v1"})
+        # El guardado deja el estado en caché (write-through): ninguna lectura del head.
+        state_reads = [read for read in FakeReference.gets if read[0] == state_path]
+        self.assertEqual(state_reads, [])
+        self.assertEqual(service.cache.stats()["hits"], 3)
+
+        self.client.post("/push_feed", headers=self.headers, json={
+            **self.identity,
+            "estado_reporte": {"version": "v2"},
+        })
+        restore = self.client.post("/recuperar_estado_reporte", headers=self.headers,
+                                   json=self.identity)
+        self.assertEqual(restore.get_json()["estado_reporte"], {"version": "v2"})
+
+    def test_sqlite_cache_is_shared_between_instances(self):
+        import read_cache
+        path = os.path.join(self.blob_dir.name, "cache.sqlite3")
+        first = read_cache.ReadThroughCache(read_cache.SQLiteBackend(path))
+        second = read_cache.ReadThroughCache(read_cache.SQLiteBackend(path))
+        self.assertEqual(first.get_or_load("k", lambda: {"a": 1}), {"a": 1})
+        self.assertEqual(second.get_or_load("k", lambda: self.fail("debió ser hit")), {"a": 1})
+        second.invalidate("k")
+        self.assertEqual(first.get_or_load("k", lambda: {"a": 2}), {"a": 2})
+        self.assertEqual((first.stats()["misses"], second.stats()["hits"]), (2, 1))
+
+    def test_async_mode_queues_and_drains_push_feed(self):
+        from write_queue import WriteQueue
+
+        path = os.path.join(self.blob_dir.name, "queue.sqlite3")
+        queue = WriteQueue({"push_feed": service.persist_report}, path=path)
+        with mock.patch.object(service, "ASYNC_WRITES", True), \
+                mock.patch.object(service, "write_queue", queue):
+            save = self.client.post("/guardar-reporte", headers=self.headers, json={
+                **self.identity,
+                "estado_reporte": {"version": "v1"},
+            })
+            self.assertEqual(save.status_code, 202)
+            job_id = save.get_json()["respuesta"]["job_id"]
+            self.assertEqual(FakeReference.updates, [])
+
+            pending = self.client.get(f"/push_feed/jobs/{job_id}", headers=self.headers)
+            self.assertEqual(pending.get_json()["status"], "pending")
+
+            self.assertEqual(queue.drain(), 1)
+            done = self.client.get(f"/push_feed/jobs/{job_id}", headers=self.headers).get_json()
+        self.assertEqual(done["status"], "done")
+        self.assertIn("equipo-1", done["result"]["body"]["pushed"])
+        self.assertEqual(len(FakeReference.pushes), 1)
+
+    def test_autosaves_are_coalesced_and_final_save_flushes_now(self):
+        from coalescer import SaveCoalescer
+
+        path = os.path.join(self.blob_dir.name, "coalesce.sqlite3")
+        saves = SaveCoalescer(service.flush_autosave, path=path, debounce=60, max_delay=120)
+        draft = lambda text: {**self.identity, "estatus": "EN_PROCESO", "estado_reporte": {"texto": text}}
+        with mock.patch.object(service, "save_coalescer", saves):
+            for text in ("h", "hall", "hallazgos"):
+                autosave = self.client.post("/push_feed", headers=self.headers, json=draft(text))
+                self.assertEqual(autosave.status_code, 202)
+                self.assertTrue(autosave.get_json()["coalesced"])
+            self.assertEqual(FakeReference.updates, [])
+
+            saves.debounce = 0
+            self.assertEqual(saves.drain(), 1)
+            self.assertEqual(len(FakeReference.updates), 1)
+            self.assertEqual(len(FakeReference.pushes), 1)
+
+            unchanged = self.client.post("/push_feed", headers=self.headers, json=draft("hallazgos"))
+            self.assertEqual(unchanged.status_code, 200)
+            self.assertTrue(unchanged.get_json()["skipped"])
+
+            saves.debounce = 60
+            self.client.post("/push_feed", headers=self.headers, json=draft("hallazgos sin cambios"))
+            final = self.client.post("/push_feed", headers=self.headers, json={
+                **draft("hallazgos sin cambios agudos"), "estatus": "REPORTADO",
+            })
+            self.assertEqual(final.status_code, 200)
+            self.assertEqual(saves.drain(), 0)
+
+        self.assertEqual(len(FakeReference.pushes), 2)
+        restore = self.client.post("/recuperar_estado_reporte", headers=self.headers, json=self.identity)
+        self.assertEqual(restore.get_json()["estado_reporte"], {"texto": "hallazgos sin cambios agudos"})
+
+    def test_batch_and_queued_saves_supersede_pending_autosaves(self):
+        from coalescer import SaveCoalescer
+        from write_queue import WriteQueue
+
+        saves = SaveCoalescer(service.flush_autosave, path=os.path.join(self.blob_dir.name, "coalesce.sqlite3"),
+                              debounce=60, max_delay=120)
+        draft = lambda text: {**self.identity, "estatus": "EN_PROCESO", "estado_reporte": {"texto": text}}
+        final = {**draft("final"), "estatus": "REPORTADO"}
+        with mock.patch.object(service, "save_coalescer", saves):
+            self.assertEqual(self.client.post("/push_feed", headers=self.headers, json=draft("borrador")).status_code, 202)
+            batch = self.client.post("/push_feed_batch", headers=self.headers, json={"reportes": [draft("del lote")]})
+            self.assertEqual(batch.get_json()["guardados"], 1)
+            saves.debounce = 0
+            self.assertEqual(saves.drain(), 0)
+            # El hash del lote también cuenta: repetir ese contenido no escribe.
+            repeated = self.client.post("/push_feed", headers=self.headers, json=draft("del lote"))
+            self.assertTrue(repeated.get_json()["skipped"])
+
+            # En modo asíncrono el flush pasa por la cola, detrás de lo ya encolado.
+            saves.debounce = 60
+            queue = WriteQueue({"push_feed": service.persist_report, "push_feed_batch": service.persist_batch},
+                               path=os.path.join(self.blob_dir.name, "queue.sqlite3"))
+            with mock.patch.object(service, "ASYNC_WRITES", True), mock.patch.object(service, "write_queue", queue):
+                self.client.post("/push_feed", headers=self.headers, json=draft("borrador 2"))
+                queued = self.client.post("/push_feed_batch", headers=self.headers,
+                                          json={"reportes": [{**final, "estado_reporte": {"texto": "final 2"}}]})
+                self.assertEqual(queued.status_code, 202)
+                saves.debounce = 0
+                self.assertEqual(saves.drain(), 0)
+                self.client.post("/push_feed", headers=self.headers, json=draft("borrador 3"))
+                self.assertEqual(saves.drain(), 1)
+                self.assertEqual(queue.drain(), 2)
+
+        restore = self.client.post("/recuperar_estado_reporte", headers=self.headers, json=self.identity)
+        self.assertEqual(restore.get_json()["estado_reporte"], {"texto": "borrador 3"})
+
+    def test_final_save_is_handed_to_the_flusher_instead_of_waiting(self):
+        import json
+        from coalescer import SaveCoalescer
+
+        path = os.path.join(self.blob_dir.name, "coalesce.sqlite3")
+        saves = SaveCoalescer(service.flush_autosave, path=path, debounce=0, max_delay=120, take_wait=0.1)
+        other_worker = SaveCoalescer(service.flush_autosave, path=path, debounce=0, max_delay=120)
+        draft = {**self.identity, "estatus": "EN_PROCESO", "estado_reporte": {"texto": "borrador"}}
+        final = {**self.identity, "estatus": "REPORTADO", "estado_reporte": {"texto": "final"}}
+        with mock.patch.object(service, "save_coalescer", saves):
+            self.client.post("/push_feed", headers=self.headers, json=draft)
+            key, payload = other_worker._claim()  # otro worker empieza a escribir el borrador
+
+            started = time.monotonic()
+            handed = self.client.post("/push_feed", headers=self.headers, json=final)
+            self.assertLess(time.monotonic() - started, 1)
+            self.assertEqual(handed.status_code, 202)
+            self.assertEqual(FakeReference.updates, [])
+
+            other_worker.handler(json.loads(payload))
+            other_worker._finish(key, retry=False)
+            self.assertEqual(saves.drain(), 1)
+
+        restore = self.client.post("/recuperar_estado_reporte", headers=self.headers, json=self.identity)
+        self.assertEqual(restore.get_json()["estado_reporte"], {"texto": "final"})
+
+    def test_write_queue_retries_and_replays_after_restart(self):
+        from write_queue import WriteQueue
+
+        path = os.path.join(self.blob_dir.name, "queue.sqlite3")
+        calls = []
+
+        def flaky(payload):
+            calls.append(payload)
+            if len(calls) == 1:
+                raise RuntimeError("RTDB no disponible")
+            return 200, {"ok": True}
+
+        queue = WriteQueue({"push_feed": flaky}, path=path, backoff_base=0)
+        job_id = queue.enqueue("push_feed", {"n": 1})
+        queue.drain()
+        self.assertEqual(queue.status(job_id)["status"], "done")
+        self.assertEqual(queue.status(job_id)["attempts"], 2)
+
+        # Un trabajo tomado por un proceso que murió se reanuda al vencer el lease.
+        crashed = WriteQueue({"push_feed": flaky}, path=path, lease=-1)
+        orphan = crashed.enqueue("push_feed", {"n": 2})
+        crashed._claim()
+        restarted = WriteQueue({"push_feed": flaky}, path=path)
+        self.assertEqual(restarted.drain(), 1)
+        self.assertEqual(restarted.status(orphan)["status"], "done")
+
+    def test_write_queue_runs_jobs_of_the_same_report_in_order(self):
+        from write_queue import WriteQueue
+
+        ran = []
+
+        def handler(payload):
+            ran.append(payload["n"])
+            if payload["n"] == 1 and ran.count(1) == 1:
+                raise RuntimeError("RTDB no disponible")
+            return 200, {"ok": True}
+
+        queue = WriteQueue({"push_feed": handler}, path=os.path.join(self.blob_dir.name, "queue.sqlite3"),
+                           backoff_base=60)
+        first = queue.enqueue("push_feed", {"n": 1}, keys=["reporte-a"])
+        queue.enqueue("push_feed", {"n": 2}, keys=["reporte-a"])
+        queue.enqueue("push_feed", {"n": 3}, keys=["reporte-b"])
+
+        # El 1 falla y espera su reintento: el 2 (mismo reporte) no se le adelanta.
+        self.assertEqual(queue.drain(), 2)
+        self.assertEqual(ran, [1, 3])
+        queue._conn().execute("UPDATE jobs SET next_attempt = 0 WHERE id = ?", (first,))
+        self.assertEqual(queue.drain(), 2)
+        self.assertEqual(ran, [1, 3, 1, 2])
+
+    def test_write_queue_reopens_connections_inherited_by_fork(self):
+        from write_queue import WriteQueue
+
+        queue = WriteQueue({"push_feed": lambda payload: (200, {"ok": True})},
+                           path=os.path.join(self.blob_dir.name, "queue.sqlite3"))
+        inherited = queue._conn()
+        self.assertIs(queue._conn(), inherited)
+        with mock.patch("write_queue.os.getpid", return_value=os.getpid() + 1):
+            self.assertIsNot(queue._conn(), inherited)
+
+    def test_state_saves_send_only_changed_leaves(self):
+        state = {"hallazgos": {"eje": "normal", "listesis": False}, "notas": "x" * 500}
+        first = self.client.post("/push_feed", headers=self.headers, json={
+            **self.identity, "estado_reporte": state,
+        })
+        self.assertEqual(first.get_json()["version"], 1)
+
+        state = {**state, "hallazgos": {"eje": "escoliosis", "listesis": False}}
+        second = self.client.post("/push_feed", headers=self.headers, json={
+            **self.identity, "estado_reporte": state,
+        })
+        self.assertEqual(second.get_json()["version"], 2)
+        key = service.report_state_key("centro-test", "TEST-ESTADO-001")
+        _, update = FakeReference.updates[-1]
+        self.assertNotIn(f"estados_reportes/{key}", update)
+        self.assertEqual(update[f"estados_reportes/{key}/estado_reporte/hallazgos/eje"], "escoliosis")
+        self.assertNotIn(f"estados_reportes/{key}/estado_reporte/notas", update)
+
+        service.cache.clear()
+        restore = self.client.post("/recuperar_estado_reporte", headers=self.headers,
+                                   json=self.identity).get_json()
+        self.assertEqual((restore["estado_reporte"], restore["version"]), (state, 2))
+
+    def test_saves_planned_on_the_same_head_never_share_a_version(self):
+        self.client.post("/push_feed", headers=self.headers, json={**self.identity, "estado_reporte": {"a": 0, "b": 0}})
+        report_a, _ = service.build_report(service.normalize_payload({**self.identity, "estado_reporte": {"a": 1, "b": 0}}))
+        report_b, _ = service.build_report(service.normalize_payload({**self.identity, "estado_reporte": {"a": 0, "b": 1}}))
+        real_fetch = service.fetch_head
+        stale = iter([real_fetch(report_b)])
+        self.assertEqual(service.persist_report(report_a)[1]["version"], 2)
+
+        # B se planea sobre la v1 que leyó antes de que A escribiera.
+        with mock.patch.object(service, "fetch_head", side_effect=lambda report: next(stale, None) or real_fetch(report)):
+            status, body = service.persist_report(report_b)
+        self.assertEqual((status, body["version"]), (200, 3))
+
+        service.cache.clear()
+        latest = self.client.post("/recuperar_estado_reporte", headers=self.headers, json=self.identity).get_json()
+        self.assertEqual((latest["estado_reporte"], latest["version"]), ({"a": 0, "b": 1}, 3))
+        older = self.client.post("/recuperar_estado_reporte", headers=self.headers,
+                                 json={**self.identity, "version": 2}).get_json()
+        self.assertEqual(older["estado_reporte"], {"a": 1, "b": 0})
+        key = service.report_state_key("centro-test", "TEST-ESTADO-001")
+        self.assertNotIn("reservada", FakeReference.read(f"/ecosistemas/centro-test/estados_reportes_meta/{key}"))
+        self.assertEqual(FakeReference.read(f"/ecosistemas/centro-test/estados_reportes_lock/{key}"), {"version": 3})
+
+    def test_metadata_restore_ignores_a_claim_that_was_never_written(self):
+        import state_versions
+        self.client.post("/push_feed", headers=self.headers, json={**self.identity, "estado_reporte": {"a": 1}})
+        key = service.report_state_key("centro-test", "TEST-ESTADO-001")
+        # El worker reserva la v2 y cae antes del update: la reserva nunca se libera.
+        state_versions.claim_version("centro-test", key, 1)
+        service.cache.clear()
+
+        probe = self.client.post("/recuperar_estados_reportes", headers=self.headers, json={
+            "centro_id": "centro-test", "email_usuario": "test@example.com",
+            "codigos_unicos": ["TEST-ESTADO-001"], "solo_metadatos": True,
+        }).get_json()["estados"]["TEST-ESTADO-001"]
+        full = self.client.post("/recuperar_estado_reporte", headers=self.headers, json=self.identity).get_json()
+        self.assertEqual((probe["existe"], probe["version"]), (True, 1))
+        self.assertEqual(full["version"], 1)
+
+        with mock.patch.object(service, "STATE_RETRY_DELAY", 0):
+            busy = self.client.post("/push_feed", headers=self.headers, json={**self.identity, "estado_reporte": {"a": 2}})
+        self.assertEqual(busy.status_code, 409)
+        with mock.patch.object(state_versions, "STATE_CLAIM_TTL", 0):
+            saved = self.client.post("/push_feed", headers=self.headers, json={**self.identity, "estado_reporte": {"a": 2}})
+        self.assertEqual(saved.get_json()["version"], 2)
+
+    def test_client_patch_requires_matching_base_version(self):
+        self.client.post("/push_feed", headers=self.headers, json={
+            **self.identity, "estado_reporte": {"a": 1, "b": {"c": 2}},
+        })
+        patch = [{"op": "replace", "path": "/b/c", "value": 3}, {"op": "add", "path": "/d", "value": 4}]
+        saved = self.client.post("/push_feed", headers=self.headers, json={
+            **self.identity, "estado_reporte_patch": patch, "base_version": 1,
+        })
+        self.assertEqual(saved.status_code, 200)
+        self.assertEqual(saved.get_json()["version"], 2)
+
+        stale = self.client.post("/push_feed", headers=self.headers, json={
+            **self.identity, "estado_reporte_patch": patch, "base_version": 1,
+        })
+        self.assertEqual(stale.status_code, 409)
+        self.assertEqual(stale.get_json()["version"], 2)
+
+        restore = self.client.post("/recuperar_estado_reporte", headers=self.headers,
+                                   json=self.identity).get_json()
+        self.assertEqual(restore["estado_reporte"], {"a": 1, "b": {"c": 3}, "d": 4})
+
+    def test_restore_rebuilds_requested_version_after_compaction(self):
+        import state_versions
+
+        states = [{"paso": n, "texto": f"borrador {n}"} for n in range(1, 8)]
+        with mock.patch.object(state_versions, "STATE_SNAPSHOT_EVERY", 3), \
+                mock.patch.object(state_versions, "STATE_HISTORY_SNAPSHOTS", 2), \
+                mock.patch.object(state_versions, "_executor", InlineExecutor()):
+            for state in states:
+                self.client.post("/push_feed", headers=self.headers, json={
+                    **self.identity, "estado_reporte": state,
+                })
+
+        key = service.report_state_key("centro-test", "TEST-ESTADO-001")
+        history = FakeReference.read(f"/ecosistemas/centro-test/estados_reportes_historial/{key}")
+        self.assertEqual(sorted(history["snapshots"]), ["v00000004", "v00000007"])
+        self.assertEqual(sorted(history["deltas"]), ["v00000005", "v00000006", "v00000007"])
+
+        for version in (4, 5, 6, 7):
+            restore = self.client.post("/recuperar_estado_reporte", headers=self.headers,
+                                       json={**self.identity, "version": version}).get_json()
+            self.assertEqual(restore["estado_reporte"], states[version - 1])
+        gone = self.client.post("/recuperar_estado_reporte", headers=self.headers,
+                                json={**self.identity, "version": 2})
+        self.assertEqual(gone.status_code, 404)
+
+    def test_batch_groups_writes_per_centro_with_per_item_results(self):
+        FakeReference.write("/ecosistemas/centro-2/dispositivos", {"sala-a": {}, "sala-b": {}})
+        reportes = [
+            {**self.identity, "codigo_unico": "LOTE-1", "estado_reporte": {"v": 1}},
+            {**self.identity, "codigo_unico": "LOTE-2"},
+            {"codigo_unico": "SIN-EMAIL", "centro_id": "centro-test"},
+            {**self.identity, "centro_id": "centro-2", "codigo_unico": "LOTE-3"},
+            {**self.identity, "codigo_unico": "LOTE-1", "estado_reporte": {"v": 2}},
+            {**self.identity, "centro_id": "centro-vacio", "codigo_unico": "LOTE-4"},
+        ]
+        result = self.client.post("/push_feed_batch", headers=self.headers,
+                                  json={"reportes": reportes})
+        self.assertEqual(result.status_code, 200)
+        body = result.get_json()
+        self.assertEqual([item["status"] for item in body["results"]], [200, 200, 400, 200, 200, 400])
+        self.assertEqual((body["guardados"], body["fallidos"]), (4, 2))
+        self.assertEqual(set(body["results"][3]["pushed"]), {"sala-a", "sala-b"})
+
+        # centro-test: dos rondas (LOTE-1 aparece dos veces); centro-2: una.
+        self.assertEqual(
+            sorted(path for path, _ in FakeReference.updates),
+            ["/ecosistemas/centro-2", "/ecosistemas/centro-test", "/ecosistemas/centro-test"],
+        )
+        device_reads = [read for read in FakeReference.gets if read[0].endswith("/dispositivos")]
+        self.assertEqual(len(device_reads), 3)
+
+        restore = self.client.post("/recuperar_estado_reporte", headers=self.headers,
+                                   json={**self.identity, "codigo_unico": "LOTE-1"}).get_json()
+        self.assertEqual((restore["estado_reporte"], restore["version"]), ({"v": 2}, 2))
+
+    def test_batch_rejects_non_list_payload(self):
+        result = self.client.post("/push_feed_batch", headers=self.headers, json={"reportes": {}})
+        self.assertEqual(result.status_code, 400)
+
+    def test_bulk_restore_checks_ownership_per_study(self):
+        for codigo, email in (("W-1", "test@example.com"), ("W-2", "otro@example.com")):
+            self.client.post("/push_feed", headers=self.headers, json={
+                **self.identity, "codigo_unico": codigo, "email_usuario": email,
+                "estado_reporte": {"codigo": codigo},
+            })
+        request = {
+            "centro_id": "centro-test",
+            "email_usuario": "test@example.com",
+            "codigos_unicos": ["W-1", "W-2", "W-3"],
+        }
+        result = self.client.post("/recuperar_estados_reportes", headers=self.headers, json=request)
+        self.assertEqual(result.status_code, 200)
+        estados = result.get_json()["estados"]
+        self.assertEqual(estados["W-1"]["estado_reporte"], {"codigo": "W-1"})
+        self.assertEqual(estados["W-2"], {"existe": False})
+        self.assertEqual(estados["W-3"], {"existe": False})
+
+    def test_bulk_restore_metadata_only_skips_state_bodies(self):
+        self.client.post("/push_feed", headers=self.headers, json={
+            **self.identity, "estado_reporte": {"grande": "x" * 1000},
+        })
+        service.cache.clear()
+        FakeReference.gets = []
+        result = self.client.post("/recuperar_estados_reportes", headers=self.headers, json={
+            "centro_id": "centro-test",
+            "email_usuario": "test@example.com",
+            "codigos_unicos": ["TEST-ESTADO-001"],
+            "solo_metadatos": True,
+        })
+        entry = result.get_json()["estados"]["TEST-ESTADO-001"]
+        self.assertEqual(entry["existe"], True)
+        self.assertEqual(entry["version"], 1)
+        self.assertNotIn("estado_reporte", entry)
+        self.assertTrue(all("/estados_reportes_meta/" in path for path, _ in FakeReference.gets))
+
     def test_restore_hides_existing_state_when_email_does_not_match(self):
         self.client.post("/push_feed", headers=self.headers, json={
             **self.identity,
@@ -172,12 +911,13 @@ class ServidorSyncBubbleTest(unittest.TestCase):
         self.assertEqual(upload.status_code, 201)
         adjunto = upload.get_json()["adjunto"]
         self.assertEqual(adjunto["tipo"], "esquema_prostata")
-        self.assertTrue(adjunto["storage_path"].startswith("rtdb:/ecosistemas/"))
+        self.assertEqual(adjunto["storage_path"], f"blob:sha256/{adjunto['sha256']}")
         stored = service.attachment_ref(
             self.identity["centro_id"],
             self.identity["codigo_unico"],
         ).get()
-        self.assertEqual(stored["content_base64"], "iVBORw0KGgpjb250ZW5pZG8=")
+        self.assertNotIn("content_base64", stored)
+        self.assertEqual(self.blobs.read(adjunto["sha256"]), b"\x89PNG\r\n\x1a\ncontenido")
 
         saved = self.client.post("/push_feed", headers=self.headers, json={
             **self.identity,
@@ -201,6 +941,116 @@ class ServidorSyncBubbleTest(unittest.TestCase):
         self.assertEqual(body["mime_type"], "image/png")
         self.assertEqual(body["content_base64"], "iVBORw0KGgpjb250ZW5pZG8=")
 
+    def test_identical_uploads_share_one_blob(self):
+        import io
+        for codigo in ("TEST-A", "TEST-B"):
+            self.client.post("/subir_esquema_prostata", headers=self.headers, data={
+                **self.identity,
+                "codigo_unico": codigo,
+                "archivo": (io.BytesIO(b"\x89PNG\r\n\x1a\ncontenido"), "esquema.png"),
+            }, content_type="multipart/form-data")
+        stored = [
+            os.path.join(root, name)
+            for root, _, names in os.walk(self.blob_dir.name)
+            for name in names
+        ]
+        self.assertEqual(len(stored), 1)
+
+    def test_upload_is_streamed_in_chunks_with_limits(self):
+        import hashlib
+        import io
+
+        contenido = b"\x89PNG\r\n\x1a\n" + bytes(range(256)) * 40
+        with mock.patch.object(service, "UPLOAD_CHUNK_BYTES", 1024):
+            upload = self.client.post("/subir_esquema_prostata", headers=self.headers, data={
+                **self.identity,
+                "archivo": (io.BytesIO(contenido), "esquema.png"),
+            }, content_type="multipart/form-data")
+            self.assertEqual(upload.status_code, 201)
+            adjunto = upload.get_json()["adjunto"]
+            self.assertEqual(adjunto["size_bytes"], len(contenido))
+            self.assertEqual(adjunto["sha256"], hashlib.sha256(contenido).hexdigest())
+
+            with mock.patch.object(service, "MAX_ATTACHMENT_BYTES", 10000):
+                too_big = self.client.post("/subir_esquema_prostata", headers=self.headers, data={
+                    **self.identity,
+                    "archivo": (io.BytesIO(contenido), "esquema.png"),
+                }, content_type="multipart/form-data")
+            self.assertEqual(too_big.status_code, 413)
+
+        not_png = self.client.post("/subir_esquema_prostata", headers=self.headers, data={
+            **self.identity,
+            "archivo": (io.BytesIO(b"GIF89a..."), "esquema.png"),
+        }, content_type="multipart/form-data")
+        self.assertEqual(not_png.status_code, 400)
+        leftovers = os.listdir(os.path.join(self.blob_dir.name, ".staging"))
+        self.assertEqual(leftovers, [])
+
+    def test_raw_download_supports_etag_and_range(self):
+        import io
+        contenido = b"\x89PNG\r\n\x1a\ncontenido"
+        upload = self.client.post("/subir_esquema_prostata", headers=self.headers, data={
+            **self.identity,
+            "archivo": (io.BytesIO(contenido), "esquema.png"),
+        }, content_type="multipart/form-data")
+        digest = upload.get_json()["adjunto"]["sha256"]
+
+        full = self.client.get("/descargar_adjunto_reporte", headers=self.headers,
+                               query_string=self.identity)
+        self.assertEqual(full.status_code, 200)
+        self.assertEqual(full.mimetype, "image/png")
+        self.assertEqual(full.data, contenido)
+        self.assertEqual(full.headers["ETag"], f'"{digest}"')
+        self.assertIn("private", full.headers["Cache-Control"])
+        full.close()
+
+        cached = self.client.get("/descargar_adjunto_reporte", query_string=self.identity,
+                                 headers={**self.headers, "If-None-Match": f'"{digest}"'})
+        self.assertEqual(cached.status_code, 304)
+        self.assertEqual(cached.data, b"")
+
+        partial = self.client.get("/descargar_adjunto_reporte", query_string=self.identity,
+                                  headers={**self.headers, "Range": "bytes=0-7"})
+        self.assertEqual(partial.status_code, 206)
+        self.assertEqual(partial.data, contenido[:8])
+        partial.close()
+
+        posted = self.client.post("/descargar_adjunto_reporte", headers=self.headers,
+                                  json=self.identity)
+        self.assertEqual(posted.data, contenido)
+        posted.close()
+
+        other = self.client.get("/descargar_adjunto_reporte", headers=self.headers,
+                                query_string={**self.identity, "email_usuario": "otro@example.com"})
+        self.assertEqual(other.status_code, 404)
+
+    def test_legacy_base64_attachment_is_served_and_migrated(self):
+        service.attachment_ref("centro-test", "TEST-ESTADO-001").set({
+            "tipo": "esquema_prostata",
+            "storage_path": "rtdb:/legacy",
+            "mime_type": "image/png",
+            "codigo_unico": "TEST-ESTADO-001",
+            "email_usuario": "test@example.com",
+            "content_base64": "iVBORw0KGgpjb250ZW5pZG8=",
+        })
+        request = {**self.identity, "tipo": "esquema_prostata"}
+        before = self.client.post("/obtener_adjunto_reporte", headers=self.headers, json=request)
+        self.assertEqual(before.get_json()["content_base64"], "iVBORw0KGgpjb250ZW5pZG8=")
+
+        import read_cache
+
+        cache_key = service.attachment_cache_key("centro-test", "TEST-ESTADO-001")
+        self.assertIsNot(service.cache.backend.get(cache_key), read_cache._MISSING)
+        summary = blob_store.migrate_rtdb_attachments(self.blobs, on_migrated=service.invalidate_stored_attachment)
+        self.assertEqual(summary["migrated"], 1)
+        self.assertIs(service.cache.backend.get(cache_key), read_cache._MISSING)
+        stored = service.attachment_ref("centro-test", "TEST-ESTADO-001").get()
+        self.assertNotIn("content_base64", stored)
+        self.assertTrue(stored["storage_path"].startswith("blob:sha256/"))
+
+        after = self.client.post("/obtener_adjunto_reporte", headers=self.headers, json=request)
+        self.assertEqual(after.get_json()["content_base64"], "iVBORw0KGgpjb250ZW5pZG8=")
+
 
 if __name__ == "__main__":
     unittest.main()
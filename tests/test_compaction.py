@@ -0,0 +1,77 @@
+import unittest
+from unittest import mock
+
+from fake_firebase import FakeReference
+
+import compaction
+
+DAY_MS = 86400 * 1000
+NOW = 1_700_000_000_000
+
+
+def entry(codigo, updated_at):
+    return {"codigo_unico": codigo, "estatus": "REPORTADO", "updatedAt": updated_at}
+
+
+class CompactionTest(unittest.TestCase):
+    def setUp(self):
+        feed = {
+            "k1": entry("A", NOW - 3 * DAY_MS),
+            "k2": entry("A", NOW - 1 * DAY_MS),
+            "k3": entry("B", NOW - 200 * DAY_MS),
+            "k4": entry("C", NOW - 2 * DAY_MS),
+        }
+        FakeReference.reset({
+            "/ecosistemas/centro-test/dispositivos/equipo-1/feed_estudios": feed,
+            "/ecosistemas/centro-test/dispositivos/equipo-2/feed_estudios": feed,
+        })
+
+    def test_keeps_only_newest_entry_per_codigo(self):
+        feed = FakeReference.read("/ecosistemas/centro-test/dispositivos/equipo-1/feed_estudios")
+        self.assertEqual(compaction.select_prunable(feed, NOW), ["k1"])
+
+    def test_prunes_by_age_and_count(self):
+        feed = FakeReference.read("/ecosistemas/centro-test/dispositivos/equipo-1/feed_estudios")
+        self.assertEqual(
+            sorted(compaction.select_prunable(feed, NOW, max_age_ms=90 * DAY_MS)),
+            ["k1", "k3"],
+        )
+        self.assertEqual(
+            sorted(compaction.select_prunable(feed, NOW, max_count=1)),
+            ["k1", "k3", "k4"],
+        )
+
+    def test_dry_run_reports_bytes_without_deleting(self):
+        stats = compaction.compact_centro("centro-test", now_ms=NOW, max_age_days=90,
+                                          max_entries=0, dry_run=True)
+        self.assertEqual(stats["devices"], 2)
+        self.assertEqual(stats["pruned"], 4)
+        self.assertGreater(stats["bytes"], 0)
+        self.assertEqual(FakeReference.updates, [])
+
+    def test_compaction_deletes_in_batched_updates(self):
+        summary = compaction.compact_all(centros=["centro-test"], now_ms=NOW,
+                                         max_age_days=90, max_entries=0)
+        self.assertEqual(summary["pruned"], 4)
+        for device in ("equipo-1", "equipo-2"):
+            remaining = FakeReference.read(
+                f"/ecosistemas/centro-test/dispositivos/{device}/feed_estudios"
+            )
+            self.assertEqual(sorted(remaining), ["k2", "k4"])
+
+    def test_batches_pause_and_report_a_resume_point(self):
+        feed = FakeReference.read("/ecosistemas/centro-test/dispositivos/equipo-1/feed_estudios")
+        FakeReference.reset({f"/ecosistemas/c{n}/dispositivos/equipo-1/feed_estudios": feed for n in range(1, 4)})
+        with mock.patch.object(compaction.time, "sleep") as sleep, mock.patch("builtins.print"):
+            summary = compaction.compact_all(batch_size=2, pause=5, now_ms=NOW, max_age_days=90, max_entries=0)
+        sleep.assert_called_once_with(5)
+        self.assertEqual((summary["centros"], summary["last_centro"]), (3, "c3"))
+
+        with mock.patch("builtins.print"):
+            resumed = compaction.compact_all(centros=["c3", "c1", "c2"], start_after="c1", pause=0,
+                                             now_ms=NOW, max_age_days=90, max_entries=0)
+        self.assertEqual([stats["centro_id"] for stats in resumed["detail"]], ["c2", "c3"])
+
+
+if __name__ == "__main__":
+    unittest.main()
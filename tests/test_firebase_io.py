@@ -0,0 +1,56 @@
+import threading
+import time
+import unittest
+from concurrent.futures import Future
+
+from fake_firebase import FakeReference
+
+from firebase_io import FirebaseIO, FirebaseTimeout
+
+
+class FirebaseIOTest(unittest.TestCase):
+    def setUp(self):
+        FakeReference.reset({"/ecosistemas/centro-test/a": 1, "/ecosistemas/centro-test/b": 2})
+        self.io = FirebaseIO(concurrency=4, timeout=2)
+
+    def test_independent_operations_overlap(self):
+        barrier = threading.Barrier(3, timeout=1)
+
+        def slow(value):
+            barrier.wait()
+            return value
+
+        self.assertEqual(self.io.map(slow, [1, 2, 3]), [1, 2, 3])
+
+    def test_timeout_raises_and_cancels(self):
+        release = threading.Event()
+        self.addCleanup(release.set)
+        future = self.io.submit(release.wait, 5)
+        with self.assertRaises(FirebaseTimeout):
+            self.io.wait(future, timeout=0.05)
+
+    def test_nested_calls_run_inline_on_pool_threads(self):
+        io = FirebaseIO(concurrency=1, timeout=2)
+        # Con un solo hilo, una llamada anidada encolada nunca terminaría.
+        self.assertEqual(io.call(lambda: io.get("/ecosistemas/centro-test/a")), 1)
+
+    def test_gather_cancels_pending_on_error(self):
+        io = FirebaseIO(concurrency=1, timeout=2)
+        release = threading.Event()
+        self.addCleanup(release.set)
+        io.submit(release.wait, 1)  # ocupa el único hilo
+        queued = io.submit(time.sleep, 0)
+        failed = Future()
+        failed.set_exception(RuntimeError("boom"))
+        with self.assertRaises(RuntimeError):
+            io.gather(failed, queued)
+        self.assertTrue(queued.cancelled())
+
+    def test_update_and_query(self):
+        self.io.update("/ecosistemas/centro-test", {"c": 3})
+        self.assertEqual(self.io.query("/ecosistemas/centro-test", start_at="b"), {"b": 2, "c": 3})
+        self.assertEqual(self.io.get("/ecosistemas/centro-test", shallow=True), {"a": True, "b": True, "c": True})
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,150 @@
+import hashlib
+import importlib
+import io
+import os
+import struct
+import tempfile
+import unittest
+import zlib
+from unittest import mock
+
+from fake_firebase import FakeReference
+
+os.environ.setdefault("PUSH_FEED_TOKEN", "test-token")
+service = importlib.import_module("app")
+import blob_store
+import png_optimize
+
+
+def chunk(kind, body):
+    return struct.pack(">I", len(body)) + kind + body + struct.pack(">I", zlib.crc32(kind + body))
+
+
+def paeth_filter(row, prev, bpp):
+    out = bytearray(len(row))
+    for i in range(len(row)):
+        a = row[i - bpp] if i >= bpp else 0
+        c = prev[i - bpp] if i >= bpp else 0
+        p = a + prev[i] - c
+        predictor = min((abs(p - a), 0, a), (abs(p - prev[i]), 1, prev[i]), (abs(p - c), 2, c))[2]
+        out[i] = (row[i] - predictor) & 0xFF
+    return bytes(out)
+
+
+def canvas_png(width=120, height=80, color_type=6, pixel=None):
+    """A poorly compressed canvas-style PNG: Paeth rows, zlib level 1, text chunks."""
+    channels = png_optimize.CHANNELS[color_type]
+    pixel = pixel or (lambda x, y: (255, 255, 255, 255) if (x - 60) ** 2 + (y - 40) ** 2 > 600 else (190, 20, 20, 255))
+    rows, prev = [], bytes(width * channels)
+    for y in range(height):
+        row = bytes(value for x in range(width) for value in pixel(x, y)[:channels])
+        rows.append(b"\x04" + paeth_filter(row, prev, channels))
+        prev = row
+    return (png_optimize.PNG_SIGNATURE
+            + chunk(b"IHDR", struct.pack(">IIBBBBB", width, height, 8, color_type, 0, 0, 0))
+            + chunk(b"tEXt", b"Software\x00Bubble canvas export")
+            + chunk(b"IDAT", zlib.compress(b"".join(rows), 1))
+            + chunk(b"IEND", b""))
+
+
+def pixels(data):
+    return png_optimize.rgba(png_optimize.decode(data))
+
+
+class PNGOptimizeTest(unittest.TestCase):
+    def test_flat_canvas_becomes_a_packed_palette_without_pixel_changes(self):
+        original = canvas_png()
+        optimized, details = png_optimize.optimize(original)
+        self.assertLess(len(optimized), len(original) // 2)
+        self.assertEqual((details["color_type"], details["bit_depth"]), (3, 1))
+        self.assertEqual(pixels(optimized), pixels(original))
+        self.assertNotIn(b"tEXt", optimized)
+
+    def test_many_colors_keep_their_type_and_transparency(self):
+        gradient = lambda x, y: (x * 2, y * 3, (x * y) % 256, 128 if x < 10 else 255)
+        original = canvas_png(color_type=6, pixel=gradient)
+        optimized, details = png_optimize.optimize(original)
+        self.assertEqual(details["color_type"], 6)
+        self.assertEqual(pixels(optimized), pixels(original))
+
+        gray = canvas_png(color_type=2, pixel=lambda x, y: (x, x, x))
+        optimized, details = png_optimize.optimize(gray)
+        self.assertEqual(details["color_type"], 0)
+        self.assertEqual(pixels(optimized), pixels(gray))
+
+    def test_invalid_or_unsupported_input_is_left_alone(self):
+        self.assertIsNone(png_optimize.optimize(b"\x89PNG\r\n\x1a\ncontenido"))
+        damaged = bytearray(canvas_png())
+        damaged[40] ^= 0xFF
+        self.assertIsNone(png_optimize.optimize(bytes(damaged)))
+
+    def test_optimization_runs_in_a_bounded_child_process(self):
+        original = canvas_png()
+        self.assertEqual(png_optimize.optimize_in_subprocess(original), png_optimize.optimize(original))
+        self.assertIsNone(png_optimize.optimize_in_subprocess(original, timeout=0))
+
+
+class OptimizedUploadTest(unittest.TestCase):
+    def setUp(self):
+        FakeReference.reset({"/ecosistemas/centro-test/dispositivos": {"equipo-1": {}}})
+        service.cache.clear()
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+        blob_store.set_blob_store(blob_store.LocalBlobStore(self.tmp.name))
+        for patcher in (mock.patch.object(png_optimize, "PNG_OPTIMIZE", True),
+                        mock.patch.object(png_optimize, "_executor", InlineExecutor())):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.client = service.app.test_client()
+        self.headers = {"Authorization": f"Bearer {os.environ['PUSH_FEED_TOKEN']}"}
+        self.identity = {"codigo_unico": "PNG-1", "centro_id": "centro-test", "email_usuario": "a@example.com"}
+
+    def test_upload_is_optimized_in_the_background_and_served_smaller(self):
+        original = canvas_png()
+        upload = self.client.post("/subir_esquema_prostata", headers=self.headers, data={
+            **self.identity, "archivo": (io.BytesIO(original), "esquema.png", "image/png"),
+        }, content_type="multipart/form-data")
+        self.assertEqual(upload.status_code, 201)
+        self.assertEqual(upload.get_json()["adjunto"]["size_bytes"], len(original))
+
+        record = FakeReference.read(service.attachment_database_path("centro-test", "PNG-1"))
+        self.assertEqual(record["original_size_bytes"], len(original))
+        self.assertEqual(record["original_sha256"], upload.get_json()["adjunto"]["sha256"])
+        self.assertLess(record["size_bytes"], len(original))
+
+        download = self.client.get("/descargar_adjunto_reporte", headers=self.headers, query_string=self.identity)
+        self.assertEqual(download.status_code, 200)
+        self.assertEqual(len(download.data), record["size_bytes"])
+        self.assertEqual(pixels(download.data), pixels(original))
+
+    def test_optimized_blob_is_not_applied_over_a_newer_upload(self):
+        path = service.attachment_database_path("centro-test", "PNG-1")
+        FakeReference.reset({path: {"sha256": "nuevo", "size_bytes": 10}})
+        applied = service.apply_optimized_attachment("centro-test", "PNG-1", "viejo", "optimizado", 100, 50, {})
+        self.assertFalse(applied)
+        self.assertEqual(FakeReference.read(path), {"sha256": "nuevo", "size_bytes": 10})
+
+    def test_failures_applying_the_optimized_blob_are_logged(self):
+        store = blob_store.LocalBlobStore(self.tmp.name)
+        original = canvas_png()
+        digest = hashlib.sha256(original).hexdigest()
+        store.put(digest, original)
+        failing = mock.Mock(side_effect=RuntimeError("RTDB no disponible"))
+        with mock.patch("builtins.print") as log:
+            future = png_optimize.schedule_optimization(store, digest, failing)
+        self.assertIsNone(future.result())
+        failing.assert_called_once()
+        self.assertIn("RTDB no disponible", log.call_args[0][0])
+        self.assertTrue(log.call_args[0][0].startswith("[png]"))
+
+
+class InlineExecutor:
+    def submit(self, fn, *args, **kwargs):
+        from concurrent.futures import Future
+        future = Future()
+        future.set_result(fn(*args, **kwargs))
+        return future
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,121 @@
+import importlib
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+from fake_firebase import FakeReference
+
+os.environ.setdefault("PUSH_FEED_TOKEN", "test-token")
+service = importlib.import_module("app")
+import storage
+from firebase_io import fio
+
+
+class SQLiteStoreTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+        self.store = storage.SQLiteStore(os.path.join(self.tmp.name, "rtdb.sqlite3"))
+
+    def ref(self, path):
+        return self.store.reference(path)
+
+    def test_tree_reads_and_shallow_listing(self):
+        self.ref("/ecosistemas/c1/dispositivos").set({
+            "equipo-1": {"nombre": "Sala 1", "feed_estudios": {"k1": {"codigo_unico": "A", "updatedAt": 1}}},
+            "equipo-10": {"nombre": "Sala 10"},
+            "equipo-2": {"nombre": "Sala 2"},
+        })
+        self.assertEqual(
+            self.ref("/ecosistemas/c1/dispositivos").get(shallow=True),
+            {"equipo-1": True, "equipo-10": True, "equipo-2": True},
+        )
+        self.assertEqual(self.ref("/ecosistemas/c1/dispositivos/equipo-1/feed_estudios/k1/codigo_unico").get(), "A")
+        self.assertEqual(self.ref("/ecosistemas/c1/dispositivos/equipo-2").get(), {"nombre": "Sala 2"})
+        self.assertIsNone(self.ref("/ecosistemas/c2").get())
+
+    def test_multi_path_update_is_atomic_and_rejects_overlaps(self):
+        self.ref("/ecosistemas/c1").update({
+            "estados_reportes/h1": {"codigo_unico": "A", "estado_reporte": {"a": 1, "b": 2}, "version": 1},
+            "dispositivos/equipo-1/feed_estudios/k1": {"codigo_unico": "A", "updatedAt": 5},
+        })
+        self.ref("/ecosistemas/c1").update({
+            "estados_reportes/h1/estado_reporte/a": None,
+            "estados_reportes/h1/estado_reporte/c": {"d": 3},
+            "estados_reportes/h1/version": 2,
+        })
+        self.assertEqual(self.ref("/ecosistemas/c1/estados_reportes/h1").get(), {
+            "codigo_unico": "A", "estado_reporte": {"b": 2, "c": {"d": 3}}, "version": 2,
+        })
+        with self.assertRaises(ValueError):
+            self.ref("/ecosistemas/c1").update({"estados_reportes/h1": None, "estados_reportes/h1/version": 3})
+        self.assertEqual(self.ref("/ecosistemas/c1/estados_reportes/h1/version").get(), 2)
+
+    def test_child_queries_use_the_report_and_updated_indexes(self):
+        feed = self.ref("/ecosistemas/c1/dispositivos/equipo-1/feed_estudios")
+        feed.child("k1").set({"codigo_unico": "B", "updatedAt": 9})
+        feed.child("k2").set({"codigo_unico": "A", "updatedAt": 7})
+        feed.child("k3").set({"codigo_unico": "A", "updatedAt": 8})
+        conn = self.store._conn()
+        self.assertEqual(conn.execute("SELECT centro_id, codigo_unico, updated_at FROM nodes WHERE key = 'k2'").fetchone(),
+                         ("c1", "A", 7))
+        self.assertEqual(list(feed.order_by_child("updatedAt").start_at(8).get()), ["k3", "k1"])
+        self.assertEqual(list(feed.order_by_child("codigo_unico").equal_to("A").get()), ["k2", "k3"])
+        segments = ["ecosistemas", "c1", "dispositivos", "equipo-1", "feed_estudios"]
+        for child, index in (("updatedAt", "nodes_updated"), ("codigo_unico", "nodes_report")):
+            sql, args = self.store.child_query_sql(segments, child, "A", "A")
+            plan = " ".join(str(row) for row in conn.execute("EXPLAIN QUERY PLAN " + sql, args))
+            self.assertIn(index, plan)
+
+    def test_ordered_queries_and_deletes(self):
+        for n in range(1, 6):
+            self.ref(f"/ecosistemas/c1/estados_reportes_historial/h1/deltas/v{n:08d}").set({"patch": [], "n": n})
+        deltas = self.ref("/ecosistemas/c1/estados_reportes_historial/h1/deltas")
+        self.assertEqual(list(deltas.order_by_key().start_at("v00000002").end_at("v00000004").get()),
+                         ["v00000002", "v00000003", "v00000004"])
+        self.assertEqual(list(deltas.order_by_key().limit_to_last(2).get()), ["v00000004", "v00000005"])
+        self.ref("/ecosistemas/c1/estados_reportes_historial/h1").delete()
+        self.assertIsNone(self.ref("/ecosistemas/c1").get())
+
+    def test_scalar_is_replaced_by_object(self):
+        self.ref("/config/modo").set("a")
+        self.ref("/config/modo/detalle").set(1)
+        self.assertEqual(self.ref("/config").get(), {"modo": {"detalle": 1}})
+
+
+class SQLiteBackendAppTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+        self.store = storage.SQLiteStore(os.path.join(self.tmp.name, "rtdb.sqlite3"))
+        patcher = mock.patch.object(fio, "store", self.store)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        FakeReference.reset()
+        service.invalidate_devices()
+        service.cache.clear()
+        self.client = service.app.test_client()
+        self.headers = {"Authorization": f"Bearer {os.environ['PUSH_FEED_TOKEN']}"}
+
+    def test_push_feed_and_restore_round_trip(self):
+        for dev in ("equipo-1", "equipo-2"):
+            self.store.reference(f"/ecosistemas/centro-sql/dispositivos/{dev}/nombre").set(dev)
+        identity = {"codigo_unico": "SQL-1", "centro_id": "centro-sql", "email_usuario": "a@example.com"}
+        for version in (1, 2):
+            save = self.client.post("/push_feed", headers=self.headers,
+                                    json={**identity, "estado_reporte": {"paso": version}})
+            self.assertEqual(save.status_code, 200)
+            self.assertEqual(set(save.get_json()["pushed"]), {"equipo-1", "equipo-2"})
+        service.cache.clear()
+        restore = self.client.post("/recuperar_estado_reporte", headers=self.headers, json=identity)
+        self.assertEqual(restore.get_json()["estado_reporte"], {"paso": 2})
+        older = self.client.post("/recuperar_estado_reporte", headers=self.headers, json={**identity, "version": 1})
+        self.assertEqual(older.get_json()["estado_reporte"], {"paso": 1})
+        feed = self.store.reference("/ecosistemas/centro-sql/dispositivos/equipo-2/feed_estudios").get()
+        self.assertEqual(len(feed), 2)
+        self.assertEqual(FakeReference.updates, [])
+
+
+if __name__ == "__main__":
+    unittest.main()
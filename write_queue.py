@@ -0,0 +1,229 @@
+# write_queue.py — cola durable (SQLite WAL) para escrituras a Firebase en segundo plano
+import json, os, random, sqlite3, threading, time, uuid
+
+WRITE_QUEUE_PATH = os.getenv("WRITE_QUEUE_PATH", "/tmp/servidor_sync_queue.sqlite3")
+WRITE_QUEUE_WORKERS = int(os.getenv("WRITE_QUEUE_WORKERS", "2"))
+WRITE_QUEUE_MAX_ATTEMPTS = int(os.getenv("WRITE_QUEUE_MAX_ATTEMPTS", "8"))
+WRITE_QUEUE_BACKOFF_BASE = float(os.getenv("WRITE_QUEUE_BACKOFF_BASE", "0.5"))  # segundos
+WRITE_QUEUE_BACKOFF_MAX = float(os.getenv("WRITE_QUEUE_BACKOFF_MAX", "60"))
+WRITE_QUEUE_LEASE = float(os.getenv("WRITE_QUEUE_LEASE", "120"))  # segundos antes de reintentar un trabajo huérfano
+WRITE_QUEUE_RETENTION = float(os.getenv("WRITE_QUEUE_RETENTION", str(24 * 3600)))
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id TEXT PRIMARY KEY,
+    kind TEXT NOT NULL,
+    payload TEXT NOT NULL,
+    status TEXT NOT NULL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    next_attempt REAL NOT NULL,
+    lease_until REAL,
+    created REAL NOT NULL,
+    updated REAL NOT NULL,
+    result TEXT,
+    error TEXT
+);
+CREATE INDEX IF NOT EXISTS jobs_ready ON jobs (status, next_attempt);
+CREATE TABLE IF NOT EXISTS job_keys (
+    job_id TEXT NOT NULL,
+    key TEXT NOT NULL,
+    PRIMARY KEY (job_id, key)
+);
+CREATE INDEX IF NOT EXISTS job_keys_key ON job_keys (key);
+"""
+
+class WriteQueue:
+    """Durable job queue drained by a pool of background threads.
+
+    Jobs are claimed with a lease, so a job held by a worker process that died
+    is picked up again once the lease expires; that is also how the queue is
+    replayed after a restart. Several gunicorn workers can share one file.
+
+    Jobs enqueued with the same key (one per report) run one at a time and in
+    order: a job waits while an earlier one with a shared key is pending,
+    running or backing off, so an old save never lands after a newer one.
+    """
+
+    def __init__(self, handlers, path=WRITE_QUEUE_PATH, workers=WRITE_QUEUE_WORKERS,
+                 max_attempts=WRITE_QUEUE_MAX_ATTEMPTS, backoff_base=WRITE_QUEUE_BACKOFF_BASE,
+                 backoff_max=WRITE_QUEUE_BACKOFF_MAX, lease=WRITE_QUEUE_LEASE):
+        self.handlers = dict(handlers)
+        self.path = path
+        self.workers = workers
+        self.max_attempts = max_attempts
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.lease = lease
+        self._local = threading.local()
+        self._wakeup = threading.Condition()
+        self._threads = []
+        self._stopping = False
+        self._schema_ready = False
+
+    def _conn(self):
+        # Una conexión heredada por fork (gunicorn --preload) no debe reutilizarse.
+        conn = getattr(self._local, "conn", None)
+        if conn is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            if not self._schema_ready:
+                conn.executescript(SCHEMA)
+                self._schema_ready = True
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    def enqueue(self, kind, payload, keys=()):
+        if kind not in self.handlers:
+            raise ValueError(f"Tipo de trabajo desconocido: {kind}")
+        job_id = uuid.uuid4().hex
+        now = time.time()
+        conn = self._conn()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            conn.execute(
+                "INSERT INTO jobs (id, kind, payload, status, next_attempt, created, updated)"
+                " VALUES (?, ?, ?, 'pending', ?, ?, ?)",
+                (job_id, kind, json.dumps(payload, separators=(",", ":")), now, now, now),
+            )
+            conn.executemany("INSERT OR IGNORE INTO job_keys (job_id, key) VALUES (?, ?)",
+                             [(job_id, key) for key in keys])
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        with self._wakeup:
+            self._wakeup.notify()
+        return job_id
+
+    def status(self, job_id):
+        row = self._conn().execute(
+            "SELECT id, kind, status, attempts, created, updated, result, error FROM jobs WHERE id = ?",
+            (job_id,),
+        ).fetchone()
+        if row is None:
+            return None
+        return {
+            "job_id": row[0],
+            "kind": row[1],
+            "status": row[2],
+            "attempts": row[3],
+            "created": int(row[4] * 1000),
+            "updated": int(row[5] * 1000),
+            "result": json.loads(row[6]) if row[6] else None,
+            "error": row[7],
+        }
+
+    def _claim(self):
+        conn = self._conn()
+        now = time.time()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            # rowid sigue el orden de inserción, también entre procesos.
+            row = conn.execute(
+                "SELECT id, kind, payload, attempts FROM jobs AS job"
+                " WHERE ((status = 'pending' AND next_attempt <= ?)"
+                "        OR (status = 'running' AND lease_until < ?))"
+                "   AND NOT EXISTS ("
+                "       SELECT 1 FROM job_keys AS mine"
+                "       JOIN job_keys AS other ON other.key = mine.key AND other.job_id != mine.job_id"
+                "       JOIN jobs AS earlier ON earlier.id = other.job_id"
+                "       WHERE mine.job_id = job.id AND earlier.rowid < job.rowid"
+                "         AND earlier.status IN ('pending', 'running'))"
+                " ORDER BY rowid LIMIT 1",
+                (now, now),
+            ).fetchone()
+            if row is not None:
+                conn.execute(
+                    "UPDATE jobs SET status = 'running', attempts = attempts + 1,"
+                    " lease_until = ?, updated = ? WHERE id = ?",
+                    (now + self.lease, now, row[0]),
+                )
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        return row
+
+    def _finish(self, job_id, status, result=None, error=None, next_attempt=None):
+        now = time.time()
+        conn = self._conn()
+        conn.execute(
+            "UPDATE jobs SET status = ?, result = ?, error = ?, next_attempt = COALESCE(?, next_attempt),"
+            " lease_until = NULL, updated = ? WHERE id = ?",
+            (status, json.dumps(result) if result is not None else None, error, next_attempt, now, job_id),
+        )
+        if status in ("done", "failed"):
+            # Terminado: deja de bloquear a los trabajos posteriores del mismo reporte.
+            conn.execute("DELETE FROM job_keys WHERE job_id = ?", (job_id,))
+
+    def backoff(self, attempts):
+        delay = min(self.backoff_max, self.backoff_base * (2 ** max(0, attempts - 1)))
+        return delay * (0.5 + random.random() / 2)
+
+    def run_one(self):
+        """Claim and execute one ready job; returns False when none is ready."""
+        row = self._claim()
+        if row is None:
+            return False
+        job_id, kind, payload, attempts = row
+        attempts += 1
+        try:
+            status, body = self.handlers[kind](json.loads(payload))
+        except Exception as exc:
+            if attempts >= self.max_attempts:
+                self._finish(job_id, "failed", error=str(exc))
+            else:
+                self._finish(job_id, "pending", error=str(exc),
+                             next_attempt=time.time() + self.backoff(attempts))
+            return True
+        # 2xx = hecho; 4xx = error del payload, reintentar no ayuda.
+        self._finish(job_id, "done" if 200 <= status < 300 else "failed",
+                     result={"status": status, "body": body})
+        return True
+
+    def drain(self, max_jobs=None):
+        processed = 0
+        while (max_jobs is None or processed < max_jobs) and self.run_one():
+            processed += 1
+        return processed
+
+    def prune(self, retention=WRITE_QUEUE_RETENTION):
+        self._conn().execute(
+            "DELETE FROM jobs WHERE status IN ('done', 'failed') AND updated < ?",
+            (time.time() - retention,),
+        )
+
+    def _loop(self):
+        last_prune = 0
+        while not self._stopping:
+            try:
+                if self.run_one():
+                    continue
+                if time.time() - last_prune > 600:
+                    self.prune()
+                    last_prune = time.time()
+            except Exception as exc:
+                print(f"[write_queue] error: {exc}")
+            # Sin trabajo listo: esperar aviso local o sondear (otros procesos
+            # también encolan y los reintentos maduran con el tiempo).
+            with self._wakeup:
+                self._wakeup.wait(timeout=1.0)
+
+    def start(self):
+        if self._threads:
+            return
+        self._stopping = False
+        for index in range(max(1, self.workers)):
+            thread = threading.Thread(target=self._loop, name=f"write-queue-{index}", daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def stop(self, timeout=5):
+        self._stopping = True
+        with self._wakeup:
+            self._wakeup.notify_all()
+        for thread in self._threads:
+            thread.join(timeout)
+        self._threads = []